@@ -45,7 +45,7 @@ def patch_pathlib_for_cross_platform_loading():
 
 patch_pathlib_for_cross_platform_loading()
 
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Header, Request
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Header, Request, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import joblib
@@ -54,16 +54,17 @@ from PIL import Image
 import pandas as pd
 import io
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 from dotenv import load_dotenv
 import os
 import re
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, NamedTuple, Sequence
 import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from firebase_admin import credentials, firestore, firestore_async, auth
 from google.cloud.firestore_v1 import Query
-from datetime import datetime, timedelta
-from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, OrderedDict
 import cv2
 from google.cloud.firestore import SERVER_TIMESTAMP
 from reportlab.lib.pagesizes import letter, A4
@@ -73,33 +74,356 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from reportlab.pdfgen import canvas
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 import tempfile
 import torch
 import json
+import sqlite3
+import threading
+import time
+import asyncio
+import hashlib
+import anyio
+import bisect
+import random
+import warnings
+import itertools
+import uuid
+import unicodedata
+import abc
 
 # Load environment variables first
 load_dotenv()
 
-# Load Firebase credentials from environment variables
-firebase_creds = {
-    "type": os.getenv("FIREBASE_TYPE"),
-    "project_id": os.getenv("FIREBASE_PROJECT_ID"),
-    "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
-    "private_key": os.getenv("FIREBASE_PRIVATE_KEY", "").replace("\\n", "\n"),  # Convert literal \n to actual newlines
-    "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
-    "client_id": os.getenv("FIREBASE_CLIENT_ID"),
-    "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
-    "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
-    "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_CERT_URL"),
-    "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_CERT_URL"),
-    "universe_domain": os.getenv("FIREBASE_UNIVERSE_DOMAIN")
+# ===== DATA ACCESS LAYER =====
+# "firestore" (default) talks to the live Firebase project.
+# "memory" keeps everything in-process so the API can be load-tested offline.
+DATA_BACKEND = os.getenv("DATA_BACKEND", "firestore").lower()
+
+# Memory mode trusts any "uid[:email]" bearer string, so it must be opted into
+ALLOW_INSECURE_MEMORY_AUTH = os.getenv("ALLOW_INSECURE_MEMORY_AUTH", "false").lower() == "true"
+
+# Cap on in-flight Firestore RPCs across all requests
+FIRESTORE_MAX_CONCURRENCY = int(os.getenv("FIRESTORE_MAX_CONCURRENCY", "32"))
+
+# Worker threads for the remaining blocking work (models, Gemini, SQLite)
+THREADPOOL_SIZE = int(os.getenv("THREADPOOL_SIZE", "40"))
+
+# Sub-collection paths under farms/{farm_id}
+FARM_COLLECTIONS = {
+    "readings": ("sensors", "sensors_root", "readings"),
+    "leaf_scans": ("leaf_scans",),
+    "action_plans": ("action_plans",),
 }
 
-cred = credentials.Certificate(firebase_creds)
-firebase_admin.initialize_app(cred)
+SENSOR_FIELDS = ("soil_moisture", "temperature", "humidity", "rainfall_7d", "soil_ph")
+
+# Field projections for the summary views, so queries skip the bulky
+# per-document payloads (AI recommendations, full plans, ...)
+LEAF_SCAN_SUMMARY_FIELDS = ("grade", "disease_type", "confidence", "severity", "surface_analysis")
+ACTION_PLAN_SUMMARY_FIELDS = (
+    "composite_score",
+    "environmental_score",
+    "crop_health_score",
+    "market_opportunity_score",
+    "ai_insight",
+)
+
+# Page size cap for the history endpoints
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "50"))
+
+
+class SensorReading(NamedTuple):
+    """One IoT sample. Fields missing from the document are None."""
+    timestamp: datetime
+    soil_moisture: Optional[float] = None
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
+    rainfall_7d: Optional[float] = None
+    soil_ph: Optional[float] = None
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "SensorReading":
+        return cls(doc.get("timestamp"), *(doc.get(field) for field in SENSOR_FIELDS))
+
+
+class FarmRepository(abc.ABC):
+    """
+    Timestamp-ordered access to the per-farm collections.
+    Every query returns plain dicts (with the document "id") and supports
+    ordering, a limit, an inclusive start / exclusive `after` / inclusive
+    end range on "timestamp", a `fields` projection ("timestamp" is
+    always included), and a `cursor`: the id of the last document of the
+    previous page, resuming right after it in the same ordering.
+    Unknown cursors raise ValueError.
+    """
+
+    @abc.abstractmethod
+    async def query(
+        self,
+        farm_id: str,
+        collection: str,
+        *,
+        start: Optional[datetime] = None,
+        after: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        fields: Optional[Sequence[str]] = None,
+        cursor: Optional[str] = None
+    ) -> List[dict]:
+        ...
+
+    async def readings(self, farm_id: str, **kwargs) -> List[SensorReading]:
+        """Sensor readings as compact records, fetching only the sensor fields."""
+        docs = await self.query(farm_id, "readings", fields=SENSOR_FIELDS, **kwargs)
+        return [SensorReading.from_doc(doc) for doc in docs]
+
+    @abc.abstractmethod
+    async def add(self, farm_id: str, collection: str, doc: dict) -> str:
+        ...
+
+    def watch(self, farm_id: str, collection: str, callback):
+        """Call `callback()` whenever a document is added. Returns a handle or None."""
+        return None
+
+    @abc.abstractmethod
+    async def list_farms(self) -> List[str]:
+        ...
+
+
+class FirestoreFarmRepository(FarmRepository):
+    def __init__(self, client, sync_client, max_concurrency: int):
+        self.client = client
+        self.sync_client = sync_client
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @staticmethod
+    def _collection(client, farm_id: str, collection: str):
+        ref = client.collection("farms").document(farm_id)
+        path = FARM_COLLECTIONS[collection]
+        for i, name in enumerate(path):
+            ref = ref.collection(name) if i % 2 == 0 else ref.document(name)
+        return ref
+
+    async def query(self, farm_id, collection, *, start=None, after=None, end=None, descending=False, limit=None, fields=None, cursor=None):
+        collection_ref = self._collection(self.client, farm_id, collection)
+        query = collection_ref
+        if fields is not None:
+            query = query.select(["timestamp", *fields])
+        if start is not None:
+            query = query.where("timestamp", ">=", start)
+        if after is not None:
+            query = query.where("timestamp", ">", after)
+        if end is not None:
+            query = query.where("timestamp", "<=", end)
+        query = query.order_by(
+            "timestamp",
+            direction=Query.DESCENDING if descending else Query.ASCENDING
+        )
+        if limit is not None:
+            query = query.limit(limit)
+
+        async with self._semaphore:
+            if cursor is not None:
+                snapshot = await collection_ref.document(cursor).get()
+                if not snapshot.exists:
+                    raise ValueError(f"Unknown cursor: {cursor}")
+                query = query.start_after(snapshot)
+            return [{**doc.to_dict(), "id": doc.id} async for doc in query.stream()]
+
+    async def add(self, farm_id, collection, doc):
+        async with self._semaphore:
+            _, ref = await self._collection(self.client, farm_id, collection).add(doc)
+        return ref.id
+
+    async def list_farms(self):
+        async with self._semaphore:
+            return [ref.id async for ref in self.client.collection("farms").list_documents()]
+
+    def watch(self, farm_id, collection, callback):
+        first_snapshot = [True]
+
+        def on_change(docs, changes, read_time):
+            if first_snapshot[0]:
+                first_snapshot[0] = False
+                return
+            callback()
+
+        return (
+            self._collection(self.sync_client, farm_id, collection)
+            .order_by("timestamp", direction=Query.DESCENDING)
+            .limit(1)
+            .on_snapshot(on_change)
+        )
+
+
+class InMemoryFarmRepository(FarmRepository):
+    """
+    In-process stand-in for Firestore. Documents are kept sorted by
+    timestamp per (farm, collection), so ranged and limited queries are
+    bisect lookups just like indexed Firestore queries.
+    """
+
+    def __init__(self):
+        # (farm_id, collection) -> parallel sorted lists of (epoch, seq) keys and docs
+        self._keys = defaultdict(list)
+        self._docs = defaultdict(list)
+        self._ids = defaultdict(dict)  # (farm_id, collection) -> {doc id: key}
+        self._watchers = defaultdict(list)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _epoch(ts) -> float:
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return ts.timestamp()
+
+    async def query(self, farm_id, collection, *, start=None, after=None, end=None, descending=False, limit=None, fields=None, cursor=None):
+        with self._lock:
+            keys = self._keys[(farm_id, collection)]
+            lo, hi = 0, len(keys)
+            if start is not None:
+                lo = max(lo, bisect.bisect_left(keys, (self._epoch(start),)))
+            if after is not None:
+                lo = max(lo, bisect.bisect_left(keys, (self._epoch(after), float("inf"))))
+            if end is not None:
+                hi = min(hi, bisect.bisect_left(keys, (self._epoch(end), float("inf"))))
+            if cursor is not None:
+                cursor_key = self._ids[(farm_id, collection)].get(cursor)
+                if cursor_key is None:
+                    raise ValueError(f"Unknown cursor: {cursor}")
+                if descending:
+                    hi = min(hi, bisect.bisect_left(keys, cursor_key))
+                else:
+                    lo = max(lo, bisect.bisect_right(keys, cursor_key))
+
+            docs = self._docs[(farm_id, collection)]
+            if descending:
+                stop = max(lo, hi - limit) if limit is not None else lo
+                selected = docs[stop:hi][::-1]
+            else:
+                selected = docs[lo:min(hi, lo + limit) if limit is not None else hi]
+
+        if fields is None:
+            return [dict(doc) for doc in selected]
+        keep = ("id", "timestamp", *fields)
+        return [{key: doc[key] for key in keep if key in doc} for doc in selected]
+
+    async def add(self, farm_id, collection, doc):
+        return self.add_sync(farm_id, collection, doc)
+
+    def add_sync(self, farm_id: str, collection: str, doc: dict) -> str:
+        doc = dict(doc)
+        if doc.get("timestamp") is None or doc.get("timestamp") is SERVER_TIMESTAMP:
+            doc["timestamp"] = datetime.now(timezone.utc)
+
+        with self._lock:
+            self._seq += 1
+            doc["id"] = doc.get("id") or f"mem_{self._seq}"
+            key = (self._epoch(doc["timestamp"]), self._seq)
+            keys = self._keys[(farm_id, collection)]
+            index = bisect.bisect_right(keys, key)
+            keys.insert(index, key)
+            self._docs[(farm_id, collection)].insert(index, doc)
+            self._ids[(farm_id, collection)][doc["id"]] = key
+            callbacks = list(self._watchers[(farm_id, collection)])
+
+        for callback in callbacks:
+            callback()
+        return doc["id"]
+
+    def watch(self, farm_id, collection, callback):
+        with self._lock:
+            self._watchers[(farm_id, collection)].append(callback)
+        return callback
+
+    async def list_farms(self):
+        with self._lock:
+            return sorted({farm_id for farm_id, _ in self._keys})
+
+
+def seed_memory_repository(repo: InMemoryFarmRepository, farm_id: str, days: int, interval_seconds: int):
+    """Fill the in-memory backend with synthetic readings and leaf scans."""
+    rng = np.random.default_rng(int(hashlib.md5(farm_id.encode()).hexdigest()[:8], 16))
+    now = datetime.now(timezone.utc)
+    count = int(days * 86400 / interval_seconds)
+
+    for i in range(count):
+        ts = now - timedelta(seconds=(count - i) * interval_seconds)
+        hour_angle = 2 * np.pi * (ts.hour + ts.minute / 60) / 24
+        repo.add_sync(farm_id, "readings", {
+            "timestamp": ts,
+            "soil_moisture": round(float(60 + 6 * np.sin(hour_angle) + rng.normal(0, 1.5)), 2),
+            "temperature": round(float(23 + 4 * np.sin(hour_angle - 1) + rng.normal(0, 0.8)), 2),
+            "humidity": round(float(70 + 6 * np.cos(hour_angle) + rng.normal(0, 2)), 2),
+            "rainfall_7d": round(float(max(0, 55 + rng.normal(0, 10))), 2),
+            "soil_ph": round(float(5.2 + rng.normal(0, 0.1)), 2),
+        })
+
+    grades = ["Healthy", "Healthy", "Stressed", "Diseased"]
+    for i in range(days * 2):
+        grade = grades[int(rng.integers(len(grades)))]
+        repo.add_sync(farm_id, "leaf_scans", {
+            "timestamp": now - timedelta(hours=12 * (days * 2 - i)),
+            "grade": grade,
+            "disease_type": "Red Rust" if grade == "Diseased" else None,
+            "cnn_prediction": "Red Rust" if grade == "Diseased" else "healthy",
+            "confidence": round(float(rng.uniform(0.7, 0.99)), 2),
+            "confidence_level": "High",
+            "severity": "Moderate" if grade == "Diseased" else "Low",
+            "surface_analysis": {"green": 0.7, "yellow": 0.1, "brown": 0.05, "dark": 0.01},
+            "decision_source": "RULE_BASED",
+        })
+
+    print(f"🧪 Seeded {count} readings for {farm_id} in the in-memory backend")
+
+
+if DATA_BACKEND == "memory":
+    if not ALLOW_INSECURE_MEMORY_AUTH:
+        raise RuntimeError(
+            "DATA_BACKEND=memory accepts unverified bearer tokens; "
+            "set ALLOW_INSECURE_MEMORY_AUTH=true to run it for local testing"
+        )
+    print("🚨🚨🚨 INSECURE: in-memory backend accepts ANY bearer token as 'uid[:email]'. Never expose this server. 🚨🚨🚨")
+    repo = InMemoryFarmRepository()
+    for seed_farm in filter(None, os.getenv("MEMORY_SEED_FARMS", "demo_farm").split(",")):
+        seed_memory_repository(
+            repo,
+            seed_farm.strip(),
+            days=int(os.getenv("MEMORY_SEED_DAYS", "7")),
+            interval_seconds=int(os.getenv("MEMORY_SEED_INTERVAL_SECONDS", "7"))
+        )
+else:
+    # Load Firebase credentials from environment variables
+    firebase_creds = {
+        "type": os.getenv("FIREBASE_TYPE"),
+        "project_id": os.getenv("FIREBASE_PROJECT_ID"),
+        "private_key_id": os.getenv("FIREBASE_PRIVATE_KEY_ID"),
+        "private_key": os.getenv("FIREBASE_PRIVATE_KEY", "").replace("\\n", "\n"),  # Convert literal \n to actual newlines
+        "client_email": os.getenv("FIREBASE_CLIENT_EMAIL"),
+        "client_id": os.getenv("FIREBASE_CLIENT_ID"),
+        "auth_uri": os.getenv("FIREBASE_AUTH_URI"),
+        "token_uri": os.getenv("FIREBASE_TOKEN_URI"),
+        "auth_provider_x509_cert_url": os.getenv("FIREBASE_AUTH_PROVIDER_CERT_URL"),
+        "client_x509_cert_url": os.getenv("FIREBASE_CLIENT_CERT_URL"),
+        "universe_domain": os.getenv("FIREBASE_UNIVERSE_DOMAIN")
+    }
 
-db = firestore.client()
+    cred = credentials.Certificate(firebase_creds)
+    firebase_admin.initialize_app(cred)
+
+    # Async client for request handlers; the sync client is kept for snapshot listeners
+    repo = FirestoreFarmRepository(
+        firestore_async.client(),
+        firestore.client(),
+        FIRESTORE_MAX_CONCURRENCY
+    )
+
+print(f"🗃️ Data backend: {DATA_BACKEND}")
 
 # ===== TWILIO SMS CONFIGURATION =====
 from twilio.rest import Client
@@ -119,52 +443,599 @@ if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
 else:
     print("⚠️ Twilio credentials not configured - SMS service disabled")
 
-try:
-    df = pd.read_excel("teadata.xlsx")
+MARKET_DATA_PATH = os.getenv("MARKET_DATA_PATH", "teadata.xlsx")
+
+market_columns = [
+    "kolkata", "guwahati", "siliguri", "jalpaiguri",
+    "mjunction", "cochin", "coonoor", "coimbatore", "tea_serve"
+]
+
+
+def extract_price(val):
+    if pd.isna(val):
+        return np.nan
+    match = re.search(r"(\d+\.?\d*)", str(val))
+    return float(match.group(1)) if match else np.nan
+
+
+def load_market_data(source) -> tuple:
+    """
+    Parse the weekly auction workbook (a path or the file's bytes) into a
+    price frame sorted by week. Returns (df, version); the version changes
+    whenever the file content does. Raises if the workbook is unusable.
+    """
+    raw = source if isinstance(source, bytes) else pathlib.Path(source).read_bytes()
+    data = pd.read_excel(io.BytesIO(raw))
 
-    df.columns = (
-        df.columns
+    data.columns = (
+        data.columns
         .str.strip()
         .str.lower()
         .str.replace(" ", "_")
         .str.replace("/", "_")
     )
 
-    df["week_ending_date"] = pd.to_datetime(df["week_ending_date"])
+    missing = [c for c in ["week_ending_date", *market_columns] if c not in data.columns]
+    if missing:
+        raise ValueError(f"Missing columns: {', '.join(missing)}")
 
-    market_columns = [
-        "kolkata", "guwahati", "siliguri", "jalpaiguri",
-        "mjunction", "cochin", "coonoor", "coimbatore", "tea_serve"
-    ]
-
-    def extract_price(val):
-        if pd.isna(val):
-            return np.nan
-        match = re.search(r"(\d+\.?\d*)", str(val))
-        return float(match.group(1)) if match else np.nan
+    data["week_ending_date"] = pd.to_datetime(data["week_ending_date"])
 
     for col in market_columns:
-        df[col] = df[col].apply(extract_price)
+        data[col] = data[col].apply(extract_price)
+
+    data["avg_price"] = data[market_columns].mean(axis=1)
+    data = data.sort_values("week_ending_date")
+    if data.empty:
+        raise ValueError("No weekly prices found")
 
-    df["avg_price"] = df[market_columns].mean(axis=1)
-    df = df.sort_values("week_ending_date")
+    # Identifies the loaded market data for cache fingerprints
+    version = (
+        f"{len(data)}:{data['week_ending_date'].iloc[-1].isoformat()}:"
+        f"{hashlib.md5(raw).hexdigest()[:8]}"
+    )
+    return data, version
+
+
+try:
+    df, MARKET_DATA_VERSION = load_market_data(MARKET_DATA_PATH)
 
 except Exception as e:
     print("❌ DATA LOAD ERROR:", e)
     df = None
+    MARKET_DATA_VERSION = None
+
+# ===== MARKET ANALYTICS SNAPSHOT =====
+# Derived KPIs for every market column, computed once per loaded dataset
+# so market endpoints read them instead of re-deriving from `df`
+
+# Market signal thresholds: demand index (0-100) and 7-week volatility (%)
+MARKET_SIGNAL_DEMAND_THRESHOLD = 20
+MARKET_SIGNAL_VOLATILITY_THRESHOLD = 3
+MARKET_PRICE_HISTORY_WEEKS = 8
+# Weeks in the linear trend behind price series forecasts
+MARKET_TREND_WEEKS = 10
+MARKET_MONTHLY_MONTHS = 12
+
+
+def market_signals(demand_index: np.ndarray, volatility: np.ndarray) -> np.ndarray:
+    """watch / opportunity / risk / neutral per market from demand and volatility."""
+    low_volatility = volatility < MARKET_SIGNAL_VOLATILITY_THRESHOLD
+    return np.select(
+        [
+            (demand_index < MARKET_SIGNAL_DEMAND_THRESHOLD) & low_volatility,
+            (demand_index >= MARKET_SIGNAL_DEMAND_THRESHOLD) & low_volatility,
+            volatility >= MARKET_SIGNAL_VOLATILITY_THRESHOLD,
+        ],
+        ["watch", "opportunity", "risk"],
+        "neutral"
+    )
+
+
+def demand_index_from_change(latest: np.ndarray, previous: np.ndarray) -> np.ndarray:
+    """Weekly absolute price change in %, x5, capped at 100 to avoid spikes."""
+    return np.minimum(np.abs((latest - previous) / previous) * 100 * 5, 100)
+
+
+def coefficient_of_variation(window: np.ndarray) -> np.ndarray:
+    """Sample std / mean in % per column, ignoring missing weeks."""
+    return np.nanstd(window, axis=0, ddof=1) / np.nanmean(window, axis=0) * 100
+
+
+def monthly_demand_volatility(data: pd.DataFrame) -> dict:
+    """Per market, the last 12 months of weekly price counts and volatility."""
+    months = data["week_ending_date"].dt.to_period("M")
+    recent_months = months.sort_values().unique()[-MARKET_MONTHLY_MONTHS:]
+    in_range = months.isin(recent_months)
+    grouped = data.loc[in_range, market_columns].groupby(months[in_range])
+
+    counts = grouped.count()
+    volatility = grouped.std() / grouped.mean() * 100
+
+    labels = [m.to_timestamp().strftime("%b %Y") for m in counts.index]
+    return {
+        col: [
+            {
+                "month": label,
+                "demand": int(count * 100),
+                "volatility": None if pd.isna(vol) else round(float(vol), 2),
+            }
+            for label, count, vol in zip(labels, counts[col], volatility[col])
+        ]
+        for col in market_columns
+    }
+
+
+def build_market_snapshot(data: Optional[pd.DataFrame], version: Optional[str]) -> dict:
+    """
+    KPIs for every market column of `data` (sorted by week), keyed by
+    column. All markets are computed together as column-wise operations on
+    a weeks x markets price matrix; each market's figures use only its own
+    non-null weeks. Markets with fewer than 3 weeks of prices are marked
+    incomplete and their change-based figures use the weeks available.
+    """
+    if data is None or data.empty:
+        return {"version": version, "week_ending": None, "markets": {}, "monthly": {}}
+
+    prices = data[market_columns].to_numpy(dtype=float)  # weeks x markets
+    dates = data["week_ending_date"].to_numpy()
+    valid = ~np.isnan(prices)
+    counts = valid.sum(axis=0)
+
+    # Move each market's missing weeks to the top, keeping the order of its
+    # prices, so row -k holds every market's k-th latest price (NaN if none)
+    rows = max(len(prices), 2 * 7)
+    order = np.argsort(valid, axis=0, kind="stable")
+    packed = np.full((rows, len(market_columns)), np.nan)
+    packed[-len(prices):] = np.take_along_axis(prices, order, axis=0)
+    week_rows = np.full((rows, len(market_columns)), -1)
+    week_rows[-len(prices):] = order
+
+    with np.errstate(divide="ignore", invalid="ignore"), warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+
+        current = packed[-1]
+        prev = np.where(counts > 1, packed[-2], current)
+        prev2 = np.where(counts > 2, packed[-3], prev)
+
+        price_change_pct = (current - prev) / prev * 100
+        demand_index = demand_index_from_change(current, prev)
+        prev_demand_index = demand_index_from_change(prev, prev2)
+
+        recent_7 = packed[-7:]
+        volatility = coefficient_of_variation(recent_7)
+        prev_volatility = np.where(counts >= 14, coefficient_of_variation(packed[-14:-7]), volatility)
+        price_std_7w = np.nanstd(recent_7, axis=0, ddof=1)
+
+        # Least-squares slope over each market's last MARKET_TREND_WEEKS prices
+        window = packed[-MARKET_TREND_WEEKS:]
+        in_window = ~np.isnan(window)
+        x = np.arange(len(window), dtype=float)[:, None]
+        x_mean = np.nanmean(np.where(in_window, x, np.nan), axis=0)
+        y_mean = np.nanmean(window, axis=0)
+        dx = np.where(in_window, x - x_mean, 0.0)
+        dy = np.where(in_window, window - y_mean, 0.0)
+        trend_slope = (dx * dy).sum(axis=0) / (dx * dx).sum(axis=0)
+        trend_slope = np.where(np.isfinite(trend_slope), trend_slope, 0.0)
+
+        trend = np.select([current > prev * 1.01, current < prev * 0.99], ["up", "down"], "stable")
+        signals = market_signals(demand_index, volatility)
+        avg_price = np.nanmean(prices, axis=0)
+        min_price = np.nanmin(prices, axis=0)
+        max_price = np.nanmax(prices, axis=0)
+
+    def number(value):
+        return None if np.isnan(value) else float(value)
+
+    def week(row, fmt):
+        return pd.Timestamp(dates[row]).strftime(fmt)
+
+    markets = {}
+    for i, col in enumerate(market_columns):
+        if not counts[i]:
+            continue
+        recent = [
+            (row, price) for row, price in zip(week_rows[-MARKET_TREND_WEEKS:, i], window[:, i])
+            if not np.isnan(price)
+        ]
+        markets[col] = {
+            "complete": bool(counts[i] >= 3),
+            "current_price": float(current[i]),
+            "previous_price": float(prev[i]),
+            "price_change_pct": float(price_change_pct[i]),
+            "price_direction": "downward" if current[i] < prev[i] else "upward",
+            "trend": str(trend[i]),
+            "demand_index": float(demand_index[i]),
+            "demand_change_abs": float(demand_index[i] - prev_demand_index[i]),
+            "volatility": number(volatility[i]),
+            "volatility_change_abs": number(volatility[i] - prev_volatility[i]),
+            # Standard deviation in ₹, as quoted to the chat assistant
+            "price_std_7w": number(price_std_7w[i]),
+            "signal": str(signals[i]),
+            "trend_slope": float(trend_slope[i]),
+            "trend_forecast": float(current[i] + trend_slope[i]),
+            "avg_price": float(avg_price[i]),
+            "min_price": float(min_price[i]),
+            "max_price": float(max_price[i]),
+            "week_ending": week(week_rows[-1, i], "%Y-%m-%d"),
+            "recent_prices": [
+                {"date": week(row, "%Y-%m-%d"), "price": round(float(price), 2)}
+                for row, price in recent
+            ],
+            "price_history": [
+                {"week": week(row, "%b %d"), "price": round(float(price), 2)}
+                for row, price in recent[-MARKET_PRICE_HISTORY_WEEKS:]
+            ],
+        }
+
+    return {
+        "version": version,
+        "week_ending": data["week_ending_date"].iloc[-1].strftime("%Y-%m-%d"),
+        "markets": markets,
+        "monthly": monthly_demand_volatility(data),
+    }
+
+
+def market_kpis_for(column: str, snapshot: dict = None) -> Optional[dict]:
+    """Snapshot KPIs for a market with at least 3 weeks of prices, else None."""
+    kpis = (snapshot or market_snapshot)["markets"].get(column)
+    return kpis if kpis and kpis["complete"] else None
+
+
+try:
+    market_snapshot = build_market_snapshot(df, MARKET_DATA_VERSION)
+except Exception as e:
+    print(f"❌ Market snapshot error: {e}")
+    market_snapshot = build_market_snapshot(None, None)
+
+# From here on market data is read only through `market_snapshot` (which
+# carries its version), so a reload replaces it with a single assignment
+del df, MARKET_DATA_VERSION
 
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 
+# ===== LLM GATEWAY =====
+LLM_DEFAULT_MODEL = "models/gemini-flash-latest"
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "15"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+# Streamed responses run longer than one-shot calls
+LLM_STREAM_TIMEOUT_SECONDS = float(os.getenv("LLM_STREAM_TIMEOUT_SECONDS", "60"))
+
+
+class LLMUnavailable(Exception):
+    """Raised instead of calling Gemini when the call cannot succeed in time."""
+
+
+class LLMGateway:
+    """
+    Single entry point for Gemini calls.
+
+    - model clients are created once per model name and reused
+    - every call has a deadline covering queueing, retries and the request
+    - at most `max_concurrency` calls are in flight process-wide
+    - transient provider errors are retried with jittered exponential backoff
+    - after `breaker_threshold` consecutive provider failures (5xx, 429,
+      network errors) the circuit opens and calls fail immediately (so
+      callers use their rule-based fallbacks) until a single probe call
+      succeeds after the cooldown; local failures such as a missed deadline
+      or no free slot do not count
+    """
+
+    RETRYABLE = (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        TimeoutError,
+        ConnectionError,
+    )
+
+    # Errors that say the provider is unhealthy; anything else leaves the breaker alone
+    PROVIDER_FAILURES = (
+        google_exceptions.ServerError,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted,
+        TimeoutError,
+        ConnectionError,
+    )
+
+    def __init__(self, timeout: float, max_concurrency: int, max_retries: int,
+                 breaker_threshold: int, breaker_cooldown: float):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._models = {}
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self.calls = 0
+        self.failures = 0
+        self.short_circuited = 0
+
+    def _model(self, name: str):
+        with self._lock:
+            if name not in self._models:
+                self._models[name] = genai.GenerativeModel(name)
+            return self._models[name]
+
+    def _allow(self):
+        """Returns (allowed, probe); `probe` marks the single half-open call."""
+        with self._lock:
+            if self._opened_at is None:
+                return True, False
+            if time.monotonic() - self._opened_at < self.breaker_cooldown or self._probe_in_flight:
+                return False, False
+            self._probe_in_flight = True  # half-open: let one call through
+            return True, True
+
+    def _outcome(self, error: Exception) -> Optional[bool]:
+        """False for a provider failure, None for a local one that is not counted."""
+        return False if isinstance(error, self.PROVIDER_FAILURES) else None
+
+    def _record(self, ok: Optional[bool], probe: bool = False):
+        with self._lock:
+            if probe:
+                self._probe_in_flight = False
+            if ok is None:
+                return
+            if ok:
+                if self._opened_at is not None:
+                    print("✅ LLM circuit closed")
+                self._consecutive_failures = 0
+                self._opened_at = None
+                return
+
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self._opened_at is not None or self._consecutive_failures >= self.breaker_threshold:
+                if self._opened_at is None:
+                    print(f"⚠️ LLM circuit opened after {self._consecutive_failures} failures")
+                self._opened_at = time.monotonic()
+
+    def generate_content(self, prompt: str, model: str = LLM_DEFAULT_MODEL, timeout: Optional[float] = None):
+        """Drop-in for GenerativeModel(model).generate_content(prompt)."""
+        allowed, probe = self._allow()
+        if not allowed:
+            with self._lock:
+                self.short_circuited += 1
+            raise LLMUnavailable("circuit open")
+
+        with self._lock:
+            self.calls += 1
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+        try:
+            response = self._call_with_retries(prompt, model, deadline)
+        except Exception as e:
+            self._record(self._outcome(e), probe)
+            raise
+        self._record(True, probe)
+        return response
+
+    def _call_with_retries(self, prompt: str, model: str, deadline: float):
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMUnavailable("deadline exceeded")
+            if not self._slots.acquire(timeout=remaining):
+                raise LLMUnavailable("no free slot before deadline")
+
+            try:
+                return self._model(model).generate_content(
+                    prompt,
+                    request_options={"timeout": remaining}
+                )
+            except self.RETRYABLE:
+                attempt += 1
+                backoff = random.uniform(0, min(4.0, 0.5 * 2 ** attempt))
+                if attempt > self.max_retries or time.monotonic() + backoff >= deadline:
+                    raise
+            finally:
+                self._slots.release()
+
+            time.sleep(backoff)
+
+    def stream_content(self, prompt: str, model: str = LLM_DEFAULT_MODEL, timeout: Optional[float] = None):
+        """
+        Yield response text chunks as Gemini produces them. Transient errors
+        are retried only until the first chunk has been yielded.
+        """
+        allowed, probe = self._allow()
+        if not allowed:
+            with self._lock:
+                self.short_circuited += 1
+            raise LLMUnavailable("circuit open")
+
+        with self._lock:
+            self.calls += 1
+        deadline = time.monotonic() + (timeout if timeout is not None else LLM_STREAM_TIMEOUT_SECONDS)
+        ok = None
+        attempt = 0
+        yielded = False
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise LLMUnavailable("deadline exceeded")
+                if not self._slots.acquire(timeout=remaining):
+                    raise LLMUnavailable("no free slot before deadline")
+
+                try:
+                    response = self._model(model).generate_content(
+                        prompt,
+                        stream=True,
+                        request_options={"timeout": remaining}
+                    )
+                    for chunk in response:
+                        if chunk.text:
+                            yielded = True
+                            yield chunk.text
+                    ok = True
+                    return
+                except self.RETRYABLE:
+                    attempt += 1
+                    backoff = random.uniform(0, min(4.0, 0.5 * 2 ** attempt))
+                    if yielded or attempt > self.max_retries or time.monotonic() + backoff >= deadline:
+                        raise
+                finally:
+                    self._slots.release()
+
+                time.sleep(backoff)
+        except GeneratorExit:
+            # Client went away; only chunks already received say anything about the provider
+            ok = True if yielded else None
+            raise
+        except Exception as e:
+            ok = self._outcome(e)
+            raise
+        finally:
+            self._record(ok, probe)
+
+    def stats(self) -> dict:
+        with self._lock:
+            if self._opened_at is None:
+                state = "closed"
+            elif time.monotonic() - self._opened_at < self.breaker_cooldown:
+                state = "open"
+            else:
+                state = "half_open"
+            return {
+                "state": state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "short_circuited": self.short_circuited,
+            }
+
+
+llm = LLMGateway(
+    LLM_TIMEOUT_SECONDS,
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_RETRIES,
+    LLM_BREAKER_THRESHOLD,
+    LLM_BREAKER_COOLDOWN_SECONDS
+)
+
 # Demo account configuration
 DEMO_EMAIL = os.getenv("DEMO_EMAIL", "demo@chaitea.com")
 
 # Security
 security = HTTPBearer()
 
+# ===== VERIFIED TOKEN CACHE =====
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+TOKEN_CERT_REFRESH_SECONDS = float(os.getenv("TOKEN_CERT_REFRESH_SECONDS", "1800"))
+FIREBASE_ID_TOKEN_CERT_URL = (
+    "https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com"
+)
+
+
+class VerifiedTokenCache:
+    """
+    LRU of decoded Firebase ID tokens keyed by the token's SHA-256.
+    An entry never outlives the token's own `exp` claim, so a cache hit
+    is exactly as valid as a fresh verify_id_token() call.
+    """
+
+    # Drop entries slightly before expiry to absorb clock skew
+    EXPIRY_MARGIN_SECONDS = 5
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, token: str, decoded: dict):
+        exp = decoded.get("exp")
+        if not exp:
+            return
+        expires_at = float(exp) - self.EXPIRY_MARGIN_SECONDS
+        if expires_at <= time.time():
+            return
+
+        with self._lock:
+            self._entries[self._key(token)] = (expires_at, decoded)
+            self._entries.move_to_end(self._key(token))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else None,
+        }
+
+
+token_cache = VerifiedTokenCache(TOKEN_CACHE_MAX_ENTRIES)
+
+
+def refresh_token_signing_keys():
+    """
+    Re-fetch Google's ID-token signing certificates through the Firebase
+    token verifier's own HTTP cache. Bypassing the cached copy here keeps it
+    fresh, so verify_id_token() never waits on a certificate download, even
+    when the key set rotates.
+    """
+    verifier = auth._get_client(firebase_admin.get_app())._token_verifier
+    verifier.request(
+        FIREBASE_ID_TOKEN_CERT_URL,
+        method="GET",
+        headers={"Cache-Control": "no-cache"}
+    )
+
+
+def token_signing_key_refresher():
+    while True:
+        try:
+            refresh_token_signing_keys()
+        except Exception as e:
+            print(f"⚠️ Signing key refresh failed: {type(e).__name__}: {e}")
+        time.sleep(TOKEN_CERT_REFRESH_SECONDS)
+
+
+def verify_token(token: str) -> dict:
+    """
+    Verify a bearer token. With the in-memory backend there is no Firebase
+    project to check against, so the token is taken as "uid" or "uid:email".
+    """
+    if DATA_BACKEND == "memory":
+        uid, _, email = token.partition(":")
+        return {"uid": uid, "email": email, "email_verified": bool(email), "exp": time.time() + 3600}
+    return auth.verify_id_token(token)
+
 # User model
 class User(BaseModel):
     uid: str
     email: str
+    email_verified: bool = False
+    role: str = ""  # Firebase custom claim, e.g. "fleet_manager"
     is_demo_view: bool = False
 
 # Authentication dependency
@@ -181,7 +1052,10 @@ async def get_current_user(
             raise HTTPException(status_code=401, detail="No credentials provided")
         
         token = credentials.credentials
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = token_cache.get(token)
+        if decoded_token is None:
+            decoded_token = await run_in_threadpool(verify_token, token)
+            token_cache.put(token, decoded_token)
         
         # Check for Demo Mode header
         is_demo = request.headers.get("X-Force-Demo") == "true"
@@ -191,6 +1065,8 @@ async def get_current_user(
         return User(
             uid=decoded_token['uid'],
             email=decoded_token.get('email', ''),
+            email_verified=bool(decoded_token.get('email_verified', False)),
+            role=decoded_token.get('role', ''),
             is_demo_view=is_demo
         )
     except Exception as e:
@@ -200,6 +1076,15 @@ async def get_current_user(
             detail="Invalid authentication credentials"
         )
 
+def user_has_role(user: User, role: str, allowed_emails: set) -> bool:
+    """
+    True if the token carries the `role` custom claim, or a verified email
+    on the allow-list. Unverified emails never grant privileges.
+    """
+    if user.role == role:
+        return True
+    return user.email_verified and user.email.lower() in allowed_emails
+
 # Farm ID resolution
 def resolve_farm_id(user: User) -> str:
     """
@@ -237,6 +1122,17 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Keep Google signing certs warm for token verification
+@app.on_event("startup")
+def start_token_signing_key_refresher():
+    if DATA_BACKEND == "memory":
+        return
+    threading.Thread(target=token_signing_key_refresher, daemon=True).start()
+
+@app.on_event("startup")
+def configure_threadpool():
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_SIZE
+
 # ===== HEALTH CHECK ENDPOINTS =====
 @app.get("/")
 def health_check():
@@ -265,7 +1161,18 @@ def detailed_health():
             "price_forecast": "loaded" if price_model else "failed",
             "yolo_detection": "loaded" if yolo_model else "failed"
         },
-        "firebase": "connected",
+        "data_backend": DATA_BACKEND,
+        "market_data": market_reloader.stats(),
+        "auth_token_cache": token_cache.stats(),
+        "sensor_store": TS_STORE_PATH,
+        "recent_readings_cache": recent_readings.stats(),
+        "scheduler": scheduler.stats() if SCHEDULER_ENABLED else "disabled",
+        "precomputed": precomputed.stats(),
+        "llm_gateway": llm.stats(),
+        "chat_context_cache": chat_contexts.stats(),
+        "chat_response_cache": chat_response_cache.stats(),
+        "chat_router": chat_router.stats(),
+        "chat_sessions": conversations.stats(),
         "twilio_sms": "configured" if twilio_client else "not_configured",
         "timestamp": datetime.utcnow().isoformat()
     }
@@ -534,8 +1441,7 @@ Market Data:
 """
 
     try:
-        model = genai.GenerativeModel("models/gemini-flash-latest")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
         return response.text.strip() if response and response.text else None
     except Exception as e:
         print("❌ AI INSIGHT ERROR:", e)
@@ -559,8 +1465,7 @@ Market Context:
 """
 
     try:
-        model = genai.GenerativeModel("models/gemini-flash-latest")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
 
         if not response or not response.text:
             return []
@@ -610,8 +1515,7 @@ Leaf Analysis Result:
 """
 
     try:
-        model = genai.GenerativeModel("models/gemini-flash-latest")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
 
         if not response or not response.text:
             return ["No recommendations available for this scan."]
@@ -806,7 +1710,8 @@ async def leaf_quality(file: UploadFile = File(...), user: User = Depends(get_cu
     )
 
     # -------- AI RECOMMENDATIONS --------
-    ai_recommendations = generate_leaf_quality_recommendations(
+    ai_recommendations = await run_in_threadpool(
+        generate_leaf_quality_recommendations,
         grade=final_disease or final_grade,
         confidence=confidence
     )
@@ -829,10 +1734,8 @@ async def leaf_quality(file: UploadFile = File(...), user: User = Depends(get_cu
         "timestamp": SERVER_TIMESTAMP
     }
 
-    db.collection("farms") \
-      .document(FARM_ID) \
-      .collection("leaf_scans") \
-      .add(leaf_scan_doc)
+    await repo.add(FARM_ID, "leaf_scans", leaf_scan_doc)
+    chat_contexts.note_leaf_scan(FARM_ID)
 
     print("✅ Leaf scan stored in Firestore")
 
@@ -854,6 +1757,68 @@ async def leaf_quality(file: UploadFile = File(...), user: User = Depends(get_cu
     }
 
 
+async def fetch_history_page(
+    farm_id: str,
+    collection: str,
+    fields: Sequence[str],
+    limit: int,
+    cursor: Optional[str],
+    start: Optional[str],
+    end: Optional[str]
+) -> tuple:
+    """
+    One newest-first page of a farm history collection.
+    Returns (docs, next_cursor); next_cursor is None on the last page.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    try:
+        docs = await repo.query(
+            farm_id, collection,
+            start=parse_series_time(start, None),
+            end=parse_series_time(end, None),
+            descending=True,
+            limit=limit + 1,  # one extra row tells us whether another page exists
+            fields=fields,
+            cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, docs[-1]["id"]
+    return docs, None
+
+
+@app.get("/api/leaf-quality/history")
+async def leaf_scan_history(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user: User = Depends(get_current_user)
+):
+    """
+    Paginated leaf scan history, newest first.
+
+    Query params:
+    - limit: page size (capped at HISTORY_MAX_PAGE_SIZE)
+    - cursor: next_cursor from the previous page
+    - start / end: optional ISO-8601 date range
+    """
+    FARM_ID = resolve_farm_id(user)
+
+    scans, next_cursor = await fetch_history_page(
+        FARM_ID, "leaf_scans", LEAF_SCAN_SUMMARY_FIELDS, limit, cursor, start, end
+    )
+
+    return {
+        "count": len(scans),
+        "scans": scans,
+        "next_cursor": next_cursor
+    }
+
+
 # -----------------------------
 # CULTIVATION INTELLIGENCE
 # -----------------------------
@@ -889,8 +1854,7 @@ Field Data:
 """
 
     try:
-        model = genai.GenerativeModel("models/gemini-flash-latest")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt)
 
         if not response or not response.text:
             return ["AI recommendations unavailable at the moment."]
@@ -959,7 +1923,8 @@ def compute_stress_breakdown(data):
     risk_score = int(100 * total_stress)
     return clamp(risk_score), breakdown
 
-def run_cultivation_engine(data: dict):
+def predict_field_risks(data: dict):
+    """(pest_risk, drought_risk) labels from the field risk models."""
     features = np.array([[ 
         data["soil_moisture"],
         data["temperature"],
@@ -971,6 +1936,11 @@ def run_cultivation_engine(data: dict):
 
     pest_risk = normalize_risk(pest_model.predict(features)[0])
     drought_risk = normalize_risk(drought_model.predict(features)[0])
+    return pest_risk, drought_risk
+
+def assess_cultivation(data: dict) -> dict:
+    """Model- and rule-based cultivation assessment, without AI recommendations."""
+    pest_risk, drought_risk = predict_field_risks(data)
 
     health_score = compute_health_score({
         "soil_moisture": data["soil_moisture"],
@@ -986,16 +1956,6 @@ def run_cultivation_engine(data: dict):
         "rainfall_7d": "Optimal" if 40 <= data["rainfall_7d"] <= 80 else "Suboptimal",
     }
 
-    context = {
-        "health_score": health_score,
-        "pest_risk": pest_risk,
-        "drought_risk": drought_risk,
-        **data,
-        "score_explanation": score_explanation
-    }
-
-    ai_recommendations = generate_ai_recommendations_gemini(context)
-
     return {
         "health_score": clamp(health_score),
         "pest_risk": pest_risk,
@@ -1005,7 +1965,24 @@ def run_cultivation_engine(data: dict):
             if pest_risk == "High" or drought_risk == "High"
             else "Monitor and maintain current practices"
         ),
-        "score_explanation": score_explanation,
+        "score_explanation": score_explanation
+    }
+
+def run_cultivation_engine(data: dict):
+    assessment = assess_cultivation(data)
+
+    context = {
+        "health_score": assessment["health_score"],
+        "pest_risk": assessment["pest_risk"],
+        "drought_risk": assessment["drought_risk"],
+        **data,
+        "score_explanation": assessment["score_explanation"]
+    }
+
+    ai_recommendations = generate_ai_recommendations_gemini(context)
+
+    return {
+        **assessment,
         "ai_recommendations": ai_recommendations
     }
 
@@ -1042,36 +2019,478 @@ def aggregate_cultivation_metrics(data: dict):
         "count": len(df)
     }
 
-@app.get("/api/farm/averages")
-def get_farm_averages(user: User = Depends(get_current_user)):
-    FARM_ID = resolve_farm_id(user)
+# -----------------------------
+# SENSOR TIME-SERIES STORE
+# -----------------------------
 
-    readings_ref = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(50)
-    )
+TS_STORE_PATH = os.getenv("TS_STORE_PATH", "sensor_store.db")
+TS_SYNC_INTERVAL_SECONDS = float(os.getenv("TS_SYNC_INTERVAL_SECONDS", "30"))
+TS_BACKFILL_DAYS = int(os.getenv("TS_BACKFILL_DAYS", "90"))
 
-    docs = readings_ref.stream()
+# Per-field aggregates materialised in the hourly / daily rollup tables
+ROLLUP_AGGREGATES = ("min", "max", "sum", "n")
+ROLLUP_COLUMNS = [f"{field}_{agg}" for field in SENSOR_FIELDS for agg in ROLLUP_AGGREGATES]
 
-    readings = []
-    for doc in docs:
-        d = doc.to_dict()
-        readings.append({
-            "soil_moisture": d.get("soil_moisture"),
-            "temperature": d.get("temperature"),
-            "humidity": d.get("humidity"),
-            "rainfall_7d": d.get("rainfall_7d"),
-        })
 
+def to_epoch(ts) -> float:
+    """Convert a Firestore / python datetime to UTC epoch seconds."""
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+def from_epoch(ts: float) -> datetime:
+    return datetime.fromtimestamp(ts, tz=timezone.utc)
+
+
+class SensorTimeSeriesStore:
+    """
+    Embedded SQLite replica of the IoT readings, partitioned by farm and day.
+    Firestore stays the source of truth; analytics endpoints read from here so
+    range scans over weeks of readings never touch Firestore.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sync_locks = defaultdict(asyncio.Lock)
+        self._backfills: Dict[str, asyncio.Task] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS readings (
+                farm_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                ts REAL NOT NULL,
+                soil_moisture REAL,
+                temperature REAL,
+                humidity REAL,
+                rainfall_7d REAL,
+                soil_ph REAL,
+                PRIMARY KEY (farm_id, day, ts)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_readings_farm_ts ON readings (farm_id, ts)"
+        )
+        rollup_columns = ", ".join(f"{c} REAL" for c in ROLLUP_COLUMNS)
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS hourly_rollups (
+                farm_id TEXT NOT NULL,
+                hour INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                {rollup_columns},
+                rainfall REAL,
+                PRIMARY KEY (farm_id, hour)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_hourly_farm_day ON hourly_rollups (farm_id, day)"
+        )
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS daily_rollups (
+                farm_id TEXT NOT NULL,
+                day TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                {rollup_columns},
+                rainfall REAL,
+                PRIMARY KEY (farm_id, day)
+            ) WITHOUT ROWID
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sync_state (
+                farm_id TEXT PRIMARY KEY,
+                high_water REAL,
+                synced_at REAL
+            )
+        """)
+        self._backfill_rollups()
+
+    def _backfill_rollups(self):
+        """Build rollups for readings stored before the rollup tables existed."""
+        with self._lock:
+            missing = self._conn.execute("""
+                SELECT farm_id, MIN(ts), MAX(ts) FROM readings
+                WHERE farm_id NOT IN (SELECT DISTINCT farm_id FROM hourly_rollups)
+                GROUP BY farm_id
+            """).fetchall()
+            for farm_id, first_ts, last_ts in missing:
+                self._conn.execute("BEGIN")
+                self._refresh_rollups(farm_id, first_ts, last_ts)
+                self._conn.execute("COMMIT")
+
+    # -------- WRITE PATH --------
+
+    def insert_readings(self, farm_id: str, readings: List[SensorReading]) -> int:
+        """
+        Upsert SensorReading records. Returns the number of rows written.
+        """
+        rows = []
+        for r in readings:
+            if not r.timestamp:
+                continue
+            epoch = to_epoch(r.timestamp)
+            rows.append((
+                farm_id,
+                from_epoch(epoch).strftime("%Y-%m-%d"),
+                epoch,
+                *(getattr(r, field) for field in SENSOR_FIELDS)
+            ))
+
+        if not rows:
+            return 0
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO readings "
+                    "(farm_id, day, ts, soil_moisture, temperature, humidity, rainfall_7d, soil_ph) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._conn.execute(
+                    "INSERT INTO sync_state (farm_id, high_water, synced_at) VALUES (?, ?, NULL) "
+                    "ON CONFLICT(farm_id) DO UPDATE SET high_water = MAX(COALESCE(high_water, 0), excluded.high_water)",
+                    (farm_id, max(r[2] for r in rows))
+                )
+                self._refresh_rollups(farm_id, min(r[2] for r in rows), max(r[2] for r in rows))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        return len(rows)
+
+    def _refresh_rollups(self, farm_id: str, start_epoch: float, end_epoch: float):
+        """
+        Recompute the hourly and daily rollups touched by a write.
+        Buckets are rebuilt from their source rows, so re-delivered readings
+        never double count. Caller must hold the lock inside a transaction.
+        """
+        hour_start = int(start_epoch // 3600) * 3600
+        hour_end = int(end_epoch // 3600) * 3600 + 3600
+
+        hourly_select = ", ".join(
+            f"MIN({f}), MAX({f}), SUM({f}), COUNT({f})" for f in SENSOR_FIELDS
+        )
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO hourly_rollups "
+            f"(farm_id, hour, day, count, {', '.join(ROLLUP_COLUMNS)}, rainfall) "
+            f"SELECT farm_id, CAST(ts / 3600 AS INTEGER) * 3600 AS bucket, MIN(day), COUNT(*), "
+            f"{hourly_select}, COALESCE(SUM(rainfall_7d), 0) / 7.0 "
+            f"FROM readings WHERE farm_id = ? AND ts >= ? AND ts < ? GROUP BY bucket",
+            (farm_id, hour_start, hour_end)
+        )
+
+        daily_select = ", ".join(
+            f"MIN({f}_min), MAX({f}_max), SUM({f}_sum), SUM({f}_n)" for f in SENSOR_FIELDS
+        )
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO daily_rollups "
+            f"(farm_id, day, count, {', '.join(ROLLUP_COLUMNS)}, rainfall) "
+            f"SELECT farm_id, day, SUM(count), {daily_select}, SUM(rainfall) "
+            f"FROM hourly_rollups WHERE farm_id = ? AND day BETWEEN ? AND ? GROUP BY day",
+            (
+                farm_id,
+                from_epoch(hour_start).strftime("%Y-%m-%d"),
+                from_epoch(hour_end - 1).strftime("%Y-%m-%d"),
+            )
+        )
+
+    def _sync_state(self, farm_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT high_water, synced_at FROM sync_state WHERE farm_id = ?",
+                (farm_id,)
+            ).fetchone()
+        return row if row else (None, None)
+
+    def _mark_synced(self, farm_id: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (farm_id, high_water, synced_at) VALUES (?, NULL, ?) "
+                "ON CONFLICT(farm_id) DO UPDATE SET synced_at = excluded.synced_at",
+                (farm_id, time.time())
+            )
+
+    def _mark_backfilled(self, farm_id: str, end_epoch: float):
+        """
+        Record a finished backfill. A farm with no readings gets the backfill
+        end as its high-water mark, so later syncs only look for newer ones.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (farm_id, high_water, synced_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(farm_id) DO UPDATE SET "
+                "high_water = COALESCE(high_water, excluded.high_water), synced_at = excluded.synced_at",
+                (farm_id, end_epoch, time.time())
+            )
+
+    def version(self, farm_id: str) -> Optional[float]:
+        """The farm's high-water mark, which moves whenever stored readings (and rollups) grow."""
+        return self._sync_state(farm_id)[0]
+
+    def backfilling(self, farm_id: str) -> bool:
+        """True while the farm's first history backfill is still running."""
+        return farm_id in self._backfills
+
+    async def sync(self, farm_id: str, force: bool = False) -> int:
+        """
+        Pull readings newer than the local high-water mark from Firestore.
+        Calls within TS_SYNC_INTERVAL_SECONDS of the last sync cost no reads.
+        A farm's first sync starts the history backfill in the background
+        and returns at once; the store fills in as it runs, and callers
+        report backfilling() meanwhile.
+        """
+        if farm_id in self._backfills:
+            return 0
+
+        async with self._sync_locks[farm_id]:
+            high_water, synced_at = await run_in_threadpool(self._sync_state, farm_id)
+            if farm_id in self._backfills:
+                return 0
+            if not force and synced_at and time.time() - synced_at < TS_SYNC_INTERVAL_SECONDS:
+                return 0
+
+            if not high_water:
+                self._backfills[farm_id] = asyncio.create_task(self._backfill(farm_id))
+                return 0
+
+            readings = await repo.readings(farm_id, after=from_epoch(high_water))
+            written = await run_in_threadpool(self.insert_readings, farm_id, readings)
+            await run_in_threadpool(self._mark_synced, farm_id)
+
+            if written:
+                print(f"🗄️ Synced {written} readings for {farm_id} into local store")
+            return written
+
+    async def _backfill(self, farm_id: str):
+        """
+        First sync of a farm: pull TS_BACKFILL_DAYS of history one day at a
+        time, oldest first. Each insert holds the store lock only briefly,
+        and an interrupted backfill resumes from its high-water mark.
+        """
+        try:
+            now = datetime.utcnow()
+            day_start = now - timedelta(days=TS_BACKFILL_DAYS)
+            total = 0
+            while day_start < now:
+                day_end = min(day_start + timedelta(days=1), now)
+                readings = await repo.readings(farm_id, start=day_start, end=day_end)
+                total += await run_in_threadpool(self.insert_readings, farm_id, readings)
+                day_start = day_end
+            await run_in_threadpool(self._mark_backfilled, farm_id, to_epoch(now))
+            print(f"🗄️ Backfilled {total} readings for {farm_id} into local store")
+        except Exception as e:
+            print(f"❌ Backfill failed for {farm_id}: {type(e).__name__}: {e}")
+        finally:
+            self._backfills.pop(farm_id, None)
+
+    # -------- READ PATH --------
+
+    def range(self, farm_id: str, start: datetime, end: Optional[datetime] = None, fields=SENSOR_FIELDS) -> dict:
+        """
+        Columnar range scan: returns {"ts": ndarray, <field>: ndarray, ...}
+        ordered by timestamp ascending.
+        """
+        fields = [f for f in fields if f in SENSOR_FIELDS]
+        start_epoch = to_epoch(start)
+        end_epoch = to_epoch(end) if end else time.time() + 1
+
+        sql = (
+            f"SELECT ts{''.join(', ' + f for f in fields)} FROM readings "
+            "WHERE farm_id = ? AND day BETWEEN ? AND ? AND ts >= ? AND ts <= ? ORDER BY ts"
+        )
+        params = (
+            farm_id,
+            from_epoch(start_epoch).strftime("%Y-%m-%d"),
+            from_epoch(end_epoch).strftime("%Y-%m-%d"),
+            start_epoch,
+            end_epoch,
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        return self._to_columns(rows, fields)
+
+    def latest(self, farm_id: str, limit: int, fields=SENSOR_FIELDS) -> dict:
+        """Columnar view of the most recent `limit` readings, oldest first."""
+        fields = [f for f in fields if f in SENSOR_FIELDS]
+        sql = (
+            f"SELECT ts{''.join(', ' + f for f in fields)} FROM readings "
+            "WHERE farm_id = ? ORDER BY ts DESC LIMIT ?"
+        )
+        with self._lock:
+            rows = self._conn.execute(sql, (farm_id, limit)).fetchall()
+
+        rows.reverse()
+        return self._to_columns(rows, fields)
+
+    def rollups(self, farm_id: str, start: datetime, end: Optional[datetime] = None, resolution: str = "day") -> List[dict]:
+        """
+        Read materialised rollups between start and end (inclusive).
+        resolution is "day" (UTC calendar date) or "hour".
+        Each row carries count, rainfall and min/max/mean per sensor field.
+        """
+        start_epoch = to_epoch(start)
+        end_epoch = to_epoch(end) if end else time.time()
+
+        if resolution == "hour":
+            sql = (
+                f"SELECT hour, count, {', '.join(ROLLUP_COLUMNS)}, rainfall FROM hourly_rollups "
+                "WHERE farm_id = ? AND hour >= ? AND hour <= ? ORDER BY hour"
+            )
+            params = (farm_id, int(start_epoch // 3600) * 3600, end_epoch)
+        else:
+            sql = (
+                f"SELECT day, count, {', '.join(ROLLUP_COLUMNS)}, rainfall FROM daily_rollups "
+                "WHERE farm_id = ? AND day BETWEEN ? AND ? ORDER BY day"
+            )
+            params = (
+                farm_id,
+                from_epoch(start_epoch).strftime("%Y-%m-%d"),
+                from_epoch(end_epoch).strftime("%Y-%m-%d"),
+            )
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+
+        result = []
+        for row in rows:
+            bucket, count, *aggregates, rainfall = row
+            entry = {"bucket": bucket, "count": count, "rainfall": rainfall or 0.0}
+            for i, field in enumerate(SENSOR_FIELDS):
+                f_min, f_max, f_sum, f_n = aggregates[i * 4:(i + 1) * 4]
+                entry[field] = {
+                    "min": f_min,
+                    "max": f_max,
+                    "mean": (f_sum / f_n) if f_n else None,
+                    "count": int(f_n or 0),
+                }
+            result.append(entry)
+
+        return result
+
+    def reading_count(self, farm_id: str, start: datetime, end: datetime) -> int:
+        """Raw readings stored between start and end, from the hourly rollup counts."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COALESCE(SUM(count), 0) FROM hourly_rollups "
+                "WHERE farm_id = ? AND hour >= ? AND hour <= ?",
+                (farm_id, int(to_epoch(start) // 3600) * 3600, to_epoch(end))
+            ).fetchone()
+        return int(row[0])
+
+    @staticmethod
+    def _to_columns(rows, fields) -> dict:
+        if not rows:
+            return {"ts": np.empty(0), **{f: np.empty(0) for f in fields}}
+
+        matrix = np.array(rows, dtype=float)  # NULL -> nan
+        columns = {"ts": matrix[:, 0]}
+        for i, field in enumerate(fields, start=1):
+            columns[field] = matrix[:, i]
+        return columns
+
+
+sensor_store = SensorTimeSeriesStore(TS_STORE_PATH)
+
+
+# Start history backfills for known farms before the first request needs them
+@app.on_event("startup")
+async def start_sensor_store_backfill():
+    try:
+        farm_ids = await repo.list_farms()
+    except Exception as e:
+        print(f"⚠️ Could not list farms for backfill: {e}")
+        return
+    for farm_id in farm_ids:
+        await sensor_store.sync(farm_id)
+
+
+# -----------------------------
+# RECENT READINGS CACHE
+# -----------------------------
+
+RECENT_READINGS_LIMIT = int(os.getenv("RECENT_READINGS_LIMIT", "50"))
+RECENT_READINGS_TTL_SECONDS = float(os.getenv("RECENT_READINGS_TTL_SECONDS", "10"))
+RECENT_READINGS_LISTEN = os.getenv("RECENT_READINGS_LISTEN", "false").lower() == "true"
+
+
+class RecentReadingsCache:
+    """
+    Short-TTL, per-farm snapshot of the newest readings (newest first).
+    All dashboard endpoints share it, so a page load costs one Firestore
+    query per farm instead of one per panel. Concurrent misses for the same
+    farm are collapsed into a single query (single-flight).
+    """
+
+    def __init__(self, limit: int, ttl_seconds: float, listen: bool = False):
+        self.limit = limit
+        self.ttl_seconds = ttl_seconds
+        self.listen = listen
+        self._entries: Dict[str, tuple] = {}
+        self._locks = defaultdict(asyncio.Lock)
+        self._watches = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, farm_id: str) -> List[SensorReading]:
+        entry = self._entries.get(farm_id)
+        if entry and time.time() - entry[0] < self.ttl_seconds:
+            self.hits += 1
+            return entry[1]
+
+        async with self._locks[farm_id]:
+            # Another request may have refreshed the entry while we waited
+            entry = self._entries.get(farm_id)
+            if entry and time.time() - entry[0] < self.ttl_seconds:
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+            readings = await repo.readings(farm_id, descending=True, limit=self.limit)
+            self._entries[farm_id] = (time.time(), readings)
+
+            if self.listen and farm_id not in self._watches:
+                self._watch(farm_id)
+
+            return readings
+
+    def invalidate(self, farm_id: str):
+        self._entries.pop(farm_id, None)
+
+    def _watch(self, farm_id: str):
+        """Drop the cached snapshot as soon as a new reading lands."""
+        try:
+            self._watches[farm_id] = repo.watch(farm_id, "readings", lambda: self.invalidate(farm_id))
+        except Exception as e:
+            print(f"⚠️ Snapshot listener failed for {farm_id}, relying on TTL: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "farms": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "listeners": len(self._watches),
+        }
+
+
+recent_readings = RecentReadingsCache(
+    RECENT_READINGS_LIMIT,
+    RECENT_READINGS_TTL_SECONDS,
+    listen=RECENT_READINGS_LISTEN
+)
+
+
+def build_farm_averages(readings: List[SensorReading]) -> dict:
     if not readings:
         return {"error": "No sensor data found"}
 
-    df = pd.DataFrame(readings)
+    df = pd.DataFrame(readings, columns=SensorReading._fields)
 
     averages = {
         "soil_moisture": round(df["soil_moisture"].mean(), 2),
@@ -1086,195 +2505,127 @@ def get_farm_averages(user: User = Depends(get_current_user)):
         "sample_count": len(df)
     }
 
-@app.get("/api/farm/soil-moisture-series")
-def soil_moisture_series(user: User = Depends(get_current_user)):
-    FARM_ID = resolve_farm_id(user)
-
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(24)
-        .stream()
-    )
 
+def build_recent_series(readings: List[SensorReading], field: str, limit: int = 24) -> List[dict]:
+    """Chart points for the newest `limit` readings of one field, oldest first."""
     series = []
 
-    for doc in docs:
-        d = doc.to_dict()
-        if not d.get("timestamp"):
+    for d in readings[:limit]:
+        value = getattr(d, field)
+        if not d.timestamp or value is None:
             continue
 
         series.append({
-            "time": d["timestamp"].strftime("%d %b %H:%M"),
-            "value": round(d["soil_moisture"], 1),
-            "ts": d["timestamp"]
+            "time": d.timestamp.strftime("%d %b %H:%M"),
+            "value": round(value, 1),
+            "ts": d.timestamp
         })
 
-    # ✅ THIS IS THE IMPORTANT LINE
     series.sort(key=lambda x: x["ts"])
 
     return [
-        { "time": row["time"], "value": row["value"] }
+        {"time": row["time"], "value": row["value"]}
         for row in series
     ]
 
-@app.get("/api/farm/temperature-series")
-def temperature_series(user: User = Depends(get_current_user)):
-    FARM_ID = resolve_farm_id(user)
-
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(24)
-        .stream()
-    )
-
-    series = []
-
-    for doc in docs:
-        d = doc.to_dict()
-        if not d.get("timestamp"):
-            continue
-
-        series.append({
-            "time": d["timestamp"].strftime("%d %b %H:%M"),
-            "value": round(d["temperature"], 1),
-            "ts": d["timestamp"]
-        })
-
-    series.sort(key=lambda x: x["ts"])
-
-    return [
-        {"time": row["time"], "value": row["value"]}
-        for row in series
-    ]
 
-
-@app.get("/api/farm/daily-metrics")
-def daily_metrics(user: User = Depends(get_current_user)):
+@app.get("/api/farm/averages")
+async def get_farm_averages(user: User = Depends(get_current_user)):
     FARM_ID = resolve_farm_id(user)
+    return build_farm_averages(await recent_readings.get(FARM_ID))
 
-    now = datetime.utcnow()
-    start = now - timedelta(days=7)
-
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .where("timestamp", ">=", start)
-        .stream()
-    )
-
-    buckets = defaultdict(lambda: {
-        "soil_moisture": [],
-        "temperature": [],
-        "humidity": [],
-        "rainfall": 0.0,
-    })
+@app.get("/api/farm/soil-moisture-series")
+async def soil_moisture_series(user: User = Depends(get_current_user)):
+    FARM_ID = resolve_farm_id(user)
+    return build_recent_series(await recent_readings.get(FARM_ID), "soil_moisture")
 
-    for doc in docs:
-        d = doc.to_dict()
-        ts = d.get("timestamp")
-        if not ts:
-            continue
+@app.get("/api/farm/temperature-series")
+async def temperature_series(user: User = Depends(get_current_user)):
+    FARM_ID = resolve_farm_id(user)
+    return build_recent_series(await recent_readings.get(FARM_ID), "temperature")
 
-        day = ts.strftime("%a")  # Mon, Tue, Wed
+async def build_daily_metrics(farm_id: str, days: int = 7, resolution: str = "day") -> List[dict]:
+    """
+    Dashboard metrics for the last `days` calendar days (UTC), read from the
+    materialised rollups. Buckets are keyed by date, so the same weekday in
+    different weeks never merges.
+    """
+    days = max(1, min(days, 366))
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    start = today - timedelta(days=days - 1)
 
-        buckets[day]["soil_moisture"].append(d["soil_moisture"])
-        buckets[day]["temperature"].append(d["temperature"])
-        buckets[day]["humidity"].append(d["humidity"])
-        buckets[day]["rainfall"] += d.get("rainfall_7d", 0) / 7
+    await sensor_store.sync(farm_id)
+    rollups = await run_in_threadpool(sensor_store.rollups, farm_id, start, resolution=resolution)
 
-    ordered_days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
     result = []
-
-    for day in ordered_days:
-        if day not in buckets:
-            continue
-
-        b = buckets[day]
-        result.append({
-            "day": day,
-            "soil_moisture": round(sum(b["soil_moisture"]) / len(b["soil_moisture"]), 1),
-            "temperature": round(sum(b["temperature"]) / len(b["temperature"]), 1),
-            "humidity": round(sum(b["humidity"]) / len(b["humidity"]), 1),
-            "rainfall": round(b["rainfall"], 1),
-        })
+    for r in rollups:
+        if resolution == "hour":
+            bucket_time = from_epoch(r["bucket"])
+            label = {"date": bucket_time.isoformat(), "time": bucket_time.strftime("%d %b %H:%M")}
+        else:
+            bucket_time = datetime.strptime(r["bucket"], "%Y-%m-%d")
+            label = {"date": r["bucket"], "day": bucket_time.strftime("%a")}
+
+        entry = {**label, "count": r["count"]}
+        for field in ("soil_moisture", "temperature", "humidity"):
+            stats = r[field]
+            entry[field] = round(stats["mean"], 1) if stats["mean"] is not None else None
+            entry[f"{field}_min"] = round(stats["min"], 1) if stats["min"] is not None else None
+            entry[f"{field}_max"] = round(stats["max"], 1) if stats["max"] is not None else None
+        entry["rainfall"] = round(r["rainfall"], 1)
+        result.append(entry)
 
     return result
 
-@app.get("/api/cultivation/latest")
-def latest_cultivation_from_iot(user: User = Depends(get_current_user)):
+
+@app.get("/api/farm/daily-metrics")
+async def daily_metrics(days: int = 7, resolution: str = "day", user: User = Depends(get_current_user)):
+    """
+    Per-day (or per-hour) sensor aggregates over a 7/30/90-day window.
+    """
     FARM_ID = resolve_farm_id(user)
 
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(1)
-        .stream()
-    )
+    if resolution not in ("day", "hour"):
+        raise HTTPException(status_code=400, detail="resolution must be 'day' or 'hour'")
+
+    metrics = await build_daily_metrics(FARM_ID, days=days, resolution=resolution)
+    # The body stays a list; an incomplete history is flagged in a header
+    headers = {"X-Backfilling": "true"} if sensor_store.backfilling(FARM_ID) else None
+    return JSONResponse(content=jsonable_encoder(metrics), headers=headers)
 
-    latest = next(docs, None)
-    if not latest:
+def build_latest_cultivation(readings: List[SensorReading]) -> dict:
+    if not readings:
         return {"error": "No IoT data available"}
 
-    d = latest.to_dict()
+    d = readings[0]
 
     data = {
-        "soil_moisture": d["soil_moisture"],
-        "temperature": d["temperature"],
-        "humidity": d["humidity"],
-        "rainfall_7d": d["rainfall_7d"],
-        "soil_ph": d.get("soil_ph", 5.2),
+        "soil_moisture": d.soil_moisture,
+        "temperature": d.temperature,
+        "humidity": d.humidity,
+        "rainfall_7d": d.rainfall_7d,
+        "soil_ph": d.soil_ph if d.soil_ph is not None else 5.2,
     }
 
     return run_cultivation_engine(data)
 
 
-@app.get("/api/cultivation/smart-alert")
-def smart_alert(user: User = Depends(get_current_user)):
-    FARM_ID = resolve_farm_id(user)
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(1)
-        .stream()
-    )
-
-    latest = next(docs, None)
-    if not latest:
+def build_smart_alert(readings: List[SensorReading]) -> dict:
+    if not readings:
         return {"alert": False, "mode": "AI", "risk_score": 0}
 
-    d = latest.to_dict()
+    d = readings[0]
 
     # Ensure required fields exist
     for key in IDEAL.keys():
-        if key not in d or d[key] is None:
+        if getattr(d, key, None) is None:
             return {"alert": False, "mode": "AI", "risk_score": 0}
 
     data = {
-        "soil_moisture": d["soil_moisture"],
-        "temperature": d["temperature"],
-        "humidity": d["humidity"],
-        "rainfall_7d": d["rainfall_7d"],
+        "soil_moisture": d.soil_moisture,
+        "temperature": d.temperature,
+        "humidity": d.humidity,
+        "rainfall_7d": d.rainfall_7d,
     }
 
     # 🔑 SAME ENGINE AS MANUAL & IOT
@@ -1306,213 +2657,792 @@ def smart_alert(user: User = Depends(get_current_user)):
     }
 
 
+@app.get("/api/cultivation/latest")
+async def latest_cultivation_from_iot(user: User = Depends(get_current_user)):
+    FARM_ID = resolve_farm_id(user)
+    readings = await recent_readings.get(FARM_ID)
+    return await run_in_threadpool(build_latest_cultivation, readings)
+
+
+@app.get("/api/cultivation/smart-alert")
+async def smart_alert(refresh: bool = False, user: User = Depends(get_current_user)):
+    """
+    Alert state for the latest reading. The scheduler's precomputed state
+    is served only when it was evaluated on that same reading; otherwise
+    (or with refresh=true) the alert is re-evaluated, which is cheap.
+    """
+    FARM_ID = resolve_farm_id(user)
+    readings = await recent_readings.get(FARM_ID)
+
+    if not refresh:
+        entry = precomputed.get("smart_alert", FARM_ID)
+        if entry and entry["fingerprint"] == smart_alert_fingerprint(readings):
+            return entry["value"]
+
+    return build_smart_alert(readings)
+
+
+def smart_alert_fingerprint(readings: List[SensorReading]) -> Optional[str]:
+    """The newest reading an alert was evaluated on."""
+    return str(to_epoch(readings[0].timestamp)) if readings else None
+
+
 # -----------------------------
-# MARKET INTELLIGENCE
+# FARM DASHBOARD
 # -----------------------------
 
-PRIMARY_MARKET = "guwahati"
+DASHBOARD_PANELS = (
+    "averages",
+    "soil_moisture_series",
+    "temperature_series",
+    "daily_metrics",
+    "cultivation",
+    "smart_alert",
+)
 
-@app.post("/api/price-forecast")
-def price_forecast(data: dict):
-    history = np.array(data["price_history"]).reshape(-1, 1)
-    prediction = forecast_price_from_dict(price_model, steps=len(history))
 
-    return {
-        "forecast_price": round(float(prediction), 2),
-        "recommendation": "SELL" if prediction > history.mean() else "HOLD"
+def dashboard_etag(
+    farm_id: str,
+    readings: List[SensorReading],
+    panels: List[str],
+    days: int,
+    store_version: Optional[float],
+    backfilling: bool
+) -> str:
+    """
+    Version tag for a dashboard response. Derived from the newest reading
+    and the local store's version (so daily_metrics changes as rollups and
+    backfills progress) rather than the rendered body, so a 304 can be
+    answered before any panel (including the AI recommendations) is computed.
+    """
+    newest = readings[0].timestamp if readings else None
+    version = json.dumps([
+        farm_id,
+        to_epoch(newest) if newest else None,
+        len(readings),
+        store_version,
+        backfilling,
+        sorted(panels),
+        days,
+        datetime.utcnow().strftime("%Y-%m-%d"),
+    ])
+    return '"' + hashlib.sha1(version.encode()).hexdigest() + '"'
+
+
+@app.get("/api/farm/dashboard")
+async def farm_dashboard(
+    request: Request,
+    fields: Optional[str] = None,
+    days: int = 7,
+    user: User = Depends(get_current_user)
+):
+    """
+    All cultivation dashboard panels in one response.
+    Readings are fetched once and every panel is computed concurrently.
+
+    Query params:
+    - fields: comma-separated subset of panels (default: all)
+    - days: window for daily_metrics (default 7)
+
+    Supports If-None-Match / ETag revalidation.
+    """
+    FARM_ID = resolve_farm_id(user)
+
+    panels = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(DASHBOARD_PANELS)
+    unknown = [p for p in panels if p not in DASHBOARD_PANELS]
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown dashboard fields: {', '.join(unknown)}"
+        )
+
+    readings, store_version = await asyncio.gather(
+        recent_readings.get(FARM_ID),
+        run_in_threadpool(sensor_store.version, FARM_ID)
+    )
+
+    etag = dashboard_etag(
+        FARM_ID, readings, panels, days, store_version, sensor_store.backfilling(FARM_ID)
+    )
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    builders = {
+        "averages": lambda: run_in_threadpool(build_farm_averages, readings),
+        "soil_moisture_series": lambda: run_in_threadpool(build_recent_series, readings, "soil_moisture"),
+        "temperature_series": lambda: run_in_threadpool(build_recent_series, readings, "temperature"),
+        "daily_metrics": lambda: build_daily_metrics(FARM_ID, days=days),
+        "cultivation": lambda: run_in_threadpool(build_latest_cultivation, readings),
+        "smart_alert": lambda: run_in_threadpool(build_smart_alert, readings),
     }
 
-@app.get("/api/market/kpis")
-def market_kpis():
-    if df is None or df.empty or len(df) < 3:
-        return {"error": "Insufficient market data"}
+    results = await asyncio.gather(
+        *(builders[p]() for p in panels),
+        return_exceptions=True
+    )
 
-    prices = df[PRIMARY_MARKET].dropna()
-    dates = df["week_ending_date"]
+    payload = {
+        "farm_id": FARM_ID,
+        "generated_at": datetime.utcnow().isoformat(),
+        "backfilling": sensor_store.backfilling(FARM_ID),
+    }
+    for panel, result in zip(panels, results):
+        if isinstance(result, Exception):
+            print(f"❌ DASHBOARD PANEL ERROR ({panel}): {result}")
+            payload[panel] = {"error": f"{panel} unavailable"}
+        else:
+            payload[panel] = result
 
-    # -------------------
-    # CURRENT PRICE
-    # -------------------
-    current_price = float(prices.iloc[-1])
-    prev_price = float(prices.iloc[-2])
-    price_change_pct = ((current_price - prev_price) / prev_price) * 100
+    return JSONResponse(content=jsonable_encoder(payload), headers=headers)
 
-    # -------------------
-    # DEMAND (TRUE WEEKLY)
-    # -------------------
-    latest_price = prices.iloc[-1]
-    prev_price = prices.iloc[-2]
-    
-    price_change_pct_abs = abs((latest_price - prev_price) / prev_price) * 100
 
-    # cap extreme values to avoid spikes
-    demand_index = min(price_change_pct_abs * 5, 100)
-    
-    prev_price_change_abs = abs(
-        (prices.iloc[-2] - prices.iloc[-3]) / prices.iloc[-3]
-    ) * 100
+# -----------------------------
+# TIME-SERIES QUERY API
+# -----------------------------
 
-    prev_demand_index = min(prev_price_change_abs * 5, 100)
-    
-    demand_change_abs = demand_index - prev_demand_index
+SERIES_MAX_POINTS = 2000
+# Most raw readings a series request may load; larger ranges use rollups
+SERIES_MAX_RAW_ROWS = int(os.getenv("SERIES_MAX_RAW_ROWS", "20000"))
 
-    # -------------------
-    # VOLATILITY (ROLLING, BUT SHOWN SAFELY)
-    # -------------------
-    recent_7 = prices.tail(7)
-    prev_7 = prices.iloc[-14:-7]
 
-    volatility = (recent_7.std() / recent_7.mean()) * 100
+def lttb_downsample(x: np.ndarray, y: np.ndarray, threshold: int):
+    """
+    Largest-Triangle-Three-Buckets downsampling. Keeps the first and last
+    point and, per bucket, the point forming the largest triangle with the
+    previously kept point and the average of the next bucket.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return x, y
 
-    prev_volatility = (
-        (prev_7.std() / prev_7.mean()) * 100
-        if len(prev_7) == 7 else volatility
-    )
+    every = (n - 2) / (threshold - 2)
+    sampled = [0]
+    a = 0
 
-    # 🔑 USE ABSOLUTE CHANGE, NOT %
-    volatility_change_abs = volatility - prev_volatility
+    for i in range(threshold - 2):
+        avg_start = int(np.floor((i + 1) * every)) + 1
+        avg_end = min(int(np.floor((i + 2) * every)) + 1, n)
+        avg_x = x[avg_start:avg_end].mean()
+        avg_y = y[avg_start:avg_end].mean()
 
-    # -------------------
-    # FORECAST
-    # -------------------
-    forecast_price = forecast_price_from_dict(price_model)
+        range_start = int(np.floor(i * every)) + 1
+        range_end = int(np.floor((i + 1) * every)) + 1
+        xs = x[range_start:range_end]
+        ys = y[range_start:range_end]
 
-    return {
-        "current_price": round(current_price, 2),
-        "forecast_price": round(forecast_price, 2),
-        "price_change_pct": round(price_change_pct, 1),
+        area = np.abs((x[a] - avg_x) * (ys - y[a]) - (x[a] - xs) * (avg_y - y[a]))
+        a = range_start + int(np.argmax(area))
+        sampled.append(a)
+
+    sampled.append(n - 1)
+    idx = np.array(sampled)
+    return x[idx], y[idx]
+
+
+def minmax_downsample(x: np.ndarray, y: np.ndarray, threshold: int):
+    """
+    Min/max bucketing: split into threshold/2 buckets and keep each
+    bucket's extremes in time order, so spikes survive downsampling.
+    """
+    n = len(x)
+    if threshold >= n or threshold < 2:
+        return x, y
+
+    idx = []
+    for bucket in np.array_split(np.arange(n), threshold // 2):
+        if len(bucket) == 0:
+            continue
+        lo = bucket[int(np.argmin(y[bucket]))]
+        hi = bucket[int(np.argmax(y[bucket]))]
+        idx.extend(sorted({lo, hi}))
+
+    idx = np.array(idx)
+    return x[idx], y[idx]
+
+
+def parse_series_time(value: Optional[str], default: datetime) -> datetime:
+    if not value:
+        return default
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid timestamp: {value}")
+    return parsed.astimezone(timezone.utc).replace(tzinfo=None) if parsed.tzinfo else parsed
+
+
+@app.get("/api/farm/series")
+async def farm_series(
+    metrics: str = "soil_moisture,temperature",
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    points: int = 300,
+    method: str = "lttb",
+    user: User = Depends(get_current_user)
+):
+    """
+    Columnar sensor series for any time range, downsampled server-side.
+
+    Query params:
+    - metrics: comma-separated sensor fields
+    - start / end: ISO-8601 timestamps (default: last 7 days)
+    - points: target points per metric (max 2000)
+    - method: "lttb" (shape-preserving) or "minmax" (keeps extremes)
+
+    Ranges holding more than SERIES_MAX_RAW_ROWS readings are served from
+    the hourly rollups (or daily ones, beyond SERIES_MAX_RAW_ROWS hours)
+    instead of raw readings, whatever `points` is.
 
-        "market_demand": round(demand_index, 0),
-        "market_demand_change_abs": round(demand_change_abs, 1),
+    Returns {"series": {metric: {"ts": [epoch_ms...], "values": [...]}}};
+    "backfilling" is true while the farm's history is still being loaded.
+    """
+    FARM_ID = resolve_farm_id(user)
+
+    fields = [m.strip() for m in metrics.split(",") if m.strip()]
+    unknown = [m for m in fields if m not in SENSOR_FIELDS]
+    if not fields or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"metrics must be a subset of: {', '.join(SENSOR_FIELDS)}"
+        )
+    if method not in ("lttb", "minmax"):
+        raise HTTPException(status_code=400, detail="method must be 'lttb' or 'minmax'")
+
+    points = max(3, min(points, SERIES_MAX_POINTS))
+    end_dt = parse_series_time(end, datetime.utcnow())
+    start_dt = parse_series_time(start, end_dt - timedelta(days=7))
+    if start_dt >= end_dt:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    await sensor_store.sync(FARM_ID)
+
+    span_hours = (end_dt - start_dt).total_seconds() / 3600
+    raw_rows = await run_in_threadpool(sensor_store.reading_count, FARM_ID, start_dt, end_dt)
+    if raw_rows > SERIES_MAX_RAW_ROWS:
+        if span_hours <= SERIES_MAX_RAW_ROWS:
+            source = "hourly"
+            rollups = await run_in_threadpool(sensor_store.rollups, FARM_ID, start_dt, end_dt, resolution="hour")
+            bucket_ts = [r["bucket"] + 1800 for r in rollups]
+        else:
+            source = "daily"
+            rollups = await run_in_threadpool(sensor_store.rollups, FARM_ID, start_dt, end_dt, resolution="day")
+            bucket_ts = [
+                to_epoch(datetime.strptime(r["bucket"], "%Y-%m-%d")) + 43200 for r in rollups
+            ]
+        cols = {"ts": np.array(bucket_ts, dtype=float)}
+        for field in fields:
+            cols[field] = np.array(
+                [r[field]["mean"] if r[field]["mean"] is not None else np.nan for r in rollups],
+                dtype=float
+            )
+    else:
+        source = "raw"
+        cols = await run_in_threadpool(sensor_store.range, FARM_ID, start_dt, end_dt, fields=fields)
+
+    downsample = lttb_downsample if method == "lttb" else minmax_downsample
+
+    series = {}
+    for field in fields:
+        mask = ~np.isnan(cols[field])
+        x, y = downsample(cols["ts"][mask], cols[field][mask], points)
+        series[field] = {
+            "ts": (x * 1000).astype(np.int64).tolist(),
+            "values": np.round(y, 2).tolist(),
+        }
 
-        "volatility": round(volatility, 2),
-        "volatility_change_abs": round(volatility_change_abs, 2),
+    return {
+        "farm_id": FARM_ID,
+        "start": start_dt.isoformat(),
+        "end": end_dt.isoformat(),
+        "source": source,
+        "method": method,
+        "raw_points": int(len(cols["ts"])),
+        "backfilling": sensor_store.backfilling(FARM_ID),
+        "series": series,
     }
 
-@app.get("/api/market/price-series")
-def price_series():
-    data = df[["week_ending_date", PRIMARY_MARKET]].dropna()
-    data = data.rename(columns={PRIMARY_MARKET: "price"})
 
-    # last 10 months only
-    data = data.tail(10)
+# -----------------------------
+# FLEET ANALYTICS
+# -----------------------------
 
-    series = []
+# Comma-separated verified emails allowed to query farms other than their own
+# (tokens with the "fleet_manager" role claim are always allowed)
+FLEET_MANAGER_EMAILS = {
+    e.strip().lower() for e in os.getenv("FLEET_MANAGER_EMAILS", "").split(",") if e.strip()
+}
+FLEET_MAX_FARMS = int(os.getenv("FLEET_MAX_FARMS", "500"))
+FLEET_MAX_CONCURRENCY = int(os.getenv("FLEET_MAX_CONCURRENCY", "16"))
+FLEET_CACHE_TTL_SECONDS = float(os.getenv("FLEET_CACHE_TTL_SECONDS", "60"))
+FLEET_CACHE_MAX_ENTRIES = int(os.getenv("FLEET_CACHE_MAX_ENTRIES", "5000"))
+
+FLEET_SORT_KEYS = {
+    # key -> (field, worst first?)
+    "health_score": ("health_score", False),
+    "risk_score": ("risk_score", True),
+    "disease_rate": ("disease_rate", True),
+}
 
-    # ACTUAL DATA
-    for _, row in data.iterrows():
-        series.append({
-            "date": row["week_ending_date"].strftime("%Y-%m-%d"),
-            "price": round(row["price"], 2),
-            "type": "actual"
-        })
+fleet_semaphore = asyncio.Semaphore(FLEET_MAX_CONCURRENCY)
+fleet_cache: "OrderedDict[tuple, tuple]" = OrderedDict()  # (farm_id, scan_days) -> (computed_at, summary), LRU
 
-    # -------- FORECAST NEXT 3 MONTHS --------
-    last_price = data["price"].iloc[-1]
-    recent_prices = data["price"].values
-    slope = np.polyfit(range(len(recent_prices)), recent_prices, 1)[0]
 
-    last_date = data["week_ending_date"].iloc[-1]
+def overall_risk_level(*levels) -> Optional[str]:
+    for level in ("High", "Medium", "Low"):
+        if level in levels:
+            return level
+    return None
 
-    for i in range(1, 6):  # next 5 weeks
-        future_date = (last_date + pd.DateOffset(weeks=i))
-        forecast_price = last_price + slope * i
 
-        series.append({
-            "date": future_date.strftime("%Y-%m-%d"),
-            "price": round(forecast_price, 2),
-            "type": "forecast"
+async def build_fleet_farm_summary(farm_id: str, scan_days: int) -> dict:
+    """Health, risk, alert and scan disease rate for one farm."""
+    readings, scans = await asyncio.gather(
+        recent_readings.get(farm_id),
+        repo.query(
+            farm_id, "leaf_scans",
+            start=datetime.utcnow() - timedelta(days=scan_days),
+            fields=("grade",)
+        )
+    )
+
+    summary = {
+        "farm_id": farm_id,
+        "last_reading": readings[0].timestamp if readings else None,
+        "health_score": None,
+        "risk_score": None,
+        "risk_level": None,
+        "pest_risk": None,
+        "drought_risk": None,
+        "alert": False,
+        "alert_reason": None,
+        "scans": len(scans),
+        "disease_rate": (
+            round(sum(1 for s in scans if s.get("grade") == "Diseased") / len(scans), 3)
+            if scans else None
+        ),
+    }
+
+    alert = build_smart_alert(readings)
+    if "health_score" not in alert:
+        return summary
+
+    summary.update(
+        health_score=alert["health_score"],
+        risk_score=alert["risk_score"],
+        alert=alert["alert"],
+        alert_reason=alert.get("reason"),
+    )
+
+    if pest_model is not None and drought_model is not None:
+        latest = readings[0]
+        pest_risk, drought_risk = await run_in_threadpool(predict_field_risks, {
+            "soil_moisture": latest.soil_moisture,
+            "temperature": latest.temperature,
+            "humidity": latest.humidity,
+            "rainfall_7d": latest.rainfall_7d,
+            "soil_ph": latest.soil_ph if latest.soil_ph is not None else 5.2,
         })
+        summary.update(
+            pest_risk=pest_risk,
+            drought_risk=drought_risk,
+            risk_level=overall_risk_level(pest_risk, drought_risk),
+        )
 
-    return series
+    return summary
 
-@app.get("/api/market/demand-volatility")
-def demand_volatility():
-    if df is None or df.empty:
-        return []
 
-    data = df.copy()
+async def fleet_farm_summary(farm_id: str, scan_days: int) -> dict:
+    key = (farm_id, scan_days)
+    entry = fleet_cache.get(key)
+    if entry and time.time() - entry[0] < FLEET_CACHE_TTL_SECONDS:
+        fleet_cache.move_to_end(key)
+        return entry[1]
 
-    # Ensure datetime
-    data["week_ending_date"] = pd.to_datetime(data["week_ending_date"])
+    async with fleet_semaphore:
+        summary = await build_fleet_farm_summary(farm_id, scan_days)
 
-    # Create month key
-    data["month_key"] = data["week_ending_date"].dt.to_period("M")
+    fleet_cache[key] = (time.time(), summary)
+    fleet_cache.move_to_end(key)
+    while len(fleet_cache) > FLEET_CACHE_MAX_ENTRIES:
+        fleet_cache.popitem(last=False)
+    return summary
 
-    # ✅ KEEP ONLY LAST 12 MONTHS
-    last_12_months = (
-        data["month_key"]
-        .sort_values()
-        .unique()[-12:]
-    )
 
-    data = data[data["month_key"].isin(last_12_months)]
+@app.get("/api/fleet/overview")
+async def fleet_overview(
+    farms: Optional[str] = None,
+    sort: str = "health_score",
+    scan_days: int = 30,
+    user: User = Depends(get_current_user)
+):
+    """
+    Ranked health / risk table across many farms, worst first.
+
+    Query params:
+    - farms: comma-separated farm ids (default: every farm, managers only)
+    - sort: health_score | risk_score | disease_rate
+    - scan_days: window for the leaf scan disease rate (default 30)
+
+    Farms are summarised concurrently (at most FLEET_MAX_CONCURRENCY at a
+    time) and each summary is cached for FLEET_CACHE_TTL_SECONDS.
+    """
+    if sort not in FLEET_SORT_KEYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"sort must be one of: {', '.join(FLEET_SORT_KEYS)}"
+        )
+    scan_days = max(1, min(scan_days, 365))
+
+    own_farm = resolve_farm_id(user)
+    is_manager = user_has_role(user, "fleet_manager", FLEET_MANAGER_EMAILS)
+
+    if farms:
+        farm_ids = list(dict.fromkeys(f.strip() for f in farms.split(",") if f.strip()))
+    elif is_manager:
+        farm_ids = await repo.list_farms()
+    else:
+        farm_ids = [own_farm]
 
-    grouped = (
-        data
-        .groupby("month_key")
-        .agg(
-            demand=(PRIMARY_MARKET, "count"),
-            volatility=(PRIMARY_MARKET, lambda x: (x.std() / x.mean()) * 100)
+    if not is_manager and any(f != own_farm for f in farm_ids):
+        raise HTTPException(status_code=403, detail="Fleet access requires a manager account")
+    if len(farm_ids) > FLEET_MAX_FARMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {FLEET_MAX_FARMS} farms per request"
         )
-        .reset_index()
-        .sort_values("month_key")
+
+    results = await asyncio.gather(
+        *(fleet_farm_summary(f, scan_days) for f in farm_ids),
+        return_exceptions=True
     )
 
-    return [
-        {
-            "month": row["month_key"].to_timestamp().strftime("%b %Y"),
-            "demand": int(row["demand"] * 100),
-            "volatility": round(row["volatility"], 2)
+    rows, errors = [], []
+    for farm_id, result in zip(farm_ids, results):
+        if isinstance(result, Exception):
+            print(f"⚠️ Fleet summary failed for {farm_id}: {result}")
+            errors.append({"farm_id": farm_id, "error": str(result)})
+        else:
+            rows.append(result)
+
+    field, worst_high = FLEET_SORT_KEYS[sort]
+    scored = [r for r in rows if r[field] is not None]
+    scored.sort(key=lambda r: r[field], reverse=worst_high)
+    ranked = scored + [r for r in rows if r[field] is None]
+
+    return {
+        "count": len(ranked),
+        "sort": sort,
+        "farms": [{"rank": i + 1, **row} for i, row in enumerate(ranked)],
+        "alerts": sum(1 for r in ranked if r["alert"]),
+        "errors": errors,
+    }
+
+
+# -----------------------------
+# MARKET INTELLIGENCE
+# -----------------------------
+
+PRIMARY_MARKET = "guwahati"
+
+# ===== MARKET DATA RELOAD =====
+# Seconds between checks of MARKET_DATA_PATH for a new workbook (0 = off)
+MARKET_DATA_POLL_SECONDS = float(os.getenv("MARKET_DATA_POLL_SECONDS", "60"))
+# Verified emails allowed to upload workbooks (or the "market_data_admin" role claim)
+MARKET_DATA_ADMIN_EMAILS = {
+    e.strip().lower() for e in os.getenv("MARKET_DATA_ADMIN_EMAILS", "").split(",") if e.strip()
+}
+MARKET_DATA_MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+
+
+class MarketDataReloader:
+    """
+    Swaps in new auction prices without a restart. The workbook is parsed
+    and its KPI snapshot built off the event loop; only then is
+    `market_snapshot` rebound, in one assignment, so a request sees either
+    the old snapshot or the new, never a mix of the two. Snapshots are
+    never modified in place.
+
+    Caches derived from market data are keyed on the snapshot version
+    (chat context and answers, action plan fingerprints), so they refresh
+    on their next use.
+    """
+
+    def __init__(self, path: str, poll_seconds: float):
+        self.path = path
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        self._mtime = self._file_mtime()
+        self._task = None
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_reload_at = None
+        self.last_reload_ms = None
+
+    def _file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def reload(self, raw: bytes = None) -> dict:
+        """
+        Load the workbook from `raw` bytes (an upload, which is also saved
+        to the market data path) or from the path. Raises if it cannot be
+        parsed; the current data stays in place.
+        """
+        global market_snapshot
+
+        with self._lock:
+            started = time.perf_counter()
+            try:
+                data, version = load_market_data(raw if raw is not None else self.path)
+                snapshot = build_market_snapshot(data, version)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                raise
+
+            if raw is not None:
+                # Write-then-rename so a restart (or a poll) never reads a partial file
+                tmp_path = f"{self.path}.upload"
+                with open(tmp_path, "wb") as f:
+                    f.write(raw)
+                os.replace(tmp_path, self.path)
+            self._mtime = self._file_mtime()
+
+            changed = version != market_snapshot["version"]
+            if changed:
+                market_snapshot = snapshot
+                self.reloads += 1
+                self.last_reload_at = datetime.utcnow().isoformat()
+                print(f"✅ Market data reloaded: {version} ({len(snapshot['markets'])} markets)")
+
+            self.last_error = None
+            self.last_reload_ms = round((time.perf_counter() - started) * 1000, 1)
+            return {
+                "changed": changed,
+                "version": version,
+                "week_ending": snapshot["week_ending"],
+                "markets": len(snapshot["markets"]),
+                "reload_ms": self.last_reload_ms,
+            }
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            mtime = self._file_mtime()
+            if mtime is None or mtime == self._mtime:
+                continue
+            try:
+                await run_in_threadpool(self.reload)
+            except Exception as e:
+                # Retried only when the file changes again
+                self._mtime = mtime
+                print(f"❌ Market data reload failed, keeping {market_snapshot['version']}: {e}")
+
+    def start(self):
+        if self.poll_seconds > 0 and self._task is None:
+            self._task = asyncio.create_task(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "version": market_snapshot["version"],
+            "markets": len(market_snapshot["markets"]),
+            "watching": self._task is not None,
+            "reloads": self.reloads,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_reload_at": self.last_reload_at,
+            "last_reload_ms": self.last_reload_ms,
         }
-        for _, row in grouped.iterrows()
-    ]
 
-@app.get("/api/market/location-price-summary")
-def location_price_summary():
-    if df is None or df.empty:
+
+market_reloader = MarketDataReloader(MARKET_DATA_PATH, MARKET_DATA_POLL_SECONDS)
+
+
+@app.on_event("startup")
+async def start_market_reloader():
+    market_reloader.start()
+
+@app.on_event("shutdown")
+def stop_market_reloader():
+    market_reloader.stop()
+
+
+@app.post("/api/market/data")
+async def upload_market_data(
+    request: Request,
+    file: UploadFile = File(...),
+    user: User = Depends(get_current_user)
+):
+    """
+    Publish a new weekly auction workbook (same layout as teadata.xlsx).
+    Takes effect immediately without a restart. Restricted to the
+    "market_data_admin" role claim and verified MARKET_DATA_ADMIN_EMAILS;
+    refused with the in-memory backend, whose tokens are unverified.
+    """
+    if DATA_BACKEND == "memory":
+        raise HTTPException(status_code=403, detail="Market data upload is disabled with the in-memory backend")
+    if not user_has_role(user, "market_data_admin", MARKET_DATA_ADMIN_EMAILS):
+        raise HTTPException(status_code=403, detail="Market data upload requires an admin account")
+
+    # Reject oversized uploads before reading the file into memory
+    content_length = request.headers.get("content-length", "")
+    declared = int(content_length) if content_length.isdigit() else 0
+    if declared > MARKET_DATA_MAX_UPLOAD_BYTES or (file.size or 0) > MARKET_DATA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    raw = await file.read(MARKET_DATA_MAX_UPLOAD_BYTES + 1)
+    if not raw:
+        raise HTTPException(status_code=400, detail="Empty file")
+    if len(raw) > MARKET_DATA_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large")
+
+    try:
+        result = await run_in_threadpool(market_reloader.reload, raw)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Invalid market data: {e}")
+
+    print(f"📈 Market data uploaded by {user.email}: {result['version']}")
+    return result
+
+def resolve_markets(market: str) -> tuple:
+    """
+    Market columns for a `market` query value: one market ("Kolkata",
+    "tea_serve"), a comma-separated list, or "all". Returns (columns,
+    multiple); a single market keeps the original response shape.
+    """
+    names = [m.strip().lower().replace(" ", "_") for m in market.split(",") if m.strip()]
+    if names == ["all"]:
+        return list(market_columns), True
+    unknown = [m for m in names if m not in market_columns]
+    if not names or unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"market must be 'all' or one or more of: {', '.join(market_columns)}"
+        )
+    return list(dict.fromkeys(names)), len(names) > 1
+
+
+def for_markets(market: str, build) -> Any:
+    """build(column) for one market, or {"markets": {column: ...}} for several."""
+    columns, multiple = resolve_markets(market)
+    if not multiple:
+        return build(columns[0])
+    return {"markets": {col: build(col) for col in columns}}
+
+
+def market_display_name(column: str) -> str:
+    return column.replace("_", " ").title()
+
+
+def market_forecast(column: str, kpis: dict) -> float:
+    """Next week's price: the trained model for the primary market, else the recent trend."""
+    if column == PRIMARY_MARKET and price_model:
+        return forecast_price_from_dict(price_model)
+    return kpis["trend_forecast"]
+
+
+@app.post("/api/price-forecast")
+def price_forecast(data: dict):
+    history = np.array(data["price_history"]).reshape(-1, 1)
+    prediction = forecast_price_from_dict(price_model, steps=len(history))
+
+    return {
+        "forecast_price": round(float(prediction), 2),
+        "recommendation": "SELL" if prediction > history.mean() else "HOLD"
+    }
+
+def market_kpi_summary(column: str) -> dict:
+    kpis = market_kpis_for(column)
+    if kpis is None:
+        return {"error": "Insufficient market data"}
+
+    # -------------------
+    # FORECAST
+    # -------------------
+    forecast_price = market_forecast(column, kpis)
+
+    return {
+        "current_price": round(kpis["current_price"], 2),
+        "forecast_price": round(forecast_price, 2),
+        "price_change_pct": round(kpis["price_change_pct"], 1),
+
+        "market_demand": round(kpis["demand_index"], 0),
+        "market_demand_change_abs": round(kpis["demand_change_abs"], 1),
+
+        "volatility": round(kpis["volatility"], 2),
+        "volatility_change_abs": round(kpis["volatility_change_abs"], 2),
+        "signal": kpis["signal"],
+    }
+
+@app.get("/api/market/kpis")
+def market_kpis(market: str = PRIMARY_MARKET):
+    """
+    Headline KPIs for `market` (default Guwahati). A comma-separated list
+    or "all" returns {"markets": {market: kpis}} for side-by-side views.
+    """
+    return for_markets(market, market_kpi_summary)
+
+def market_price_series(column: str) -> list:
+    kpis = market_snapshot["markets"].get(column)
+    if kpis is None:
         return []
 
-    result = []
+    # ACTUAL DATA (last 10 weeks)
+    series = [{**point, "type": "actual"} for point in kpis["recent_prices"]]
 
-    # ensure sorted
-    data = df.sort_values("week_ending_date")
+    # -------- FORECAST NEXT 5 WEEKS (recent linear trend) --------
+    last_date = pd.Timestamp(kpis["week_ending"])
+    for i in range(1, 6):
+        future_date = (last_date + pd.DateOffset(weeks=i))
+        forecast_price = kpis["current_price"] + kpis["trend_slope"] * i
 
-    for col in market_columns:
-        series = data[col].dropna()
+        series.append({
+            "date": future_date.strftime("%Y-%m-%d"),
+            "price": round(forecast_price, 2),
+            "type": "forecast"
+        })
 
-        if series.empty:
-            continue
+    return series
 
-        avg_price = series.mean()
-        min_price = series.min()
-        max_price = series.max()
+@app.get("/api/market/price-series")
+def price_series(market: str = PRIMARY_MARKET):
+    """Recent weekly prices plus a 5-week trend forecast; `market` as in /api/market/kpis."""
+    return for_markets(market, market_price_series)
 
-        current_price = series.iloc[-1]
-        prev_price = series.iloc[-2] if len(series) > 1 else current_price
+@app.get("/api/market/demand-volatility")
+def demand_volatility(market: str = PRIMARY_MARKET):
+    """Monthly demand and volatility over the last 12 months; `market` as in /api/market/kpis."""
+    return for_markets(market, lambda column: market_snapshot["monthly"].get(column, []))
 
-        # trend logic
-        if current_price > prev_price * 1.01:
-            trend = "up"
-        elif current_price < prev_price * 0.99:
-            trend = "down"
-        else:
-            trend = "stable"
+@app.get("/api/market/location-price-summary")
+def location_price_summary():
+    result = []
 
+    for col, kpis in market_snapshot["markets"].items():
         result.append({
             "location": col.replace("_", " ").title(),
-            "avgPrice": round(avg_price, 2),
-            "currentPrice": round(current_price, 2),
-            "minPrice": round(min_price, 2),
-            "maxPrice": round(max_price, 2),
-            "trend": trend,
+            "avgPrice": round(kpis["avg_price"], 2),
+            "currentPrice": round(kpis["current_price"], 2),
+            "minPrice": round(kpis["min_price"], 2),
+            "maxPrice": round(kpis["max_price"], 2),
+            "trend": kpis["trend"],
         })
 
     return result
 
-@app.get("/api/market/insight")
-def market_insight():
-    if df is None or df.empty or len(df) < 3:
+def build_market_insight(column: str, with_ai: bool = True) -> dict:
+    kpis = market_kpis_for(column)
+    name = market_display_name(column)
+    if kpis is None:
         return {
             "signal": "neutral",
             "title": "Market Insight",
@@ -1520,21 +3450,13 @@ def market_insight():
             "ai_message": None
         }
 
-    prices = df[PRIMARY_MARKET].dropna()
-
     # ---- CORE METRICS ----
-    latest_price = prices.iloc[-1]
-    prev_price = prices.iloc[-2]
-
-    price_change_pct_abs = abs((latest_price - prev_price) / prev_price) * 100
-    demand_index = min(price_change_pct_abs * 5, 100)
-
-    recent_7 = prices.tail(7)
-    volatility = (recent_7.std() / recent_7.mean()) * 100
+    demand_index = kpis["demand_index"]
+    volatility = kpis["volatility"]
+    signal = kpis["signal"]
 
     # ---- RULE ENGINE ----
-    if demand_index < 20 and volatility < 3:
-        signal = "watch"
+    if signal == "watch":
         message = (
             f"Demand pressure remains very low ({int(demand_index)}/100) "
             f"while price volatility is stable. "
@@ -1542,16 +3464,14 @@ def market_insight():
             f"Maintain current supply and monitor for early demand recovery."
         )
 
-    elif demand_index >= 20 and volatility < 3:
-        signal = "opportunity"
+    elif signal == "opportunity":
         message = (
             f"Demand is showing recovery signals ({int(demand_index)}/100) "
             f"with stable prices. "
             f"Gradual production scaling may help capture upside."
         )
 
-    elif volatility >= 3:
-        signal = "risk"
+    elif signal == "risk":
         message = (
             f"Market volatility is elevated ({volatility:.2f}%). "
             f"Price instability increases short-term risk. "
@@ -1559,39 +3479,57 @@ def market_insight():
         )
 
     else:
-        signal = "neutral"
         message = "Market conditions are mixed. Continue monitoring closely."
 
+    if not with_ai:
+        return {
+            "signal": signal,
+            "title": f"Actionable Market Insight – {name}",
+            "message": message,
+            "ai_message": None,
+            "ai_recommendations": []
+        }
+
     # ---- AI CONTEXT (SAFE, NON-HALLUCINATING) ----
     ai_context = {
-        "market": "Guwahati",
+        "market": name,
         "demand_index": int(demand_index),
         "volatility_pct": round(volatility, 2),
-        "price_direction": (
-            "downward" if latest_price < prev_price else "upward"
-        ),
+        "price_direction": kpis["price_direction"],
         "signal": signal
     }
 
     ai_message = generate_ai_market_insight(ai_context)
     strategy_context = {
-        "market": "Guwahati",
+        "market": name,
         "signal": signal,
         "demand_index": int(demand_index),
         "volatility_pct": round(volatility, 2),
-        "price_direction": "downward" if latest_price < prev_price else "upward"
+        "price_direction": kpis["price_direction"]
     }
 
     ai_recommendations = generate_ai_strategy_recommendations(strategy_context)
 
     return {
         "signal": signal,
-        "title": "Actionable Market Insight – Guwahati",
+        "title": f"Actionable Market Insight – {name}",
         "message": message,
         "ai_message": ai_message,
         "ai_recommendations": ai_recommendations
     }
 
+@app.get("/api/market/insight")
+def market_insight(market: str = PRIMARY_MARKET):
+    """
+    Rule-based signal and message for `market`, with AI commentary.
+    For several markets (comma-separated or "all") only the rule-based
+    insight is returned, to keep Gemini calls to two per request.
+    """
+    columns, multiple = resolve_markets(market)
+    if not multiple:
+        return build_market_insight(columns[0])
+    return {"markets": {col: build_market_insight(col, with_ai=False) for col in columns}}
+
 # -----------------------------
 # FARMER ACTION SIMULATOR
 # -----------------------------
@@ -1684,34 +3622,21 @@ def calculate_yield_strategy(data: YieldInput):
         return {"error": "Yield must be greater than 0"}
     
     # Get real Guwahati market data
-    if df is None or df.empty or len(df) < 3:
+    kpis = market_kpis_for(PRIMARY_MARKET)
+    if kpis is None:
         return {"error": "Insufficient market data"}
     
-    prices = df[PRIMARY_MARKET].dropna()
-    current_price = float(prices.iloc[-1])
-    prev_price = float(prices.iloc[-2])
-    price_change_pct = ((current_price - prev_price) / prev_price) * 100
+    current_price = kpis["current_price"]
+    price_change_pct = kpis["price_change_pct"]
     
     # Calculate forecast price
     forecast_price = forecast_price_from_dict(price_model)
     forecast_increase_pct = ((forecast_price - current_price) / current_price) * 100
     
-    # Calculate volatility for risk assessment
-    recent_7 = prices.tail(7)
-    volatility = (recent_7.std() / recent_7.mean()) * 100
-    
-    # Determine market signal
-    price_change_pct_abs = abs(price_change_pct)
-    demand_index = min(price_change_pct_abs * 5, 100)
-    
-    if demand_index < 20 and volatility < 3:
-        signal = "watch"
-    elif demand_index >= 20 and volatility < 3:
-        signal = "opportunity"
-    elif volatility >= 3:
-        signal = "risk"
-    else:
-        signal = "neutral"
+    # Volatility for risk assessment, and the market signal
+    volatility = kpis["volatility"]
+    demand_index = kpis["demand_index"]
+    signal = kpis["signal"]
     
     # Calculate selling window dates
     from datetime import datetime, timedelta
@@ -2152,70 +4077,113 @@ def generate_pdf_report(data: PDFReportData):
 # INTELLIGENT ACTION PLAN GENERATOR
 # -----------------------------
 
-def fetch_todays_comprehensive_data(farm_id: str):
+# Per-call budget for each AI stage of plan generation
+ACTION_PLAN_AI_TIMEOUT_SECONDS = float(os.getenv("ACTION_PLAN_AI_TIMEOUT_SECONDS", "20"))
+
+
+async def run_ai_stage(name: str, func, *args, default=None):
+    """
+    Run a blocking AI call in the threadpool with a timeout.
+    `func` gets the stage budget left when it starts as `timeout=`, so the
+    Gemini call gives up with the stage instead of holding a thread.
+    Returns (result, timed_out); on timeout, or when the LLM is
+    unavailable, the result is `default`.
+    """
+    deadline = time.monotonic() + ACTION_PLAN_AI_TIMEOUT_SECONDS
+
+    def call():
+        return func(*args, timeout=max(0.0, deadline - time.monotonic()))
+
+    try:
+        result = await asyncio.wait_for(
+            run_in_threadpool(call),
+            timeout=ACTION_PLAN_AI_TIMEOUT_SECONDS
+        )
+        return result, False
+    except asyncio.TimeoutError:
+        print(f"⏱️ {name} timed out after {ACTION_PLAN_AI_TIMEOUT_SECONDS}s")
+        return default, True
+    except LLMUnavailable as e:
+        print(f"⏱️ {name} skipped: {e}")
+        return default, True
+
+
+async def summarize_sensor_window(farm_id: str, start: datetime) -> Optional[dict]:
+    """
+    Average of each sensor field since `start`, read from the local store's
+    hourly rollups (the first bucket may begin up to an hour before
+    `start`). While the farm's history is still being backfilled the
+    readings come from Firestore instead.
+    """
+    await sensor_store.sync(farm_id)
+
+    if sensor_store.backfilling(farm_id):
+        readings = await repo.readings(farm_id, start=start, descending=True)
+        if not readings:
+            return None
+        count = len(readings)
+        return {
+            "soil_moisture": sum(r.soil_moisture for r in readings) / count,
+            "temperature": sum(r.temperature for r in readings) / count,
+            "humidity": sum(r.humidity for r in readings) / count,
+            "rainfall_7d": sum(r.rainfall_7d for r in readings) / count,
+            "soil_ph": sum(r.soil_ph if r.soil_ph is not None else 5.2 for r in readings) / count,
+            "timestamp": readings[0].timestamp,  # Most recent timestamp
+            "readings_count": count
+        }
+
+    rollups, latest = await asyncio.gather(
+        run_in_threadpool(sensor_store.rollups, farm_id, start, resolution="hour"),
+        run_in_threadpool(sensor_store.latest, farm_id, 1, fields=())
+    )
+    count = sum(r["count"] for r in rollups)
+    if not count or not len(latest["ts"]):
+        return None
+
+    def field_sum(field):
+        return sum(r[field]["mean"] * r[field]["count"] for r in rollups if r[field]["count"])
+
+    def field_mean(field):
+        n = sum(r[field]["count"] for r in rollups)
+        return field_sum(field) / n if n else None
+
+    ph_missing = count - sum(r["soil_ph"]["count"] for r in rollups)
+    return {
+        "soil_moisture": field_mean("soil_moisture"),
+        "temperature": field_mean("temperature"),
+        "humidity": field_mean("humidity"),
+        "rainfall_7d": field_mean("rainfall_7d"),
+        "soil_ph": (field_sum("soil_ph") + 5.2 * ph_missing) / count,
+        "timestamp": from_epoch(float(latest["ts"][-1])),  # Most recent timestamp
+        "readings_count": count
+    }
+
+
+async def fetch_todays_comprehensive_data(farm_id: str, start: Optional[datetime] = None):
     """
     Aggregates all data sources for comprehensive action plan generation:
-    - Last 7 days of sensor readings (soil moisture, temperature, humidity, rainfall)
+    - Last 7 days of sensor readings (soil moisture, temperature, humidity, rainfall),
+      averaged from the local time-series store
     - Last 7 days of leaf scans with quality metrics
     - Current market prices and trends
+
+    The sensor and leaf scan queries run concurrently.
     """
     FARM_ID = farm_id
-    
-    # -------- FETCH LAST 7 DAYS OF SENSOR DATA --------
-    seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    
-    sensor_docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("sensors")
-        .document("sensors_root")
-        .collection("readings")
-        .where("timestamp", ">=", seven_days_ago)
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .stream()
-    )
-    
-    sensor_readings = []
-    for doc in sensor_docs:
-        d = doc.to_dict()
-        sensor_readings.append({
-            "soil_moisture": d.get("soil_moisture"),
-            "temperature": d.get("temperature"),
-            "humidity": d.get("humidity"),
-            "rainfall_7d": d.get("rainfall_7d"),
-            "soil_ph": d.get("soil_ph", 5.2),
-            "timestamp": d.get("timestamp")
-        })
+    seven_days_ago = start or datetime.utcnow() - timedelta(days=7)
     
     # Calculate average sensor data from 7 days
-    sensor_data = None
-    if sensor_readings:
-        sensor_data = {
-            "soil_moisture": sum(r["soil_moisture"] for r in sensor_readings) / len(sensor_readings),
-            "temperature": sum(r["temperature"] for r in sensor_readings) / len(sensor_readings),
-            "humidity": sum(r["humidity"] for r in sensor_readings) / len(sensor_readings),
-            "rainfall_7d": sum(r["rainfall_7d"] for r in sensor_readings) / len(sensor_readings),
-            "soil_ph": sum(r["soil_ph"] for r in sensor_readings) / len(sensor_readings),
-            "timestamp": sensor_readings[0]["timestamp"],  # Most recent timestamp
-            "readings_count": len(sensor_readings)
-        }
-    
-    # -------- FETCH LAST 7 DAYS OF LEAF SCANS --------
-    seven_days_ago_start = datetime.utcnow() - timedelta(days=7)
-    
-    leaf_scan_docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("leaf_scans")
-        .where("timestamp", ">=", seven_days_ago_start)
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .stream()
+    sensor_data, leaf_scan_docs = await asyncio.gather(
+        summarize_sensor_window(FARM_ID, seven_days_ago),
+        repo.query(
+            FARM_ID, "leaf_scans",
+            start=seven_days_ago, descending=True, fields=LEAF_SCAN_SUMMARY_FIELDS
+        )
     )
-
     
+    # -------- LAST 7 DAYS OF LEAF SCANS --------
     leaf_scans = []
-    for doc in leaf_scan_docs:
-        scan = doc.to_dict()
+    for scan in leaf_scan_docs:
         leaf_scans.append({
             "grade": scan.get("grade"),
             "disease_type": scan.get("disease_type"),
@@ -2227,41 +4195,19 @@ def fetch_todays_comprehensive_data(farm_id: str):
     
     # -------- FETCH MARKET DATA --------
     market_data = None
-    if df is not None and not df.empty and len(df) >= 3:
-        prices = df[PRIMARY_MARKET].dropna()
-        
-        current_price = float(prices.iloc[-1])
-        prev_price = float(prices.iloc[-2])
-        price_change_pct = ((current_price - prev_price) / prev_price) * 100
-        
-        # Demand calculation
-        price_change_pct_abs = abs(price_change_pct)
-        demand_index = min(price_change_pct_abs * 5, 100)
-        
-        # Volatility
-        recent_7 = prices.tail(7)
-        volatility = (recent_7.std() / recent_7.mean()) * 100
-        
+    snapshot = market_snapshot
+    kpis = market_kpis_for(PRIMARY_MARKET, snapshot)
+    if kpis is not None:
         # Forecast
         forecast_price = forecast_price_from_dict(price_model)
         
-        # Market signal
-        if demand_index < 20 and volatility < 3:
-            signal = "watch"
-        elif demand_index >= 20 and volatility < 3:
-            signal = "opportunity"
-        elif volatility >= 3:
-            signal = "risk"
-        else:
-            signal = "neutral"
-        
         market_data = {
-            "current_price": round(current_price, 2),
+            "current_price": round(kpis["current_price"], 2),
             "forecast_price": round(forecast_price, 2),
-            "price_change_pct": round(price_change_pct, 1),
-            "demand_index": round(demand_index, 0),
-            "volatility": round(volatility, 2),
-            "signal": signal,
+            "price_change_pct": round(kpis["price_change_pct"], 1),
+            "demand_index": round(kpis["demand_index"], 0),
+            "volatility": round(kpis["volatility"], 2),
+            "signal": kpis["signal"],
             "market": PRIMARY_MARKET
         }
     
@@ -2476,7 +4422,7 @@ def calculate_market_opportunity_score(market_data):
 
 
 
-def generate_disease_prevention_approaches(leaf_scans, sensor_data):
+def generate_disease_prevention_approaches(leaf_scans, sensor_data, timeout: Optional[float] = None):
     """
     Generate 3 distinct approaches for disease prevention and treatment
     based on leaf scan data and environmental conditions
@@ -2528,8 +4474,7 @@ Generate 3 approaches now:
 """
     
     try:
-        model = genai.GenerativeModel("models/gemini-pro")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt, model="models/gemini-pro", timeout=timeout)
         
         if not response or not response.text:
             return []
@@ -2555,6 +4500,8 @@ Generate 3 approaches now:
         # Return exactly 3 approaches
         return approaches[:3] if len(approaches) >= 3 else approaches
         
+    except LLMUnavailable:
+        raise
     except Exception as e:
         print("❌ DISEASE PREVENTION APPROACHES ERROR:", e)
         return []
@@ -2698,7 +4645,7 @@ def generate_strategic_recommendations(env_score, crop_score, market_score, sens
     return recommendations
 
 
-def generate_ai_enriched_insights(comprehensive_data, env_score, crop_score, market_score):
+def generate_ai_enriched_insights(comprehensive_data, env_score, crop_score, market_score, timeout: Optional[float] = None):
     """
     Use Gemini AI to generate contextual, strategic insights
     """
@@ -2735,29 +4682,70 @@ Farm Analysis:
 """
     
     try:
-        model = genai.GenerativeModel("models/gemini-pro")
-        response = model.generate_content(prompt)
+        response = llm.generate_content(prompt, model="models/gemini-pro", timeout=timeout)
         return response.text.strip() if response and response.text else None
+    except LLMUnavailable:
+        raise
     except Exception as e:
         print("❌ AI INSIGHT ERROR:", e)
         return None
 
 
-@app.post("/api/action-plan/generate")
-def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
+def action_plan_window_start() -> datetime:
+    """Start of the 7-day input window, on the hour like the sensor rollups."""
+    return (datetime.utcnow() - timedelta(days=7)).replace(minute=0, second=0, microsecond=0)
+
+
+async def action_plan_fingerprint(farm_id: str, window_start: datetime) -> str:
+    """
+    Hash of the input window start, the newest reading, the count and newest
+    timestamp of the window's leaf scans, and the market data version.
+    Costs one single-document read and a timestamp-only scan query, so it
+    is checked before the week of plan inputs is fetched.
+    """
+    latest_readings, scans = await asyncio.gather(
+        repo.query(farm_id, "readings", descending=True, limit=1, fields=()),
+        repo.query(farm_id, "leaf_scans", start=window_start, descending=True, fields=()),
+    )
+    inputs = json.dumps([
+        to_epoch(window_start),
+        to_epoch(latest_readings[0]["timestamp"]) if latest_readings else None,
+        len(scans),
+        to_epoch(scans[0]["timestamp"]) if scans else None,
+        market_snapshot["version"],
+    ])
+    return hashlib.sha1(inputs.encode()).hexdigest()
+
+
+async def build_action_plan(farm_id: str, force: bool = False) -> dict:
     """
     Generate comprehensive action plan integrating all data sources:
     - Environmental sensors (soil, temperature, humidity, rainfall)
     - Leaf scan quality and disease data
     - Market prices and trends
     
-    Returns strategic recommendations across multiple time horizons
+    Stores the plan in the farm's history and returns strategic
+    recommendations across multiple time horizons.
+
+    If the inputs are unchanged since the last plan (same fingerprint),
+    that plan is returned as-is, with no AI calls and no new history
+    entry, unless `force` is set. The last plan is looked up in Firestore
+    when this process has none, so this survives restarts.
     """
     
-    FARM_ID = resolve_farm_id(user)
+    FARM_ID = farm_id
+
+    window_start = action_plan_window_start()
+    fingerprint, previous = await asyncio.gather(
+        action_plan_fingerprint(FARM_ID, window_start),
+        load_stored_action_plan(FARM_ID)
+    )
+    if not force and previous and previous["fingerprint"] == fingerprint:
+        print(f"♻️ Inputs unchanged for {FARM_ID}, reusing action plan from {previous['computed_at']}")
+        return {**previous["value"], "reused": True, "computed_at": previous["computed_at"]}
     
     # -------- AGGREGATE ALL DATA --------
-    comprehensive_data = fetch_todays_comprehensive_data(FARM_ID)
+    comprehensive_data = await fetch_todays_comprehensive_data(FARM_ID, start=window_start)
     
     sensor_data = comprehensive_data["sensor_data"]
     leaf_scans = comprehensive_data["leaf_scans"]
@@ -2782,16 +4770,25 @@ def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
         sensor_data, leaf_scans, market_data
     )
     
-    # -------- GENERATE DISEASE PREVENTION APPROACHES --------
-    disease_prevention_approaches = generate_disease_prevention_approaches(
-        leaf_scans, sensor_data
-    )
-    
-    # -------- AI ENRICHMENT --------
-
-    ai_insight = generate_ai_enriched_insights(
-        comprehensive_data, env_score, crop_score, market_score
+    # -------- DISEASE PREVENTION APPROACHES + AI ENRICHMENT --------
+    # Independent Gemini calls, run concurrently with a per-call timeout
+    (disease_prevention_approaches, approaches_timed_out), (ai_insight, insight_timed_out) = await asyncio.gather(
+        run_ai_stage(
+            "disease_prevention_approaches",
+            generate_disease_prevention_approaches, leaf_scans, sensor_data,
+            default=[]
+        ),
+        run_ai_stage(
+            "ai_insight",
+            generate_ai_enriched_insights, comprehensive_data, env_score, crop_score, market_score
+        )
     )
+    ai_timeouts = [
+        name for name, timed_out in (
+            ("disease_prevention_approaches", approaches_timed_out),
+            ("ai_insight", insight_timed_out),
+        ) if timed_out
+    ]
     
     # -------- PROJECTED OUTCOMES --------
     # Calculate expected yield and profit changes based on scores
@@ -2829,6 +4826,8 @@ def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
         "market_opportunity_score": market_score["score"],
         "recommendations": recommendations,
         "ai_insight": ai_insight,
+        # Partial plans are never reused, so the next request retries the AI stages
+        "input_fingerprint": None if ai_timeouts else fingerprint,
         "data_sources": {
             "sensor_readings": 1 if sensor_data else 0,
             "leaf_scans": len(leaf_scans),
@@ -2836,15 +4835,8 @@ def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
         }
     }
     
-    db.collection("farms") \
-      .document(FARM_ID) \
-      .collection("action_plans") \
-      .add(action_plan_doc)
-    
-    print("✅ Action plan stored in Firestore")
-    
     # -------- RETURN COMPREHENSIVE RESPONSE --------
-    return {
+    plan = {
         "timestamp": datetime.utcnow().isoformat(),
         "composite_score": round(composite_score, 1),
         
@@ -2892,6 +4884,9 @@ def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
         
         "ai_insight": ai_insight,
         
+        "ai_partial": bool(ai_timeouts),
+        "ai_timeouts": ai_timeouts,
+        
         "data_quality": {
             "sensor_data_available": sensor_data is not None,
             "leaf_scans_count": len(leaf_scans),
@@ -2900,28 +4895,108 @@ def generate_comprehensive_action_plan(user: User = Depends(get_current_user)):
         }
     }
 
+    # The full plan is stored with its summary so it can be served after a restart
+    action_plan_doc["plan"] = jsonable_encoder(plan)
+    await repo.add(FARM_ID, "action_plans", action_plan_doc)
+    
+    print("✅ Action plan stored in Firestore")
+
+    # A partial plan is kept for serving but not reused for identical inputs,
+    # so the next request retries the AI stages
+    entry = precomputed.put(
+        "action_plan", FARM_ID, plan,
+        fingerprint=None if ai_timeouts else fingerprint
+    )
+    return {**plan, "reused": False, "computed_at": entry["computed_at"]}
+
+
+async def load_stored_action_plan(farm_id: str) -> Optional[dict]:
+    """
+    The farm's precomputed plan entry. After a restart it is reloaded from
+    the newest stored action plan and cached again.
+    """
+    entry = precomputed.get("action_plan", farm_id)
+    if entry:
+        return entry
+
+    docs = await repo.query(farm_id, "action_plans", descending=True, limit=1)
+    if not docs or not docs[0].get("plan"):
+        return None
+    doc = docs[0]
+    return precomputed.put(
+        "action_plan", farm_id, doc["plan"],
+        fingerprint=doc.get("input_fingerprint"),
+        computed_epoch=to_epoch(doc["timestamp"])
+    )
+
+
+@app.post("/api/action-plan/generate")
+async def generate_comprehensive_action_plan(force: bool = False, user: User = Depends(get_current_user)):
+    """
+    Generate an action plan now. This is also the manual refresh for the
+    precomputed plan served by /api/action-plan/latest.
+    Returns the previous plan when its inputs have not changed; force=true
+    always regenerates.
+    """
+    FARM_ID = resolve_farm_id(user)
+    return await build_action_plan(FARM_ID, force=force)
+
+
+@app.get("/api/action-plan/latest")
+async def latest_action_plan(
+    refresh: bool = False,
+    force: bool = False,
+    user: User = Depends(get_current_user)
+):
+    """
+    The farm's precomputed daily action plan, generated off-peak by the
+    scheduler. Falls back to generating one when none is stored yet or the
+    stored one is older than ACTION_PLAN_MAX_AGE_SECONDS.
+    refresh=true rebuilds it if its inputs changed; force=true always does.
+    "age_seconds" tells the UI how old the plan is.
+    """
+    FARM_ID = resolve_farm_id(user)
+
+    if not refresh and not force:
+        entry = await load_stored_action_plan(FARM_ID)
+        if entry and time.time() - entry["computed_epoch"] <= ACTION_PLAN_MAX_AGE_SECONDS:
+            return {
+                **entry["value"],
+                "reused": True,
+                "computed_at": entry["computed_at"],
+                "age_seconds": round(time.time() - entry["computed_epoch"]),
+            }
+
+    plan = await build_action_plan(FARM_ID, force=force)
+    return {
+        **plan,
+        "age_seconds": round(time.time() - datetime.fromisoformat(plan["computed_at"]).timestamp()),
+    }
+
 
 @app.get("/api/action-plan/history")
-def get_action_plan_history(limit: int = 10, user: User = Depends(get_current_user)):
+async def get_action_plan_history(
+    limit: int = 10,
+    cursor: Optional[str] = None,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    user: User = Depends(get_current_user)
+):
     """
-    Retrieve historical action plans for comparison and tracking
+    Retrieve historical action plans for comparison and tracking.
+    Paginated newest first: pass the returned next_cursor to get the next
+    page; start / end optionally restrict the date range.
     """
     FARM_ID = resolve_farm_id(user)
     
-    docs = (
-        db.collection("farms")
-        .document(FARM_ID)
-        .collection("action_plans")
-        .order_by("timestamp", direction=Query.DESCENDING)
-        .limit(limit)
-        .stream()
+    plans, next_cursor = await fetch_history_page(
+        FARM_ID, "action_plans", ACTION_PLAN_SUMMARY_FIELDS, limit, cursor, start, end
     )
     
     history = []
-    for doc in docs:
-        plan = doc.to_dict()
+    for plan in plans:
         history.append({
-            "id": doc.id,
+            "id": plan["id"],
             "timestamp": plan.get("timestamp"),
             "composite_score": plan.get("composite_score"),
             "environmental_score": plan.get("environmental_score"),
@@ -2932,10 +5007,232 @@ def get_action_plan_history(limit: int = 10, user: User = Depends(get_current_us
     
     return {
         "count": len(history),
-        "plans": history
+        "plans": history,
+        "next_cursor": next_cursor
     }
 
 
+# -----------------------------
+# BACKGROUND JOBS
+# -----------------------------
+
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "false").lower() == "true"
+SCHEDULER_MAX_CONCURRENCY = int(os.getenv("SCHEDULER_MAX_CONCURRENCY", "4"))
+SCHEDULER_JITTER_SECONDS = float(os.getenv("SCHEDULER_JITTER_SECONDS", "300"))
+
+# Cron expressions (minute hour day-of-month month day-of-week), in UTC.
+# 20:30 UTC is 02:00 in Assam.
+ACTION_PLAN_CRON = os.getenv("ACTION_PLAN_CRON", "30 20 * * *")
+SMART_ALERT_CRON = os.getenv("SMART_ALERT_CRON", "*/15 * * * *")
+
+# Stored action plans older than this are regenerated by /api/action-plan/latest
+ACTION_PLAN_MAX_AGE_SECONDS = float(os.getenv("ACTION_PLAN_MAX_AGE_SECONDS", str(26 * 3600)))
+
+
+class CronSchedule:
+    """
+    Standard 5-field cron expression: *, lists, ranges and steps
+    ("*/15", "1-5", "0,30"). Day-of-week 0 and 7 are Sunday.
+    """
+
+    BOUNDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: {expression!r}")
+
+        self.expression = expression
+        fields = [self._parse(part, low, high) for part, (low, high) in zip(parts, self.BOUNDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        self.weekdays = {d % 7 for d in weekdays}
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @staticmethod
+    def _parse(part: str, low: int, high: int) -> set:
+        values = set()
+        for item in part.split(","):
+            rng, _, step = item.partition("/")
+            if rng == "*":
+                start, end = low, high
+            elif "-" in rng:
+                start, end = (int(x) for x in rng.split("-"))
+            else:
+                start = int(rng)
+                end = high if step else start
+            if not (low <= start <= end <= high):
+                raise ValueError(f"Cron field out of range: {part!r}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, t: datetime) -> bool:
+        day_ok = t.day in self.days
+        weekday_ok = (t.weekday() + 1) % 7 in self.weekdays
+        # Cron semantics: if both are restricted, either one matching is enough
+        if not self.any_day and not self.any_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, dt: datetime) -> datetime:
+        t = dt.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 4)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression never fires: {self.expression!r}")
+
+
+class PrecomputedResults:
+    """Latest result per (kind, farm) produced by background jobs or refreshes."""
+
+    def __init__(self):
+        self._results: Dict[tuple, dict] = {}
+
+    def get(self, kind: str, farm_id: str, max_age: Optional[float] = None) -> Optional[dict]:
+        entry = self._results.get((kind, farm_id))
+        if entry and max_age is not None and time.time() - entry["computed_epoch"] > max_age:
+            return None
+        return entry
+
+    def put(
+        self,
+        kind: str,
+        farm_id: str,
+        value,
+        fingerprint: Optional[str] = None,
+        computed_epoch: Optional[float] = None
+    ) -> dict:
+        computed_epoch = computed_epoch if computed_epoch is not None else time.time()
+        entry = {
+            "value": value,
+            "fingerprint": fingerprint,
+            "computed_epoch": computed_epoch,
+            "computed_at": from_epoch(computed_epoch).isoformat(),
+        }
+        self._results[(kind, farm_id)] = entry
+        return entry
+
+    def stats(self) -> dict:
+        counts = defaultdict(int)
+        for kind, _ in self._results:
+            counts[kind] += 1
+        return dict(counts)
+
+
+class FarmJobScheduler:
+    """
+    Runs per-farm jobs on cron schedules inside the API process.
+    Each run fans out over every farm with a random start jitter, and at
+    most `max_concurrency` farm jobs execute at once across all jobs.
+    """
+
+    def __init__(self, max_concurrency: int, jitter_seconds: float):
+        self.jitter_seconds = jitter_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._jobs = {}
+        self._tasks = []
+
+    def add_job(self, name: str, cron: str, func):
+        """`func(farm_id)` is an async callable."""
+        self._jobs[name] = {
+            "schedule": CronSchedule(cron),
+            "func": func,
+            "next_run": None,
+            "last_run": None,
+            "succeeded": 0,
+            "failed": 0,
+        }
+
+    def start(self):
+        for name in self._jobs:
+            self._tasks.append(asyncio.create_task(self._loop(name)))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks.clear()
+
+    async def _loop(self, name: str):
+        job = self._jobs[name]
+        while True:
+            now = datetime.utcnow()
+            job["next_run"] = job["schedule"].next_after(now)
+            await asyncio.sleep((job["next_run"] - now).total_seconds())
+            try:
+                await self.run_now(name)
+            except Exception as e:
+                print(f"❌ Scheduled job {name} failed: {type(e).__name__}: {e}")
+
+    async def run_now(self, name: str, farm_ids: Optional[List[str]] = None):
+        job = self._jobs[name]
+        job["last_run"] = datetime.utcnow()
+        farm_ids = farm_ids if farm_ids is not None else await repo.list_farms()
+        print(f"🕒 Running {name} for {len(farm_ids)} farms")
+        await asyncio.gather(*(self._run_farm(job, name, f) for f in farm_ids))
+
+    async def _run_farm(self, job: dict, name: str, farm_id: str):
+        await asyncio.sleep(random.uniform(0, self.jitter_seconds))
+        async with self._semaphore:
+            try:
+                await job["func"](farm_id)
+                job["succeeded"] += 1
+            except Exception as e:
+                job["failed"] += 1
+                print(f"⚠️ {name} failed for {farm_id}: {type(e).__name__}: {e}")
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                "cron": job["schedule"].expression,
+                "next_run": job["next_run"].isoformat() if job["next_run"] else None,
+                "last_run": job["last_run"].isoformat() if job["last_run"] else None,
+                "succeeded": job["succeeded"],
+                "failed": job["failed"],
+            }
+            for name, job in self._jobs.items()
+        }
+
+
+precomputed = PrecomputedResults()
+scheduler = FarmJobScheduler(SCHEDULER_MAX_CONCURRENCY, SCHEDULER_JITTER_SECONDS)
+
+
+async def precompute_action_plan(farm_id: str):
+    await build_action_plan(farm_id)
+
+
+async def precompute_smart_alert(farm_id: str):
+    readings = await recent_readings.get(farm_id)
+    alert = build_smart_alert(readings)
+    previous = precomputed.get("smart_alert", farm_id)
+    if alert["alert"] and not (previous and previous["value"]["alert"]):
+        print(f"🚨 Smart alert raised for {farm_id}: {alert.get('reason')}")
+    precomputed.put("smart_alert", farm_id, alert, fingerprint=smart_alert_fingerprint(readings))
+
+
+scheduler.add_job("action_plans", ACTION_PLAN_CRON, precompute_action_plan)
+scheduler.add_job("smart_alerts", SMART_ALERT_CRON, precompute_smart_alert)
+
+
+@app.on_event("startup")
+def start_scheduler():
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+
+@app.on_event("shutdown")
+def stop_scheduler():
+    scheduler.stop()
+
+
 # -----------------------------
 # CHATBOT INTEGRATION
 # -----------------------------
@@ -2946,287 +5243,593 @@ class ChatMessage(BaseModel):
 
 class ChatRequest(BaseModel):
     message: str
-    history: List[ChatMessage] = []
+    history: List[ChatMessage] = []  # only used without session_id
+    session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
     response: str
-    source: str  # "AI" or "Fallback"
+    source: str  # "AI", "Local" (intent router) or "Fallback"
     suggested_actions: List[str] = []
+    prompt_stats: Dict[str, Any] = {}  # token counts and sections used
+    cached: bool = False
+    session_id: Optional[str] = None
 
 
-def gather_comprehensive_context():
-    """
-    Gather ALL available farm context from every endpoint for the chatbot.
-    Returns a comprehensive dictionary with all dashboard data.
-    """
-    FARM_ID = "demo_farm"
+async def build_sensor_context(farm_id: str, recent: List[SensorReading]) -> dict:
+    """Sections derived from the latest readings and the daily rollups."""
     context = {}
-    
-    try:
+
+    if recent:
         # ========================================
         # 1. LATEST SENSOR DATA (Real-time IoT)
         # ========================================
-        sensor_docs = (
-            db.collection("farms")
-            .document(FARM_ID)
-            .collection("sensors")
-            .document("sensors_root")
-            .collection("readings")
-            .order_by("timestamp", direction=Query.DESCENDING)
-            .limit(1)
-            .stream()
-        )
-        
-        latest_sensor = next(sensor_docs, None)
-        if latest_sensor:
-            sensor_data = latest_sensor.to_dict()
-            context["sensors"] = {
-                "soil_moisture": sensor_data.get("soil_moisture"),
-                "temperature": sensor_data.get("temperature"),
-                "humidity": sensor_data.get("humidity"),
-                "rainfall_7d": sensor_data.get("rainfall_7d"),
-                "soil_ph": sensor_data.get("soil_ph", 5.2),
-                "timestamp": sensor_data.get("timestamp")
-            }
-            
-            # ========================================
-            # 2. CULTIVATION ENGINE RESULTS
-            # ========================================
-            cultivation_result = run_cultivation_engine({
-                "soil_moisture": sensor_data["soil_moisture"],
-                "temperature": sensor_data["temperature"],
-                "humidity": sensor_data["humidity"],
-                "rainfall_7d": sensor_data["rainfall_7d"],
-                "soil_ph": sensor_data.get("soil_ph", 5.2),
-            })
-            context["cultivation"] = cultivation_result
-            
-            # ========================================
-            # 3. SMART ALERT STATUS
-            # ========================================
-            health_score = compute_health_score({
-                "soil_moisture": sensor_data["soil_moisture"],
-                "temperature": sensor_data["temperature"],
-                "humidity": sensor_data["humidity"],
-                "rainfall_7d": sensor_data["rainfall_7d"]
-            })
-            risk_score, stress_breakdown = compute_stress_breakdown({
-                "soil_moisture": sensor_data["soil_moisture"],
-                "temperature": sensor_data["temperature"],
-                "humidity": sensor_data["humidity"],
-                "rainfall_7d": sensor_data["rainfall_7d"]
-            })
-            
-            context["alerts"] = {
-                "health_score": health_score,
-                "risk_score": risk_score,
-                "stress_breakdown": stress_breakdown,
-                "alert_active": health_score <= 60
-            }
-        
+        sensor_data = recent[0]
+        soil_ph = sensor_data.soil_ph if sensor_data.soil_ph is not None else 5.2
+        context["sensors"] = {
+            "soil_moisture": sensor_data.soil_moisture,
+            "temperature": sensor_data.temperature,
+            "humidity": sensor_data.humidity,
+            "rainfall_7d": sensor_data.rainfall_7d,
+            "soil_ph": soil_ph,
+            "timestamp": sensor_data.timestamp
+        }
+
         # ========================================
-        # 4. FARM AVERAGES (Last 50 readings)
+        # 2. CULTIVATION ENGINE RESULTS
         # ========================================
-        readings_ref = (
-            db.collection("farms")
-            .document(FARM_ID)
-            .collection("sensors")
-            .document("sensors_root")
-            .collection("readings")
-            .order_by("timestamp", direction=Query.DESCENDING)
-            .limit(50)
-        )
-        
-        docs = readings_ref.stream()
-        readings = []
-        for doc in docs:
-            d = doc.to_dict()
-            readings.append({
-                "soil_moisture": d.get("soil_moisture"),
-                "temperature": d.get("temperature"),
-                "humidity": d.get("humidity"),
-                "rainfall_7d": d.get("rainfall_7d"),
-            })
-        
-        if readings:
-            df_readings = pd.DataFrame(readings)
-            context["averages"] = {
-                "soil_moisture": round(df_readings["soil_moisture"].mean(), 2),
-                "temperature": round(df_readings["temperature"].mean(), 2),
-                "humidity": round(df_readings["humidity"].mean(), 2),
-                "rainfall_7d": round(df_readings["rainfall_7d"].mean(), 2),
-                "sample_count": len(df_readings)
-            }
-        
+        # Models only: the engine's AI recommendations are not part of the prompt
+        context["cultivation"] = await run_in_threadpool(assess_cultivation, {
+            "soil_moisture": sensor_data.soil_moisture,
+            "temperature": sensor_data.temperature,
+            "humidity": sensor_data.humidity,
+            "rainfall_7d": sensor_data.rainfall_7d,
+            "soil_ph": soil_ph,
+        })
+
         # ========================================
-        # 5. SOIL MOISTURE TREND (Last 24 readings)
+        # 3. SMART ALERT STATUS
         # ========================================
-        soil_docs = (
-            db.collection("farms")
-            .document(FARM_ID)
-            .collection("sensors")
-            .document("sensors_root")
-            .collection("readings")
-            .order_by("timestamp", direction=Query.DESCENDING)
-            .limit(24)
-            .stream()
-        )
-        
-        soil_series = []
-        for doc in soil_docs:
-            d = doc.to_dict()
-            if d.get("timestamp"):
-                soil_series.append({
-                    "value": round(d["soil_moisture"], 1),
-                    "ts": d["timestamp"]
-                })
-        
-        soil_series.sort(key=lambda x: x["ts"])
-        if len(soil_series) >= 2:
-            context["soil_moisture_trend"] = {
-                "current": soil_series[-1]["value"],
-                "previous": soil_series[-2]["value"],
-                "change": round(soil_series[-1]["value"] - soil_series[-2]["value"], 1),
-                "trend": "increasing" if soil_series[-1]["value"] > soil_series[-2]["value"] else "decreasing"
-            }
-        
+        stress_input = {
+            "soil_moisture": sensor_data.soil_moisture,
+            "temperature": sensor_data.temperature,
+            "humidity": sensor_data.humidity,
+            "rainfall_7d": sensor_data.rainfall_7d
+        }
+        health_score = compute_health_score(stress_input)
+        risk_score, stress_breakdown = compute_stress_breakdown(stress_input)
+
+        context["alerts"] = {
+            "health_score": health_score,
+            "risk_score": risk_score,
+            "stress_breakdown": stress_breakdown,
+            "alert_active": health_score <= 60
+        }
+
         # ========================================
-        # 6. MARKET DATA (KPIs + Price Series)
+        # 4. FARM AVERAGES (Last 50 readings)
         # ========================================
-        if df is not None and not df.empty and len(df) >= 3:
-            prices = df[PRIMARY_MARKET].dropna()
-            
-            # Current price and change
-            current_price = float(prices.iloc[-1])
-            prev_price = float(prices.iloc[-2])
-            price_change_pct = ((current_price - prev_price) / prev_price) * 100
-            
-            # Demand index
-            price_change_pct_abs = abs((prices.iloc[-1] - prices.iloc[-2]) / prices.iloc[-2]) * 100
-            demand_index = min(price_change_pct_abs * 5, 100)
-            
-            # Volatility
-            recent_7 = prices.tail(7)
-            volatility = round(recent_7.std(), 2)
-            
-            context["market"] = {
-                "current_price": round(current_price, 2),
-                "previous_price": round(prev_price, 2),
-                "price_change_pct": round(price_change_pct, 2),
-                "price_trend": "increasing" if price_change_pct > 0 else "decreasing",
-                "demand_index": round(demand_index, 1),
-                "volatility": volatility,
-                "market_name": "Guwahati",
-                "week_ending": str(df.iloc[-1]["week_ending_date"].strftime("%Y-%m-%d"))
+        df_readings = pd.DataFrame(recent, columns=SensorReading._fields)
+        context["averages"] = {
+            "soil_moisture": round(df_readings["soil_moisture"].mean(), 2),
+            "temperature": round(df_readings["temperature"].mean(), 2),
+            "humidity": round(df_readings["humidity"].mean(), 2),
+            "rainfall_7d": round(df_readings["rainfall_7d"].mean(), 2),
+            "sample_count": len(df_readings)
+        }
+
+    # ========================================
+    # 5. SOIL MOISTURE TREND (Last 24 readings)
+    # ========================================
+    soil_series = []
+    for d in recent[:24]:
+        if d.timestamp and d.soil_moisture is not None:
+            soil_series.append({
+                "value": round(d.soil_moisture, 1),
+                "ts": d.timestamp
+            })
+
+    soil_series.sort(key=lambda x: x["ts"])
+    if len(soil_series) >= 2:
+        context["soil_moisture_trend"] = {
+            "current": soil_series[-1]["value"],
+            "previous": soil_series[-2]["value"],
+            "change": round(soil_series[-1]["value"] - soil_series[-2]["value"], 1),
+            "trend": "increasing" if soil_series[-1]["value"] > soil_series[-2]["value"] else "decreasing"
+        }
+
+    # ========================================
+    # 8. DAILY METRICS (Last 7 days)
+    # ========================================
+    daily_summary = await build_daily_metrics(farm_id, days=7)
+    if daily_summary:
+        context["daily_metrics"] = daily_summary
+
+    return context
+
+
+def build_market_context(snapshot: dict = None) -> dict:
+    # ========================================
+    # 6. MARKET DATA (KPIs + Price Series)
+    # ========================================
+    snapshot = snapshot or market_snapshot
+    context = {}
+    kpis = market_kpis_for(PRIMARY_MARKET, snapshot)
+    if kpis is not None:
+        context["market"] = {
+            "current_price": round(kpis["current_price"], 2),
+            "previous_price": round(kpis["previous_price"], 2),
+            "price_change_pct": round(kpis["price_change_pct"], 2),
+            "price_trend": "increasing" if kpis["price_change_pct"] > 0 else "decreasing",
+            "demand_index": round(kpis["demand_index"], 1),
+            "volatility": round(kpis["price_std_7w"], 2),
+            "market_name": "Guwahati",
+            "week_ending": snapshot["week_ending"],
+            # Price series (last 8 weeks)
+            "price_history": kpis["price_history"],
+            # All market locations
+            "all_locations": {
+                col.title(): round(m["current_price"], 2)
+                for col, m in snapshot["markets"].items()
+                if m["week_ending"] == snapshot["week_ending"]
+            },
+        }
+
+    return context
+
+
+async def build_leaf_context(farm_id: str) -> dict:
+    # ========================================
+    # 7. LATEST LEAF SCAN RESULTS
+    # ========================================
+    leaf_docs = await repo.query(  # Last 3 scans for trend
+        farm_id, "leaf_scans",
+        descending=True, limit=3, fields=LEAF_SCAN_SUMMARY_FIELDS
+    )
+
+    leaf_scans = []
+    for leaf_data in leaf_docs:
+        leaf_scans.append({
+            "grade": leaf_data.get("grade"),
+            "disease_type": leaf_data.get("disease_type"),
+            "confidence": leaf_data.get("confidence"),
+            "severity": leaf_data.get("severity"),
+            "timestamp": leaf_data.get("timestamp")
+        })
+
+    if not leaf_scans:
+        return {}
+    return {
+        "leaf_quality": {
+            "latest": leaf_scans[0],
+            "history_count": len(leaf_scans),
+            "recent_scans": leaf_scans
+        }
+    }
+
+
+class ChatContextCache:
+    """
+    Per-farm chat context, kept as independently versioned parts:
+    - sensors (sections 1-5, 8): rebuilt when the newest reading changes
+    - market (6): rebuilt when the loaded market data changes
+    - leaf (7): rebuilt after a new leaf scan for the farm
+    Everything is rebuilt after `ttl_seconds` as a backstop, e.g. for
+    scans written by another instance.
+
+    Farms are isolated entries in an LRU bounded by `max_farms` and by an
+    approximate memory cap (`max_bytes`, measured as serialised size).
+    Hits and part rebuilds are counted per farm.
+    """
+
+    def __init__(self, ttl_seconds: float, max_farms: int, max_bytes: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_farms = max_farms
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # farm_id -> entry, least recently used first
+        self._locks: Dict[str, asyncio.Lock] = {}
+        # A farm's leaf version is drawn from this counter whenever its entry
+        # is created, so a re-created entry never repeats an old version
+        self._leaf_versions = itertools.count(1)
+        self.bytes = 0
+        self.part_builds = 0
+        self.requests = 0
+        self.evictions = 0
+
+    def note_leaf_scan(self, farm_id: str):
+        entry = self._entries.get(farm_id)
+        if entry is not None:
+            entry["leaf_version"] = next(self._leaf_versions)
+
+    def _entry(self, farm_id: str) -> dict:
+        entry = self._entries.get(farm_id)
+        if entry is None:
+            entry = {
+                "built_at": time.time(),
+                "parts": {},
+                "leaf_version": next(self._leaf_versions),
+                "bytes": 0,
+                "requests": 0,
+                "hits": 0,
+                "part_builds": 0,
             }
-            
-            # Price series (last 8 weeks)
-            price_history = []
-            for idx in range(min(8, len(df))):
-                row = df.iloc[-(idx+1)]
-                price_history.append({
-                    "week": row["week_ending_date"].strftime("%b %d"),
-                    "price": round(float(row[PRIMARY_MARKET]), 2)
-                })
-            price_history.reverse()
-            context["market"]["price_history"] = price_history
-            
-            # All market locations
-            market_columns = ["kolkata", "guwahati", "siliguri", "jalpaiguri", 
-                            "mjunction", "cochin", "coonoor", "coimbatore", "tea_serve"]
-            latest_row = df.iloc[-1]
-            location_prices = {}
-            for col in market_columns:
-                if col in latest_row and pd.notna(latest_row[col]):
-                    location_prices[col.title()] = round(float(latest_row[col]), 2)
-            context["market"]["all_locations"] = location_prices
-        
-        # ========================================
-        # 7. LATEST LEAF SCAN RESULTS
-        # ========================================
-        leaf_docs = (
-            db.collection("farms")
-            .document(FARM_ID)
-            .collection("leaf_scans")
-            .order_by("timestamp", direction=Query.DESCENDING)
-            .limit(3)  # Get last 3 scans for trend
-            .stream()
-        )
-        
-        leaf_scans = []
-        for doc in leaf_docs:
-            leaf_data = doc.to_dict()
-            leaf_scans.append({
-                "grade": leaf_data.get("grade"),
-                "disease_type": leaf_data.get("disease_type"),
-                "confidence": leaf_data.get("confidence"),
-                "severity": leaf_data.get("severity"),
-                "timestamp": leaf_data.get("timestamp")
-            })
-        
-        if leaf_scans:
-            context["leaf_quality"] = {
-                "latest": leaf_scans[0],
-                "history_count": len(leaf_scans),
-                "recent_scans": leaf_scans
+            self._entries[farm_id] = entry
+        elif time.time() - entry["built_at"] > self.ttl_seconds:
+            entry["built_at"] = time.time()
+            entry["parts"] = {}
+        self._entries.move_to_end(farm_id)
+        return entry
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.max_farms or self.bytes > self.max_bytes
+        ):
+            farm_id, entry = next(iter(self._entries.items()))
+            if len(self._entries) == 1:
+                break  # always keep the farm just served
+            self._entries.pop(farm_id)
+            self.bytes -= entry["bytes"]
+            self.evictions += 1
+            lock = self._locks.get(farm_id)
+            if lock is not None and not lock.locked():
+                del self._locks[farm_id]
+
+    async def get(self, farm_id: str) -> dict:
+        recent = await recent_readings.get(farm_id)
+        market = market_snapshot  # one reference, in case market data is reloaded meanwhile
+        lock = self._locks.setdefault(farm_id, asyncio.Lock())
+
+        async with lock:
+            self.requests += 1
+            entry = self._entry(farm_id)
+            entry["requests"] += 1
+            versions = {
+                "sensors": (recent[0].timestamp, len(recent)) if recent else None,
+                "market": market["version"],
+                "leaf": entry["leaf_version"],
             }
-        
-        # ========================================
-        # 8. DAILY METRICS (Last 7 days)
-        # ========================================
-        now = datetime.utcnow()
-        start = now - timedelta(days=7)
-        
-        daily_docs = (
-            db.collection("farms")
-            .document(FARM_ID)
-            .collection("sensors")
-            .document("sensors_root")
-            .collection("readings")
-            .where("timestamp", ">=", start)
-            .stream()
-        )
-        
-        buckets = defaultdict(lambda: {
-            "soil_moisture": [],
-            "temperature": [],
-            "humidity": [],
-            "rainfall": 0.0,
-        })
-        
-        for doc in daily_docs:
-            d = doc.to_dict()
-            ts = d.get("timestamp")
-            if ts:
-                day = ts.strftime("%a")
-                buckets[day]["soil_moisture"].append(d["soil_moisture"])
-                buckets[day]["temperature"].append(d["temperature"])
-                buckets[day]["humidity"].append(d["humidity"])
-                buckets[day]["rainfall"] += d.get("rainfall_7d", 0) / 7
-        
-        daily_summary = []
-        for day in ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]:
-            if day in buckets:
-                b = buckets[day]
-                daily_summary.append({
-                    "day": day,
-                    "soil_moisture": round(sum(b["soil_moisture"]) / len(b["soil_moisture"]), 1),
-                    "temperature": round(sum(b["temperature"]) / len(b["temperature"]), 1),
-                    "humidity": round(sum(b["humidity"]) / len(b["humidity"]), 1),
-                    "rainfall": round(b["rainfall"], 1),
-                })
-        
-        if daily_summary:
-            context["daily_metrics"] = daily_summary
-    
+
+            parts = entry["parts"]
+            stale = [name for name, version in versions.items()
+                     if name not in parts or parts[name][0] != version]
+
+            builders = {
+                "sensors": lambda: build_sensor_context(farm_id, recent),
+                "market": lambda: run_in_threadpool(build_market_context, market),
+                "leaf": lambda: build_leaf_context(farm_id),
+            }
+            results = await asyncio.gather(*(builders[name]() for name in stale))
+            for name, result in zip(stale, results):
+                parts[name] = (versions[name], result)
+            self.part_builds += len(stale)
+            entry["part_builds"] += len(stale)
+            if not stale:
+                entry["hits"] += 1
+
+            context = {}
+            for _, part in parts.values():
+                context.update(part)
+
+            if stale:
+                size = len(json.dumps(context, default=str))
+                self.bytes += size - entry["bytes"]
+                entry["bytes"] = size
+                self._evict()
+            return context
+
+    def versions(self, farm_id: str) -> dict:
+        """Versions of the farm's currently cached context parts."""
+        entry = self._entries.get(farm_id)
+        return {name: version for name, (version, _) in entry["parts"].items()} if entry else {}
+
+    def farm_stats(self, farm_id: str) -> Optional[dict]:
+        entry = self._entries.get(farm_id)
+        if entry is None:
+            return None
+        return {
+            "requests": entry["requests"],
+            "hits": entry["hits"],
+            "hit_rate": round(entry["hits"] / entry["requests"], 3) if entry["requests"] else None,
+            "part_builds": entry["part_builds"],
+            "bytes": entry["bytes"],
+        }
+
+    def stats(self, top: int = 10) -> dict:
+        busiest = sorted(self._entries, key=lambda f: self._entries[f]["requests"], reverse=True)
+        return {
+            "farms": len(self._entries),
+            "bytes": self.bytes,
+            "requests": self.requests,
+            "part_builds": self.part_builds,
+            "evictions": self.evictions,
+            "top_farms": {farm_id: self.farm_stats(farm_id) for farm_id in busiest[:top]},
+        }
+
+
+CHAT_CONTEXT_TTL_SECONDS = float(os.getenv("CHAT_CONTEXT_TTL_SECONDS", "300"))
+CHAT_CONTEXT_MAX_FARMS = int(os.getenv("CHAT_CONTEXT_MAX_FARMS", "1000"))
+CHAT_CONTEXT_MAX_BYTES = int(os.getenv("CHAT_CONTEXT_MAX_MB", "64")) * 1024 * 1024
+chat_contexts = ChatContextCache(
+    CHAT_CONTEXT_TTL_SECONDS,
+    CHAT_CONTEXT_MAX_FARMS,
+    CHAT_CONTEXT_MAX_BYTES
+)
+
+
+async def gather_comprehensive_context(farm_id: str):
+    """
+    Gather ALL available farm context from every endpoint for the chatbot.
+    Returns a comprehensive dictionary with all dashboard data, served from
+    the per-farm context cache and refreshed only where inputs changed.
+    """
+    try:
+        return await chat_contexts.get(farm_id)
     except Exception as e:
         print(f"❌ Error gathering context: {e}")
         import traceback
         traceback.print_exc()
-    
-    return context
+        return {}
+
+
+# Server-side conversation memory: recent messages verbatim, older ones
+# folded into a running summary
+CHAT_SESSION_MAX_ENTRIES = int(os.getenv("CHAT_SESSION_MAX_ENTRIES", "5000"))
+CHAT_SESSION_TTL_SECONDS = float(os.getenv("CHAT_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+CHAT_SESSION_DB_PATH = os.getenv("CHAT_SESSION_DB_PATH", "")
+# Stored sessions kept per user; the least recently used are deleted
+CHAT_SESSIONS_PER_USER = int(os.getenv("CHAT_SESSIONS_PER_USER", "20"))
+CHAT_HISTORY_KEEP_MESSAGES = int(os.getenv("CHAT_HISTORY_KEEP_MESSAGES", "6"))
+CHAT_SUMMARY_BATCH_MESSAGES = int(os.getenv("CHAT_SUMMARY_BATCH_MESSAGES", "6"))
+CHAT_SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "1200"))
+
+
+def summarize_conversation(summary: str, messages: List[dict]) -> str:
+    """
+    Fold `messages` into the running `summary` with Gemini. Without AI the
+    farmer's questions are appended verbatim (trimmed), oldest dropped first.
+    """
+    transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+    prompt = f"""Update the running summary of a conversation between a tea farmer and a farming assistant.
+Keep the farmer's situation, questions, decisions and the advice already given. Drop greetings and small talk.
+Use at most {CHAT_SUMMARY_MAX_CHARS // 6} words, in the language of the conversation. Plain text only.
+
+Current summary:
+{summary or "(none)"}
+
+New messages:
+{transcript}
+
+Updated summary:"""
+    try:
+        response = llm.generate_content(prompt)
+        if response and response.text:
+            return response.text.strip()[:CHAT_SUMMARY_MAX_CHARS]
+    except Exception as e:
+        print(f"⚠️ Conversation summary using fallback: {type(e).__name__}: {e}")
+
+    lines = summary.splitlines() if summary else []
+    lines += [f"- Farmer asked: {m['content'][:160]}" for m in messages if m["role"] == "user"]
+    while len(lines) > 1 and len("\n".join(lines)) > CHAT_SUMMARY_MAX_CHARS:
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+class ConversationStore:
+    """
+    Chat sessions keyed by (user, session id), each holding a running
+    summary and the most recent messages. Sessions are kept in an LRU in
+    memory; with `db_path` every change is also written to SQLite, so
+    sessions evicted from memory (or from before a restart) reload from
+    disk. A session is only written once it has a turn, each user keeps
+    at most `per_user` stored sessions, and sessions idle for
+    `ttl_seconds` expire.
+    """
+
+    def __init__(self, max_sessions: int, ttl_seconds: float, keep_messages: int,
+                 db_path: str = "", per_user: int = 20):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.keep_messages = keep_messages
+        self.per_user = per_user
+        self._last_purge = time.time()
+        self._sessions = OrderedDict()  # (user_id, session_id) -> session
+        self._lock = threading.Lock()
+        self._conn = None
+        if db_path:
+            self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    user_id TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    summary TEXT NOT NULL,
+                    messages TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, session_id)
+                ) WITHOUT ROWID
+            """)
+            self._conn.execute(
+                "DELETE FROM chat_sessions WHERE updated_at < ?",
+                (time.time() - ttl_seconds,)
+            )
+        self.hits = 0
+        self.disk_loads = 0
+        self.evictions = 0
+        self.summaries = 0
+
+    # -------- INTERNAL (call with the lock held) --------
+
+    def _load(self, key: tuple) -> Optional[dict]:
+        session = self._sessions.get(key)
+        if session is None and self._conn is not None:
+            row = self._conn.execute(
+                "SELECT summary, messages, updated_at FROM chat_sessions "
+                "WHERE user_id = ? AND session_id = ?",
+                key
+            ).fetchone()
+            if row:
+                session = {
+                    "summary": row[0], "messages": json.loads(row[1]), "updated_at": row[2], "stored": True
+                }
+                self.disk_loads += 1
+                self._remember(key, session)
+        elif session is not None:
+            self.hits += 1
+
+        if session is None:
+            return None
+        if time.time() - session["updated_at"] > self.ttl_seconds:
+            self._sessions.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute(
+                    "DELETE FROM chat_sessions WHERE user_id = ? AND session_id = ?", key
+                )
+            return None
+        self._sessions.move_to_end(key)
+        return session
+
+    def _remember(self, key: tuple, session: dict):
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+
+    def _save(self, key: tuple, session: dict):
+        session["updated_at"] = time.time()
+        if self._conn is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chat_sessions "
+                "(user_id, session_id, summary, messages, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (*key, session["summary"], json.dumps(session["messages"], ensure_ascii=False),
+                 session["updated_at"])
+            )
+            if not session.get("stored"):
+                session["stored"] = True
+                self._prune(key[0])
+
+    def _prune(self, user_id: str):
+        """Drop the user's oldest stored sessions beyond `per_user`, and expired ones hourly."""
+        self._conn.execute(
+            "DELETE FROM chat_sessions WHERE user_id = ? AND session_id NOT IN ("
+            "SELECT session_id FROM chat_sessions WHERE user_id = ? "
+            "ORDER BY updated_at DESC LIMIT ?)",
+            (user_id, user_id, self.per_user)
+        )
+        if time.time() - self._last_purge > 3600:
+            self._last_purge = time.time()
+            self._conn.execute(
+                "DELETE FROM chat_sessions WHERE updated_at < ?",
+                (time.time() - self.ttl_seconds,)
+            )
+
+    # -------- PUBLIC --------
+
+    def create(self, user_id: str) -> str:
+        session_id = uuid.uuid4().hex
+        key = (user_id, session_id)
+        session = {"summary": "", "messages": [], "updated_at": time.time()}
+        with self._lock:
+            self._remember(key, session)  # written to disk with its first turn
+        return session_id
+
+    def get(self, user_id: str, session_id: str) -> Optional[tuple]:
+        """(summary, recent messages as ChatMessage) or None if unknown/expired."""
+        with self._lock:
+            session = self._load((user_id, session_id))
+            if session is None:
+                return None
+            recent = session["messages"][-self.keep_messages:]
+            return session["summary"], [ChatMessage(**m) for m in recent]
+
+    def append(self, user_id: str, session_id: str, *messages: ChatMessage):
+        key = (user_id, session_id)
+        with self._lock:
+            session = self._load(key)
+            if session is None:
+                return
+            session["messages"].extend({"role": m.role, "content": m.content} for m in messages)
+            self._save(key, session)
+
+    def compact(self, user_id: str, session_id: str, batch: int = None):
+        """
+        Fold messages older than the last `keep_messages` into the summary
+        once at least `batch` of them have built up. The summary call runs
+        outside the lock; turns appended meanwhile are kept.
+        """
+        batch = batch or CHAT_SUMMARY_BATCH_MESSAGES
+        key = (user_id, session_id)
+        with self._lock:
+            session = self._load(key)
+            if session is None or len(session["messages"]) - self.keep_messages < batch:
+                return
+            overflow = session["messages"][:-self.keep_messages]
+            summary = session["summary"]
+
+        new_summary = summarize_conversation(summary, overflow)
+
+        with self._lock:
+            session = self._load(key)
+            if session is None or session["summary"] != summary \
+                    or session["messages"][:len(overflow)] != overflow:
+                return  # compacted concurrently
+            session["summary"] = new_summary
+            del session["messages"][:len(overflow)]
+            self._save(key, session)
+            self.summaries += 1
+
+    def stats(self) -> dict:
+        return {
+            "sessions_in_memory": len(self._sessions),
+            "sqlite": bool(self._conn),
+            "hits": self.hits,
+            "disk_loads": self.disk_loads,
+            "evictions": self.evictions,
+            "summaries": self.summaries,
+        }
+
+
+conversations = ConversationStore(
+    CHAT_SESSION_MAX_ENTRIES,
+    CHAT_SESSION_TTL_SECONDS,
+    CHAT_HISTORY_KEEP_MESSAGES,
+    CHAT_SESSION_DB_PATH,
+    CHAT_SESSIONS_PER_USER
+)
+
+
+def resolve_chat_session(user_id: str, request: ChatRequest) -> tuple:
+    """
+    (session_id, summary, history) for a chat turn. Clients that send their
+    own transcript without a session id are served from it as before and
+    nothing is stored; otherwise an unknown or expired session starts fresh.
+    """
+    if request.session_id:
+        session = conversations.get(user_id, request.session_id)
+        if session is not None:
+            return (request.session_id, *session)
+    elif request.history:
+        return None, "", request.history
+    return conversations.create(user_id), "", []
+
+
+def record_chat_turn(user_id: str, session_id: Optional[str], message: str, response: str):
+    """
+    Store an answered turn. Folding older turns into the summary can call
+    Gemini, so endpoints run compact_chat_session after replying.
+    """
+    if session_id:
+        conversations.append(
+            user_id, session_id,
+            ChatMessage(role="user", content=message),
+            ChatMessage(role="assistant", content=response)
+        )
 
 
+def compact_chat_session(user_id: str, session_id: Optional[str]):
+    if session_id:
+        conversations.compact(user_id, session_id)
+
 
 def get_fallback_response(message: str) -> str:
     """
@@ -3270,134 +5873,338 @@ def get_fallback_response(message: str) -> str:
     return "That's a great question! Based on your current farm data, I recommend checking the relevant dashboard tab for detailed insights. You can also explore the Cultivation Intelligence, Leaf Quality Scanner, or Market Intelligence sections. Is there anything specific I can help clarify?"
 
 
-def generate_chat_response(message: str, history: List[ChatMessage], context: dict) -> tuple:
-    """
-    Generate AI response using Gemini with comprehensive context from ALL endpoints.
-    Returns (response_text, suggested_actions)
-    """
-    # Detect language
-    message_lower = message.lower()
-    is_hindi = any(word in message for word in ["कैसे", "क्या", "मुझे", "चाय", "पानी", "मिट्टी", "कीड़े", "बीमारी", "सिंचाई"])
-    is_assamese = any(word in message for word in ["কেনেকৈ", "কি", "চাহ", "পানী", "মাটি"])
-    
-    # Build COMPREHENSIVE context summary
-    context_summary = "=== COMPLETE FARM DATA ===\n\n"
+def render_context_sections(context: dict) -> List[tuple]:
+    """(name, text) for each context section present, in display order."""
+    sections = []
     
     # 1. CURRENT SENSOR READINGS
     if "sensors" in context:
         s = context["sensors"]
-        context_summary += "📊 CURRENT SENSOR READINGS:\n"
-        context_summary += f"  • Soil Moisture: {s.get('soil_moisture')}%\n"
-        context_summary += f"  • Temperature: {s.get('temperature')}°C\n"
-        context_summary += f"  • Humidity: {s.get('humidity')}%\n"
-        context_summary += f"  • Rainfall (7 days): {s.get('rainfall_7d')}mm\n"
-        context_summary += f"  • Soil pH: {s.get('soil_ph')}\n\n"
+        text = "📊 CURRENT SENSOR READINGS:\n"
+        text += f"  • Soil Moisture: {s.get('soil_moisture')}%\n"
+        text += f"  • Temperature: {s.get('temperature')}°C\n"
+        text += f"  • Humidity: {s.get('humidity')}%\n"
+        text += f"  • Rainfall (7 days): {s.get('rainfall_7d')}mm\n"
+        text += f"  • Soil pH: {s.get('soil_ph')}\n\n"
+        sections.append(("sensors", text))
     
     # 2. FARM AVERAGES (Last 50 readings)
     if "averages" in context:
         a = context["averages"]
-        context_summary += "📈 FARM AVERAGES (Last 50 readings):\n"
-        context_summary += f"  • Avg Soil Moisture: {a.get('soil_moisture')}%\n"
-        context_summary += f"  • Avg Temperature: {a.get('temperature')}°C\n"
-        context_summary += f"  • Avg Humidity: {a.get('humidity')}%\n"
-        context_summary += f"  • Avg Rainfall: {a.get('rainfall_7d')}mm\n"
-        context_summary += f"  • Sample Count: {a.get('sample_count')}\n\n"
+        text = "📈 FARM AVERAGES (Last 50 readings):\n"
+        text += f"  • Avg Soil Moisture: {a.get('soil_moisture')}%\n"
+        text += f"  • Avg Temperature: {a.get('temperature')}°C\n"
+        text += f"  • Avg Humidity: {a.get('humidity')}%\n"
+        text += f"  • Avg Rainfall: {a.get('rainfall_7d')}mm\n"
+        text += f"  • Sample Count: {a.get('sample_count')}\n\n"
+        sections.append(("averages", text))
     
     # 3. SOIL MOISTURE TREND
     if "soil_moisture_trend" in context:
         t = context["soil_moisture_trend"]
-        context_summary += "💧 SOIL MOISTURE TREND:\n"
-        context_summary += f"  • Current: {t.get('current')}%\n"
-        context_summary += f"  • Previous: {t.get('previous')}%\n"
-        context_summary += f"  • Change: {t.get('change')}% ({t.get('trend')})\n\n"
+        text = "💧 SOIL MOISTURE TREND:\n"
+        text += f"  • Current: {t.get('current')}%\n"
+        text += f"  • Previous: {t.get('previous')}%\n"
+        text += f"  • Change: {t.get('change')}% ({t.get('trend')})\n\n"
+        sections.append(("soil_moisture_trend", text))
     
     # 4. CULTIVATION HEALTH
     if "cultivation" in context:
         c = context["cultivation"]
-        context_summary += "🌱 CULTIVATION HEALTH ANALYSIS:\n"
-        context_summary += f"  • Health Score: {c.get('health_score')}/100\n"
-        context_summary += f"  • Pest Risk: {c.get('pest_risk')}\n"
-        context_summary += f"  • Drought Risk: {c.get('drought_risk')}\n"
-        context_summary += f"  • Recommended Action: {c.get('action')}\n"
+        text = "🌱 CULTIVATION HEALTH ANALYSIS:\n"
+        text += f"  • Health Score: {c.get('health_score')}/100\n"
+        text += f"  • Pest Risk: {c.get('pest_risk')}\n"
+        text += f"  • Drought Risk: {c.get('drought_risk')}\n"
+        text += f"  • Recommended Action: {c.get('action')}\n"
         if "score_explanation" in c:
             exp = c["score_explanation"]
-            context_summary += f"  • Soil Moisture Status: {exp.get('soil_moisture')}\n"
-            context_summary += f"  • Temperature Status: {exp.get('temperature')}\n"
-            context_summary += f"  • Humidity Status: {exp.get('humidity')}\n"
-            context_summary += f"  • Rainfall Status: {exp.get('rainfall_7d')}\n"
-        context_summary += "\n"
+            text += f"  • Soil Moisture Status: {exp.get('soil_moisture')}\n"
+            text += f"  • Temperature Status: {exp.get('temperature')}\n"
+            text += f"  • Humidity Status: {exp.get('humidity')}\n"
+            text += f"  • Rainfall Status: {exp.get('rainfall_7d')}\n"
+        text += "\n"
+        sections.append(("cultivation", text))
     
     # 5. SMART ALERTS
     if "alerts" in context:
         al = context["alerts"]
-        context_summary += "⚠️ SMART ALERTS:\n"
-        context_summary += f"  • Alert Active: {'YES' if al.get('alert_active') else 'NO'}\n"
-        context_summary += f"  • Health Score: {al.get('health_score')}/100\n"
-        context_summary += f"  • Risk Score: {al.get('risk_score')}/100\n"
+        text = "⚠️ SMART ALERTS:\n"
+        text += f"  • Alert Active: {'YES' if al.get('alert_active') else 'NO'}\n"
+        text += f"  • Health Score: {al.get('health_score')}/100\n"
+        text += f"  • Risk Score: {al.get('risk_score')}/100\n"
         if "stress_breakdown" in al:
-            context_summary += "  • Stress Factors:\n"
+            text += "  • Stress Factors:\n"
             for factor, value in al["stress_breakdown"].items():
                 if value > 0:
-                    context_summary += f"    - {factor.replace('_', ' ').title()}: {value}\n"
-        context_summary += "\n"
+                    text += f"    - {factor.replace('_', ' ').title()}: {value}\n"
+        text += "\n"
+        sections.append(("alerts", text))
     
     # 6. MARKET DATA
     if "market" in context:
         m = context["market"]
-        context_summary += "💰 MARKET INTELLIGENCE (Guwahati):\n"
-        context_summary += f"  • Current Price: ₹{m.get('current_price')}/kg\n"
-        context_summary += f"  • Previous Price: ₹{m.get('previous_price')}/kg\n"
-        context_summary += f"  • Price Change: {m.get('price_change_pct')}% ({m.get('price_trend')})\n"
-        context_summary += f"  • Demand Index: {m.get('demand_index')}/100\n"
-        context_summary += f"  • Market Volatility: {m.get('volatility')}\n"
-        context_summary += f"  • Week Ending: {m.get('week_ending')}\n"
+        text = "💰 MARKET INTELLIGENCE (Guwahati):\n"
+        text += f"  • Current Price: ₹{m.get('current_price')}/kg\n"
+        text += f"  • Previous Price: ₹{m.get('previous_price')}/kg\n"
+        text += f"  • Price Change: {m.get('price_change_pct')}% ({m.get('price_trend')})\n"
+        text += f"  • Demand Index: {m.get('demand_index')}/100\n"
+        text += f"  • Market Volatility: {m.get('volatility')}\n"
+        text += f"  • Week Ending: {m.get('week_ending')}\n"
         
         if "price_history" in m and m["price_history"]:
-            context_summary += "  • Recent Price History:\n"
+            text += "  • Recent Price History:\n"
             for ph in m["price_history"][-4:]:  # Last 4 weeks
-                context_summary += f"    - {ph['week']}: ₹{ph['price']}/kg\n"
+                text += f"    - {ph['week']}: ₹{ph['price']}/kg\n"
         
         if "all_locations" in m:
-            context_summary += "  • Prices at Other Markets:\n"
+            text += "  • Prices at Other Markets:\n"
             for loc, price in m["all_locations"].items():
-                context_summary += f"    - {loc}: ₹{price}/kg\n"
-        context_summary += "\n"
+                text += f"    - {loc}: ₹{price}/kg\n"
+        text += "\n"
+        sections.append(("market", text))
     
     # 7. LEAF QUALITY SCANS
     if "leaf_quality" in context:
         lq = context["leaf_quality"]
         latest = lq.get("latest", {})
-        context_summary += "🍃 LEAF QUALITY SCANS:\n"
-        context_summary += f"  • Latest Grade: {latest.get('grade')}\n"
+        text = "🍃 LEAF QUALITY SCANS:\n"
+        text += f"  • Latest Grade: {latest.get('grade')}\n"
         if latest.get('disease_type'):
-            context_summary += f"  • Disease Detected: {latest.get('disease_type')}\n"
-        context_summary += f"  • Confidence: {latest.get('confidence')}\n"
-        context_summary += f"  • Severity: {latest.get('severity')}\n"
-        context_summary += f"  • Total Scans in History: {lq.get('history_count')}\n\n"
+            text += f"  • Disease Detected: {latest.get('disease_type')}\n"
+        text += f"  • Confidence: {latest.get('confidence')}\n"
+        text += f"  • Severity: {latest.get('severity')}\n"
+        text += f"  • Total Scans in History: {lq.get('history_count')}\n\n"
+        sections.append(("leaf_quality", text))
     
     # 8. DAILY METRICS (Last 7 days)
     if "daily_metrics" in context:
         dm = context["daily_metrics"]
-        context_summary += "📅 DAILY METRICS (Last 7 days):\n"
+        text = "📅 DAILY METRICS (Last 7 days):\n"
         for day_data in dm[-3:]:  # Last 3 days
-            context_summary += f"  • {day_data['day']}: "
-            context_summary += f"Moisture={day_data['soil_moisture']}%, "
-            context_summary += f"Temp={day_data['temperature']}°C, "
-            context_summary += f"Humidity={day_data['humidity']}%\n"
-        context_summary += "\n"
+            text += f"  • {day_data['day']}: "
+            text += f"Moisture={day_data['soil_moisture']}%, "
+            text += f"Temp={day_data['temperature']}°C, "
+            text += f"Humidity={day_data['humidity']}%\n"
+        text += "\n"
+        sections.append(("daily_metrics", text))
+    
+    return sections
+
+
+# Context sections the prompt can draw on, with trigger keywords (English,
+# Hindi and Assamese) and a base priority used for generic questions
+CHAT_SECTIONS = {
+    "sensors": {
+        "priority": 1.0,
+        "description": "current sensor readings: soil moisture, temperature, humidity, rainfall, soil pH",
+        "keywords": ["soil", "moisture", "temperature", "temp", "humid*", "rain*", "ph", "sensor*",
+                     "weather", "current*", "now", "water*", "मिट्टी", "पानी", "तापमान", "नमी", "मौसम",
+                     "মাটি", "পানী", "বৰষুণ"],
+    },
+    "averages": {
+        "priority": 0.2,
+        "description": "average sensor values over recent readings",
+        "keywords": ["average", "avg", "mean", "usual*", "typical*", "overall", "औसत", "গড়"],
+    },
+    "soil_moisture_trend": {
+        "priority": 0.3,
+        "description": "soil moisture trend, drying or wetting, irrigation need",
+        "keywords": ["trend*", "moisture", "dry*", "wet*", "irrigat*", "water*", "सिंचाई", "पानी", "পানী"],
+    },
+    "cultivation": {
+        "priority": 0.7,
+        "description": "crop health score, pest risk, drought risk and recommended action",
+        "keywords": ["health*", "pest*", "drought", "risk*", "crop*", "plant*", "bush*", "yield*", "action*",
+                     "कीड़े", "बीमारी", "फसल", "পোক", "ৰোগ"],
+    },
+    "alerts": {
+        "priority": 0.8,
+        "description": "active alerts, stress factors and risk score",
+        "keywords": ["alert*", "warning*", "stress*", "risk*", "problem*", "urgent*", "danger*", "wrong",
+                     "समस्या", "খতৰা"],
+    },
+    "market": {
+        "priority": 0.3,
+        "description": "tea auction market prices, demand, volatility and other markets",
+        "keywords": ["market*", "price*", "sell*", "auction*", "rate*", "demand*", "profit*", "₹", "rupee*",
+                     "kolkata", "guwahati", "siliguri", "कीमत", "बाज़ार", "बाजार", "दाम", "বজাৰ", "দাম"],
+    },
+    "leaf_quality": {
+        "priority": 0.3,
+        "description": "leaf scan grades, detected leaf disease, severity",
+        "keywords": ["leaf", "leaves", "scan*", "grade*", "quality", "disease*", "rust", "blight*", "blister*",
+                     "पत्ती", "पत्ते", "बीमारी", "পাত", "ৰোগ"],
+    },
+    "daily_metrics": {
+        "priority": 0.1,
+        "description": "daily sensor history for the last week",
+        "keywords": ["week*", "daily", "yesterday", "days", "history", "past", "last", "सप्ताह", "कल",
+                     "সপ্তাহ"],
+    },
+}
+
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "600"))
+
+# Optional local sentence-embedding model (sentence-transformers) used to
+# score sections by semantic similarity in addition to keywords
+CHAT_EMBEDDING_MODEL = os.getenv("CHAT_EMBEDDING_MODEL", "")
+CHAT_EMBEDDING_MIN_SIMILARITY = float(os.getenv("CHAT_EMBEDDING_MIN_SIMILARITY", "0.35"))
+
+section_embedder = None
+section_embeddings = None
+if CHAT_EMBEDDING_MODEL:
+    try:
+        from sentence_transformers import SentenceTransformer
+        section_embedder = SentenceTransformer(CHAT_EMBEDDING_MODEL)
+        section_embeddings = section_embedder.encode(
+            [spec["description"] for spec in CHAT_SECTIONS.values()],
+            normalize_embeddings=True
+        )
+        print(f"✅ Chat section embedder loaded: {CHAT_EMBEDDING_MODEL}")
+    except Exception as e:
+        print(f"⚠️ Chat section embedder unavailable, using keywords only: {e}")
+        section_embedder = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about 4 characters per token for Gemini)."""
+    return max(1, len(text) // 4)
+
+
+# Whitespace and punctuation (including the Devanagari danda) separate chat
+# tokens. \b cannot be used: Indic vowel signs are not word characters.
+CHAT_TOKEN_SEPARATORS = r"\s!-/:-@\[-`{-~।॥‘’“”…–—"
+
+
+def chat_keyword_pattern(keyword: str) -> str:
+    """
+    Regex matching `keyword` as whole tokens, in any script. A trailing "*"
+    marks a stem matched at a token start and through the rest of the token
+    ("irrigat*" matches "irrigation", "ph" does not match "phone"); keywords
+    without letters ("₹") match anywhere.
+    """
+    stem = keyword.endswith("*")
+    keyword = keyword.rstrip("*")
+    pattern = re.escape(keyword)
+    if not any(c.isalpha() for c in keyword):
+        return pattern
+    pattern = rf"(?<![^{CHAT_TOKEN_SEPARATORS}]){pattern}"
+    if stem:
+        return rf"{pattern}[^{CHAT_TOKEN_SEPARATORS}]*"
+    return rf"{pattern}(?![^{CHAT_TOKEN_SEPARATORS}])"
+
+
+def chat_tokens(message: str) -> set:
+    return set(filter(None, re.split(rf"[{CHAT_TOKEN_SEPARATORS}]+", message)))
+
+
+CHAT_SECTION_PATTERNS = {
+    name: re.compile("|".join(chat_keyword_pattern(kw) for kw in spec["keywords"]))
+    for name, spec in CHAT_SECTIONS.items()
+}
+
+
+def score_context_sections(message: str) -> Dict[str, float]:
+    """Relevance of each section to the message; 0 means no signal."""
+    message_lower = message.lower()
+    scores = {
+        name: float(len(pattern.findall(message_lower)))
+        for name, pattern in CHAT_SECTION_PATTERNS.items()
+    }
+
+    if section_embedder is not None:
+        query = section_embedder.encode([message], normalize_embeddings=True)[0]
+        for name, similarity in zip(CHAT_SECTIONS, section_embeddings @ query):
+            if similarity >= CHAT_EMBEDDING_MIN_SIMILARITY:
+                scores[name] += float(similarity) * 2
+
+    return scores
+
+
+def assemble_context_summary(message: str, context: dict, budget: int = None) -> tuple:
+    """
+    Build the farm data block from the sections relevant to the message,
+    most relevant first, until the token budget is used. Questions with no
+    clear topic get sections by base priority. Returns (summary, stats).
+    """
+    budget = budget or CHAT_CONTEXT_TOKEN_BUDGET
+    rendered = render_context_sections(context)
+    scores = score_context_sections(message)
+    targeted = any(scores[name] > 0 for name, _ in rendered)
+
+    def rank(name):
+        return scores[name] + CHAT_SECTIONS[name]["priority"]
+
+    # Current readings anchor every answer; other untargeted sections are
+    # dropped when the question is about something specific
+    candidates = [
+        (name, text) for name, text in rendered
+        if not targeted or scores[name] > 0 or name == "sensors"
+    ]
+    candidates.sort(key=lambda item: rank(item[0]), reverse=True)
+
+    header = "=== FARM DATA ===\n\n"
+    used = estimate_tokens(header)
+    included = set()
+    for name, text in candidates:
+        tokens = estimate_tokens(text)
+        if used + tokens <= budget:
+            included.add(name)
+            used += tokens
+
+    summary = header + "".join(text for name, text in rendered if name in included)
+    stats = {
+        "context_tokens": used,
+        "budget": budget,
+        "sections": [name for name, _ in rendered if name in included],
+        "dropped": [name for name, _ in rendered if name not in included],
+    }
+    return summary, stats
+
+
+def detect_chat_language(message: str) -> str:
+    """"hi", "as" or "en" from the script and common words of the message."""
+    tokens = chat_tokens(message)
+    if tokens & {"कैसे", "क्या", "मुझे", "चाय", "पानी", "मिट्टी", "कीड़े", "बीमारी", "सिंचाई"}:
+        return "hi"
+    if tokens & {"কেনেকৈ", "কি", "চাহ", "পানী", "মাটি"}:
+        return "as"
+    # Fall back to the script, e.g. "तापमान?"
+    for c in message:
+        if "ऀ" <= c <= "ॿ":
+            return "hi"
+        if "ঀ" <= c <= "৿":
+            return "as"
+    return "en"
+
+
+def build_chat_prompt(message: str, history: List[ChatMessage], context: dict, summary: str = "") -> tuple:
+    """
+    Full Gemini prompt for a chat turn: system instructions, the farm
+    context sections relevant to the question, the conversation summary,
+    recent history and the question. Returns (prompt, prompt_stats).
+    """
+    # Detect language
+    language = detect_chat_language(message)
+    
+    # Pick the context sections relevant to this message, within budget
+    context_summary, prompt_stats = assemble_context_summary(message, context)
     
     # Build chat history for context
     chat_history = ""
     for msg in history[-6:]:  # Last 6 messages for context
         chat_history += f"{msg.role.capitalize()}: {msg.content}\n"
     
+    # Running summary of turns older than the history above
+    summary_block = f"Earlier in this conversation:\n{summary}\n\n" if summary else ""
+    
     # Enhanced system prompt with multi-lingual support
-    if is_hindi:
+    if language == "hi":
         language_instruction = """
 CRITICAL: The user is asking in HINDI. You MUST respond ENTIRELY in HINDI (Devanagari script).
 Use natural, conversational Hindi that a farmer in Assam would understand.
 """
-    elif is_assamese:
+    elif language == "as":
         language_instruction = """
 CRITICAL: The user is asking in ASSAMESE. You MUST respond ENTIRELY in ASSAMESE (Bengali script).
 Use natural, conversational Assamese that a tea farmer would understand.
@@ -3438,17 +6245,24 @@ Examples of good responses:
 
 {context_summary}
 
-Previous conversation:
+{summary_block}Previous conversation:
 {chat_history}
 
 User question: {message}
 
 Provide a helpful, data-driven response. If appropriate, end with 1-3 specific suggested actions (each on a new line starting with "ACTION:").
 """
+    prompt_stats["prompt_tokens"] = estimate_tokens(full_prompt)
+    return full_prompt, prompt_stats
 
+
+def generate_chat_response(full_prompt: str) -> tuple:
+    """
+    Generate AI response using Gemini for a prompt from build_chat_prompt.
+    Returns (response_text, suggested_actions)
+    """
     try:
-        model = genai.GenerativeModel("models/gemini-flash-latest")
-        response = model.generate_content(full_prompt)
+        response = llm.generate_content(full_prompt)
         
         if not response or not response.text:
             return None, []
@@ -3480,44 +6294,741 @@ Provide a helpful, data-driven response. If appropriate, end with 1-3 specific s
         return None, []
 
 
+# Which cached context part each prompt section is built from
+CHAT_SECTION_PARTS = {
+    "sensors": "sensors",
+    "averages": "sensors",
+    "soil_moisture_trend": "sensors",
+    "cultivation": "sensors",
+    "alerts": "sensors",
+    "daily_metrics": "sensors",
+    "market": "market",
+    "leaf_quality": "leaf",
+}
+
+# How long an answer stays valid, by the most volatile data it cites.
+# Market and leaf answers are also dropped as soon as that data changes.
+CHAT_CACHE_TTLS = {
+    "sensors": float(os.getenv("CHAT_CACHE_SENSOR_TTL_SECONDS", "120")),
+    "leaf": float(os.getenv("CHAT_CACHE_LEAF_TTL_SECONDS", "3600")),
+    "market": float(os.getenv("CHAT_CACHE_MARKET_TTL_SECONDS", "21600")),
+}
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "2000"))
+# Cosine similarity for near-duplicate questions (needs CHAT_EMBEDDING_MODEL)
+CHAT_CACHE_SIMILARITY = float(os.getenv("CHAT_CACHE_SIMILARITY", "0.92"))
+
+
+def normalize_question(message: str) -> str:
+    """Lowercase, drop punctuation and symbols, collapse whitespace."""
+    cleaned = "".join(
+        " " if unicodedata.category(c)[0] in "PS" else c
+        for c in message.lower()
+    )
+    return " ".join(cleaned.split())
+
+
+class ChatResponseCache:
+    """
+    Answers keyed by normalised question plus a scope: farm, the previous
+    user question (so follow-ups like "and yesterday?" stay apart), the
+    sections the prompt cited and the versions of the slow-moving data
+    behind them (market data, leaf scans). Each answer expires after the
+    shortest TTL of the data it cites.
+
+    With a local embedding model, questions that miss exactly are matched
+    against the cached questions of the same scope by cosine similarity
+    (a brute-force vector index; scopes hold a handful of questions).
+    """
+
+    def __init__(self, max_entries: int, similarity: float):
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._entries = OrderedDict()  # (scope, question) -> entry
+        self._scopes = defaultdict(set)  # scope -> {question}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(farm_id: str, history: List[ChatMessage], prompt_stats: dict, versions: dict) -> str:
+        parts = sorted({CHAT_SECTION_PARTS[name] for name in prompt_stats["sections"]})
+        last_question = next((m.content for m in reversed(history) if m.role == "user"), "")
+        scope = json.dumps([
+            farm_id,
+            normalize_question(last_question),
+            prompt_stats["sections"],
+            {part: versions.get(part) for part in parts if part != "sensors"},
+        ], default=str)
+        return hashlib.sha1(scope.encode()).hexdigest()
+
+    @staticmethod
+    def ttl(prompt_stats: dict) -> float:
+        parts = {CHAT_SECTION_PARTS[name] for name in prompt_stats["sections"]}
+        return min((CHAT_CACHE_TTLS[p] for p in parts), default=CHAT_CACHE_TTLS["sensors"])
+
+    def _embed(self, question: str):
+        if section_embedder is None:
+            return None
+        return section_embedder.encode([question], normalize_embeddings=True)[0]
+
+    def get(self, scope: str, message: str) -> Optional[dict]:
+        question = normalize_question(message)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((scope, question))
+            if entry and entry["expires"] > now:
+                self._entries.move_to_end((scope, question))
+                self.hits += 1
+                return entry["value"]
+            candidates = [
+                self._entries[(scope, q)] for q in self._scopes.get(scope, ())
+                if self._entries[(scope, q)]["expires"] > now
+                and self._entries[(scope, q)]["embedding"] is not None
+            ]
+
+        if candidates and section_embedder is not None:
+            query = self._embed(question)
+            similarities = np.stack([c["embedding"] for c in candidates]) @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity:
+                with self._lock:
+                    self.near_hits += 1
+                return candidates[best]["value"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, scope: str, message: str, value: dict, ttl: float):
+        question = normalize_question(message)
+        entry = {
+            "value": value,
+            "expires": time.time() + ttl,
+            "embedding": self._embed(question),
+        }
+        with self._lock:
+            self._entries[(scope, question)] = entry
+            self._entries.move_to_end((scope, question))
+            self._scopes[scope].add(question)
+            while len(self._entries) > self.max_entries:
+                (old_scope, old_question), _ = self._entries.popitem(last=False)
+                self._scopes[old_scope].discard(old_question)
+                if not self._scopes[old_scope]:
+                    del self._scopes[old_scope]
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+        }
+
+
+chat_response_cache = ChatResponseCache(CHAT_CACHE_MAX_ENTRIES, CHAT_CACHE_SIMILARITY)
+
+
+# Local answers for pure data lookups ("what is my soil moisture?",
+# "गुवाहाटी में चाय का भाव?"), filled from the cached farm context in the
+# user's language without a Gemini call
+CHAT_LOCAL_ANSWERS = os.getenv("CHAT_LOCAL_ANSWERS", "true").lower() == "true"
+CHAT_LOCAL_MAX_WORDS = int(os.getenv("CHAT_LOCAL_MAX_WORDS", "12"))
+
+# Lookup intents with trigger phrases (English, Hindi, Assamese) and
+# per-language templates
+CHAT_LOOKUP_INTENTS = {
+    "soil_moisture": {
+        "keywords": ["soil moisture", "moisture", "नमी", "মাটিৰ আৰ্দ্ৰতা*"],
+        "templates": {
+            "en": "Your current soil moisture is {value}%.",
+            "hi": "आपकी मिट्टी की वर्तमान नमी {value}% है।",
+            "as": "আপোনাৰ মাটিৰ বৰ্তমানৰ আৰ্দ্ৰতা {value}%।",
+        },
+    },
+    "temperature": {
+        "keywords": ["temperature", "temp", "how hot", "how cold", "तापमान", "উষ্ণতা*", "তাপমাত্ৰা*"],
+        "templates": {
+            "en": "The current temperature is {value}°C.",
+            "hi": "वर्तमान तापमान {value}°C है।",
+            "as": "বৰ্তমানৰ উষ্ণতা {value}°C।",
+        },
+    },
+    "humidity": {
+        "keywords": ["humidity", "humid", "आर्द्रता", "বতাহৰ আৰ্দ্ৰতা*"],
+        "templates": {
+            "en": "The current humidity is {value}%.",
+            "hi": "वर्तमान आर्द्रता {value}% है।",
+            "as": "বৰ্তমানৰ বতাহৰ আৰ্দ্ৰতা {value}%।",
+        },
+    },
+    "rainfall": {
+        "keywords": ["rainfall", "rain", "बारिश", "वर्षा", "বৰষুণ*"],
+        "templates": {
+            "en": "Rainfall over the last 7 days is {value} mm.",
+            "hi": "पिछले 7 दिनों में {value} मिमी बारिश हुई है।",
+            "as": "যোৱা ৭ দিনত {value} মিমি বৰষুণ হৈছে।",
+        },
+    },
+    "soil_ph": {
+        "keywords": ["ph", "acidity"],
+        "templates": {
+            "en": "Your soil pH is {value}.",
+            "hi": "आपकी मिट्टी का pH {value} है।",
+            "as": "আপোনাৰ মাটিৰ pH {value}।",
+        },
+    },
+    "health_score": {
+        "keywords": ["health score", "farm health", "स्वास्थ्य", "স্বাস্থ্য*"],
+        "templates": {
+            "en": "Your farm health score is {value}/100.",
+            "hi": "आपके खेत का स्वास्थ्य स्कोर {value}/100 है।",
+            "as": "আপোনাৰ বাগিচাৰ স্বাস্থ্য স্ক'ৰ {value}/100।",
+        },
+    },
+    "pest_risk": {
+        "keywords": ["pest risk", "कीट जोखिम", "कीड़ों का खतरा", "পোকৰ আশংকা*"],
+        "templates": {
+            "en": "Pest risk is currently {value}.",
+            "hi": "अभी कीट जोखिम {value} है।",
+            "as": "বৰ্তমান পোকৰ আশংকা {value}।",
+        },
+    },
+    "drought_risk": {
+        "keywords": ["drought risk", "drought", "सूखा", "খৰাং*"],
+        "templates": {
+            "en": "Drought risk is currently {value}.",
+            "hi": "अभी सूखे का जोखिम {value} है।",
+            "as": "বৰ্তমান খৰাঙৰ আশংকা {value}।",
+        },
+    },
+    "market_price": {
+        "keywords": ["price", "rate", "कीमत", "भाव", "दाम", "দাম*"],
+        "templates": {
+            "en": "The {market} price is ₹{value}/kg (week ending {week}).",
+            "hi": "{market} में भाव ₹{value}/किलो है (सप्ताह {week})।",
+            "as": "{market}ত দাম ₹{value}/কেজি (সপ্তাহ {week})।",
+        },
+    },
+    "leaf_grade": {
+        "keywords": ["leaf grade", "grade", "ग्रेड", "গ্ৰেড*"],
+        "templates": {
+            "en": "Your latest leaf scan was graded {value}.",
+            "hi": "आपके पिछले पत्ती स्कैन का ग्रेड {value} है।",
+            "as": "আপোনাৰ শেহতীয়া পাত স্কেনৰ গ্ৰেড {value}।",
+        },
+    },
+    "leaf_disease": {
+        "keywords": ["leaf disease", "disease", "बीमारी", "रोग", "ৰোগ*"],
+        "templates": {
+            "en": "The latest leaf scan detected {value} ({severity} severity).",
+            "hi": "पिछले पत्ती स्कैन में {value} पाया गया (गंभीरता: {severity})।",
+            "as": "শেহতীয়া পাত স্কেনত {value} পোৱা গৈছে (গুৰুত্ব: {severity})।",
+        },
+        "none_templates": {
+            "en": "No disease was detected in the latest leaf scan.",
+            "hi": "पिछले पत्ती स्कैन में कोई बीमारी नहीं मिली।",
+            "as": "শেহতীয়া পাত স্কেনত কোনো ৰোগ পোৱা নগ'ল।",
+        },
+    },
+}
+
+# Market slot for price lookups: column -> names in each script
+CHAT_MARKET_NAMES = {
+    "guwahati": ["guwahati", "गुवाहाटी", "গুৱাহাটী"],
+    "kolkata": ["kolkata", "calcutta", "कोलकाता", "কলকাতা"],
+    "siliguri": ["siliguri", "सिलीगुड़ी", "শিলিগুৰি"],
+    "jalpaiguri": ["jalpaiguri", "जलपाईगुड़ी", "জলপাইগুৰি"],
+    "mjunction": ["mjunction"],
+    "cochin": ["cochin", "kochi", "कोचीन", "कोच्चि"],
+    "coonoor": ["coonoor", "कुन्नूर"],
+    "coimbatore": ["coimbatore", "कोयंबटूर"],
+    "tea_serve": ["tea serve", "teaserve"],
+}
+
+# Questions asking for advice, reasons, forecasts or anything other than the
+# current value go to Gemini even if they mention a metric
+CHAT_OPEN_ENDED_CUES = [
+    "why", "should", "recommend", "suggest", "advice", "advise", "improve", "treat", "prevent",
+    "explain", "compare", "forecast", "predict", "will", "best", "when", "tip", "help", "plan",
+    "how to", "how do", "how can", "what to do", "average", "avg", "trend", "yesterday",
+    "last week", "history", "past", "tomorrow", "next", "ok", "good", "bad", "enough", "normal",
+    "going to", "gonna", "expect", "expected", "future", "what does", "mean", "means", "meaning",
+    "define", "definition", "max", "maximum", "min", "minimum", "highest", "lowest", "peak",
+    "too", "above", "below", "over", "under", "more", "less", "change*", "difference", "was",
+    "did", "at", "ago", "since", "week", "month", "hour*", "set", "alert*", "notify", "remind*",
+    "fahrenheit", "celsius", "convert*", "high", "low",
+    "क्यों", "कैसे", "चाहिए", "सुझाव", "सलाह", "भविष्य", "औसत", "कल", "ठीक", "अच्छा", "अच्छी",
+    "होगा", "होगी", "होंगे", "मतलब", "अर्थ",
+    "কিয়", "কেনেকৈ", "উচিত*", "পৰামৰ্শ*", "গড়*", "কালি", "ভাল*", "হ'ব", "হ’ব", "হব", "অৰ্থ*", "মানে",
+]
+
+
+# Words a plain lookup may contain besides its metric and market names
+# ("what is my soil moisture", "show the kolkata price"); any other word
+# sends the message to Gemini
+CHAT_LOOKUP_WORDS = [
+    "what is", "what's", "whats", "what are", "how much", "which", "current", "currently", "now",
+    "right now", "show", "show me", "tell me", "give me", "latest", "today", "today's",
+    "my", "the", "our", "of", "in", "for", "and", "is", "are", "it", "me", "farm", "field",
+    "tea", "please", "level", "value", "reading", "risk", "score", "leaf", "scan", "market",
+    "auction", "per", "kg",
+    "क्या", "है", "कितना", "कितनी", "कितने", "बताओ", "बताइए", "दिखाओ", "अभी", "आज", "वर्तमान",
+    "मेरी", "मेरा", "मेरे", "की", "का", "के", "में", "चाय", "खेत", "और",
+    "কিমান", "কি", "এতিয়া", "আজি", "বৰ্তমান*", "দেখুৱাওক", "মোৰ", "আমাৰ", "চাহ*", "বাগিচা*",
+    "আৰু", "হৈছে",
+]
+
+# Routing checks run when the router starts: message -> intents answered
+# locally, or None for messages that must reach Gemini
+CHAT_ROUTING_CHECKS = [
+    ("what is my soil moisture?", ["soil_moisture"]),
+    ("temperature", ["temperature"]),
+    ("current temperature and humidity", ["temperature", "humidity"]),
+    ("show me the kolkata price", ["market_price"]),
+    ("Kolkata today?", ["market_price"]),
+    ("kolkata and siliguri price", ["market_price"]),
+    ("गुवाहाटी में चाय का भाव?", ["market_price"]),
+    ("नमी कितनी है?", ["soil_moisture"]),
+    ("is temperature too high", None),
+    ("temperature in fahrenheit", None),
+    ("what was the temperature at 3pm", None),
+    ("what is the max temperature today", None),
+    ("minimum soil moisture this week", None),
+    ("lowest price in kolkata", None),
+    ("how much did price change in kolkata", None),
+    ("set soil moisture alert to 40", None),
+    ("why is my soil moisture low", None),
+    ("is humidity above 80", None),
+]
+
+
+def compile_chat_phrases(phrases: List[str]):
+    """Phrases match whole tokens in any script (see chat_keyword_pattern)."""
+    return re.compile("|".join(
+        chat_keyword_pattern(p) for p in sorted(phrases, key=len, reverse=True)
+    ))
+
+
+class ChatIntentRouter:
+    """
+    Classifies chat messages as data lookups or open-ended questions.
+    Lookups ("what is my soil moisture", "Kolkata price?") name one or more
+    metrics or markets and nothing else; they are answered from the farm
+    context with language templates. A message with any word outside
+    CHAT_LOOKUP_WORDS (a comparison, time, unit or command) goes to Gemini.
+    """
+
+    def __init__(self):
+        self._intents = {
+            name: compile_chat_phrases(spec["keywords"])
+            for name, spec in CHAT_LOOKUP_INTENTS.items()
+        }
+        # Place names take case suffixes in Assamese ("গুৱাহাটীত"), so match them as stems
+        self._markets = {
+            column: compile_chat_phrases([f"{n}*" for n in names])
+            for column, names in CHAT_MARKET_NAMES.items()
+        }
+        self._open_ended = compile_chat_phrases(CHAT_OPEN_ENDED_CUES)
+        self._lookup_words = compile_chat_phrases(CHAT_LOOKUP_WORDS)
+        self.local = 0
+        self.routed = 0
+
+        for message, expected in CHAT_ROUTING_CHECKS:
+            route = self.classify(message)
+            intents = route["intents"] if route else None
+            if intents != expected:
+                print(f"⚠️ Chat routing check failed: {message!r} -> {intents}, expected {expected}")
+
+    def classify(self, message: str) -> Optional[dict]:
+        """{"intents", "markets", "language"} for a lookup, else None."""
+        text = message.lower()
+        if len(text.split()) > CHAT_LOCAL_MAX_WORDS or self._open_ended.search(text):
+            return None
+
+        markets = [column for column, pattern in self._markets.items() if pattern.search(text)]
+        intents = [name for name, pattern in self._intents.items() if pattern.search(text)]
+        if markets and not intents:
+            intents = ["market_price"]  # "Kolkata today?"
+        if "leaf_disease" in intents and "leaf_grade" in intents:
+            intents.remove("leaf_grade")
+
+        if not intents:
+            return None
+
+        # Anything left after the metric, market and lookup words qualifies
+        # the question ("too high", "at 3pm", "in fahrenheit")
+        rest = text
+        for pattern in (*self._intents.values(), *self._markets.values(), self._lookup_words):
+            rest = pattern.sub(" ", rest)
+        if chat_tokens(rest):
+            return None
+        return {
+            "intents": intents,
+            "markets": markets,
+            "language": detect_chat_language(message),
+        }
+
+    def _slot_values(
+        self, intent: str, market_column: Optional[str], language: str, context: dict
+    ) -> Optional[dict]:
+        sensors = context.get("sensors", {})
+        cultivation = context.get("cultivation", {})
+        leaf = context.get("leaf_quality", {}).get("latest", {})
+
+        if intent in ("soil_moisture", "temperature", "humidity", "rainfall", "soil_ph"):
+            key = "rainfall_7d" if intent == "rainfall" else intent
+            value = sensors.get(key)
+            return None if value is None else {"value": round(float(value), 1)}
+        if intent == "health_score":
+            value = cultivation.get("health_score", context.get("alerts", {}).get("health_score"))
+            return None if value is None else {"value": value}
+        if intent in ("pest_risk", "drought_risk"):
+            value = cultivation.get(intent)
+            return None if value is None else {"value": value}
+        if intent == "market_price":
+            market = context.get("market")
+            if not market:
+                return None
+            column = market_column or PRIMARY_MARKET
+            if column == PRIMARY_MARKET:
+                value = market.get("current_price")
+            else:
+                value = market.get("all_locations", {}).get(column.title())
+            if value is None:
+                return None
+            # Market name in the question's script where one is known
+            name = next(
+                (n for n in CHAT_MARKET_NAMES.get(column, [])
+                 if detect_chat_language(n) == language and not n.isascii()),
+                column.replace("_", " ").title()
+            )
+            return {"value": value, "market": name, "week": market.get("week_ending")}
+        if intent == "leaf_grade":
+            return {"value": leaf["grade"]} if leaf.get("grade") else None
+        if intent == "leaf_disease":
+            if not leaf.get("grade"):
+                return None
+            return {"value": leaf.get("disease_type"), "severity": leaf.get("severity")}
+        return None
+
+    def answer(self, message: str, context: dict) -> Optional[tuple]:
+        """
+        (response, route) when the message is a lookup the context can
+        answer in full; None sends it to Gemini.
+        """
+        route = self.classify(message) if CHAT_LOCAL_ANSWERS else None
+        if route is None:
+            self.routed += 1
+            return None
+
+        language = route["language"]
+        sentences = []
+        for intent in route["intents"]:
+            spec = CHAT_LOOKUP_INTENTS[intent]
+            # One price sentence per market named ("kolkata and siliguri price")
+            columns = route["markets"] if intent == "market_price" and route["markets"] else [None]
+            for column in columns:
+                values = self._slot_values(intent, column, language, context)
+                if values is None:
+                    # Missing data: let Gemini explain rather than answer partially
+                    self.routed += 1
+                    return None
+                if values["value"] is None and "none_templates" in spec:
+                    sentences.append(spec["none_templates"][language])
+                else:
+                    sentences.append(spec["templates"][language].format(**values))
+
+        self.local += 1
+        return " ".join(sentences), route
+
+    def stats(self) -> dict:
+        return {
+            "enabled": CHAT_LOCAL_ANSWERS,
+            "local": self.local,
+            "routed": self.routed,
+        }
+
+
+chat_router = ChatIntentRouter()
+
 
 @app.post("/api/chat")
-def chat_endpoint(request: ChatRequest):
+async def chat_endpoint(
+    request: ChatRequest,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(get_current_user)
+):
     """
     Main chatbot endpoint with AI and fallback support.
+    Pass the returned session_id on later turns instead of the history;
+    the conversation is then kept (and summarised) server-side.
     """
+    FARM_ID = resolve_farm_id(user)
+    USER_ID = user.uid
+    session_id, summary, history = await run_in_threadpool(resolve_chat_session, USER_ID, request)
     try:
         # Gather comprehensive farm context
-        context = gather_comprehensive_context()
+        context = await gather_comprehensive_context(FARM_ID)
         
-        # Try to get AI response
-        ai_response, suggested_actions = generate_chat_response(
-            request.message, 
-            request.history, 
-            context
+        # Pure lookups are answered from the context without Gemini
+        local = await run_in_threadpool(chat_router.answer, request.message, context)
+        if local:
+            response, route = local
+            await run_in_threadpool(
+                record_chat_turn, USER_ID, session_id, request.message, response
+            )
+            background_tasks.add_task(compact_chat_session, USER_ID, session_id)
+            return ChatResponse(
+                response=response,
+                source="Local",
+                prompt_stats={"intents": route["intents"], "language": route["language"]},
+                session_id=session_id
+            )
+        
+        prompt, prompt_stats = await run_in_threadpool(
+            build_chat_prompt, request.message, history, context, summary
         )
         
+        # Repeat questions over unchanged data are answered from cache
+        scope = ChatResponseCache.scope(
+            FARM_ID, history, prompt_stats, chat_contexts.versions(FARM_ID)
+        )
+        cached = await run_in_threadpool(chat_response_cache.get, scope, request.message)
+        if cached:
+            await run_in_threadpool(
+                record_chat_turn, USER_ID, session_id, request.message, cached["response"]
+            )
+            background_tasks.add_task(compact_chat_session, USER_ID, session_id)
+            return ChatResponse(
+                **cached,
+                source="AI",
+                prompt_stats=prompt_stats,
+                cached=True,
+                session_id=session_id
+            )
+        
+        # Try to get AI response
+        ai_response, suggested_actions = await run_in_threadpool(generate_chat_response, prompt)
+        
         if ai_response:
+            await run_in_threadpool(
+                chat_response_cache.put,
+                scope,
+                request.message,
+                {"response": ai_response, "suggested_actions": suggested_actions},
+                ChatResponseCache.ttl(prompt_stats)
+            )
+            await run_in_threadpool(
+                record_chat_turn, USER_ID, session_id, request.message, ai_response
+            )
+            background_tasks.add_task(compact_chat_session, USER_ID, session_id)
             return ChatResponse(
                 response=ai_response,
                 source="AI",
-                suggested_actions=suggested_actions
+                suggested_actions=suggested_actions,
+                prompt_stats=prompt_stats,
+                session_id=session_id
             )
         else:
             # AI failed, use fallback
             fallback_response = get_fallback_response(request.message)
+            await run_in_threadpool(
+                record_chat_turn, USER_ID, session_id, request.message, fallback_response
+            )
             return ChatResponse(
                 response=fallback_response,
                 source="Fallback",
-                suggested_actions=[]
+                suggested_actions=[],
+                session_id=session_id
             )
     
     except Exception as e:
         print(f"❌ Chat endpoint error: {e}")
         # Ultimate fallback
         fallback_response = get_fallback_response(request.message)
+        await run_in_threadpool(
+            record_chat_turn, USER_ID, session_id, request.message, fallback_response
+        )
         return ChatResponse(
             response=fallback_response,
             source="Fallback",
-            suggested_actions=[]
-        )
\ No newline at end of file
+            suggested_actions=[],
+            session_id=session_id
+        )
+
+
+class ActionLineFilter:
+    """
+    Passes streamed response text through as it arrives, holding back
+    only lines that start with "ACTION:" and collecting them as actions.
+    """
+
+    PREFIX = "ACTION:"
+
+    def __init__(self):
+        self.actions = []
+        self._line = ""
+        self._passthrough = False
+
+    def _end_line(self) -> str:
+        line, self._line = self._line, ""
+        if line.strip().startswith(self.PREFIX):
+            action = line.strip()[len(self.PREFIX):].strip()
+            if action:
+                self.actions.append(action)
+            return ""
+        return line
+
+    def feed(self, chunk: str) -> str:
+        out = []
+        for c in chunk:
+            if self._passthrough:
+                out.append(c)
+                if c == "\n":
+                    self._passthrough = False
+                continue
+
+            self._line += c
+            if c == "\n":
+                out.append(self._end_line())
+                continue
+
+            # Release the line as soon as it can no longer be an ACTION line
+            head = self._line.lstrip()
+            if head and not (self.PREFIX.startswith(head) or head.startswith(self.PREFIX)):
+                out.append(self._line)
+                self._line = ""
+                self._passthrough = True
+
+        return "".join(out)
+
+    def finish(self) -> str:
+        return self._end_line()
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def chat_event_stream(message: str, prompt: str, prompt_stats: dict, scope: str, session: tuple):
+    """
+    Server-sent events for one chat turn:
+    token* (text deltas), then actions, then done.
+    `session` is (user_id, session_id) for recording the answered turn;
+    the endpoint compacts the session once the stream has been sent.
+    """
+    user_id, session_id = session
+    cached = chat_response_cache.get(scope, message)
+    if cached:
+        record_chat_turn(user_id, session_id, message, cached["response"])
+        yield sse_event("token", {"text": cached["response"]})
+        yield sse_event("actions", {"suggested_actions": cached["suggested_actions"]})
+        yield sse_event("done", {
+            "source": "AI", "prompt_stats": prompt_stats, "cached": True, "session_id": session_id
+        })
+        return
+
+    action_filter = ActionLineFilter()
+    streamed = []
+    source = "AI"
+    complete = False
+
+    try:
+        for chunk in llm.stream_content(prompt):
+            text = action_filter.feed(chunk)
+            if text:
+                streamed.append(text)
+                yield sse_event("token", {"text": text})
+
+        tail = action_filter.finish()
+        if tail:
+            streamed.append(tail)
+            yield sse_event("token", {"text": tail})
+        complete = True
+
+    except Exception as e:
+        print(f"❌ Chat stream error: {type(e).__name__}: {e}")
+        if not streamed:
+            # Nothing sent yet, so the rule-based answer can stand in cleanly
+            source = "Fallback"
+            fallback_response = get_fallback_response(message)
+            record_chat_turn(user_id, session_id, message, fallback_response)
+            yield sse_event("token", {"text": fallback_response})
+        else:
+            yield sse_event("error", {"detail": "Response interrupted"})
+
+    response = "".join(streamed).strip()
+    if complete and response:
+        chat_response_cache.put(
+            scope,
+            message,
+            {"response": response, "suggested_actions": action_filter.actions},
+            ChatResponseCache.ttl(prompt_stats)
+        )
+        record_chat_turn(user_id, session_id, message, response)
+
+    yield sse_event("actions", {"suggested_actions": action_filter.actions})
+    yield sse_event("done", {
+        "source": source, "prompt_stats": prompt_stats, "cached": False, "session_id": session_id
+    })
+
+
+def local_event_stream(message: str, response: str, route: dict, session: tuple):
+    """The same event sequence for an answer from the intent router."""
+    user_id, session_id = session
+    record_chat_turn(user_id, session_id, message, response)
+    yield sse_event("token", {"text": response})
+    yield sse_event("actions", {"suggested_actions": []})
+    yield sse_event("done", {
+        "source": "Local",
+        "prompt_stats": {"intents": route["intents"], "language": route["language"]},
+        "cached": False,
+        "session_id": session_id
+    })
+
+
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(
+    request: ChatRequest,
+    background_tasks: BackgroundTasks,
+    user: User = Depends(get_current_user)
+):
+    """
+    Streaming variant of /api/chat (text/event-stream).
+    Events: "token" {text} as the answer is generated, "actions"
+    {suggested_actions} once complete, then "done" {source, prompt_stats,
+    cached, session_id}. Cached answers arrive as a single token event.
+    """
+    FARM_ID = resolve_farm_id(user)
+    USER_ID = user.uid
+    session_id, summary, history = await run_in_threadpool(resolve_chat_session, USER_ID, request)
+    # Runs after the whole stream has been sent
+    background_tasks.add_task(compact_chat_session, USER_ID, session_id)
+    try:
+        context = await gather_comprehensive_context(FARM_ID)
+    except Exception as e:
+        print(f"❌ Chat context error: {e}")
+        context = {}
+
+    local = await run_in_threadpool(chat_router.answer, request.message, context)
+    if local:
+        response, route = local
+        return StreamingResponse(
+            local_event_stream(request.message, response, route, (USER_ID, session_id)),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    prompt, prompt_stats = await run_in_threadpool(
+        build_chat_prompt, request.message, history, context, summary
+    )
+    scope = ChatResponseCache.scope(
+        FARM_ID, history, prompt_stats, chat_contexts.versions(FARM_ID)
+    )
+
+    return StreamingResponse(
+        chat_event_stream(request.message, prompt, prompt_stats, scope, (USER_ID, session_id)),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -58,6 +58,8 @@ export default function ChatbotBubble() {
   ]);
   const [inputValue, setInputValue] = useState('');
   const [isLoading, setIsLoading] = useState(false);
+  // Server-side conversation; once set, history stays on the backend
+  const [sessionId, setSessionId] = useState<string | null>(null);
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
   const scrollToBottom = () => {
@@ -90,18 +92,16 @@ export default function ChatbotBubble() {
     setIsLoading(true);
 
     try {
-      // Prepare chat history for API
-      const history = messages.map(msg => ({
-        role: msg.type === 'user' ? 'user' : 'assistant',
-        content: msg.content
-      }));
-
       // Call backend API with authentication
       const data = await apiClient.post('/api/chat', {
         message: inputValue,
-        history: history
+        session_id: sessionId
       });
 
+      if (data.session_id) {
+        setSessionId(data.session_id);
+      }
+
       const botResponse: Message = {
         id: (Date.now() + 1).toString(),
         type: 'bot',